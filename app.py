@@ -1,9 +1,36 @@
-from flask import Flask, request, jsonify
+import time
+# Read before the other imports so the startup timings include them
+STARTED_AT = time.perf_counter()
+from flask import Flask, Response, request, jsonify
 import requests
 import os
-from pprint import pprint
+import logging
+import contextvars
+import concurrent.futures
+from job_queue import make_queue, WorkerPool
+from coalesce import Coalescer
+from shopify_client import build_clients
+from cache import make_cache
+from mappings import make_mapping_store
+from outbox import Deferred, make_outbox
+from circuit import CLOSED, Bulkhead, CircuitOpenError
+from dedup import make_deduplicator, timestamp_seconds, updated_at_seconds
+from webhooks import parse_body, verify_hmac
+from field_mappings import load_mappings
+from product_reads import ProductQuery
+from reconcile import make_reconciler
+from startup import make_warmup
+from capture import make_capture
+import metrics
+import logs
 
 app = Flask(__name__)
+logs.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Source store, destination stores and the fields synced to each (REGION_MAPPINGS_FILE / REGION_MAPPINGS)
+region_mappings = load_mappings()
+SOURCE_REGION = region_mappings.source
 
 # Load store configurations from environment variables
 store_configs = {
@@ -12,111 +39,649 @@ store_configs = {
         "API_KEY": os.getenv(f"{region}_API_KEY"),
         "PASSWORD": os.getenv(f"{region}_PASSWORD"),
         "API_VERSION": os.getenv(f"{region}_API_VERSION"),
-    } for region in ["UK", "US", "EU", "DUCO"]
+        "BASE_URL": os.getenv(f"{region}_BASE_URL"),
+    } for region in [SOURCE_REGION, *region_mappings.regions]
+}
+logs.register_secrets(*(config[key] for config in store_configs.values() for key in ("API_KEY", "PASSWORD")))
+clients = build_clients(store_configs)
+# Connects to and checks every store in the background; /readyz reports ready once it has finished
+warmup = make_warmup(clients, STARTED_AT)
+# Destination stores that receive updates
+SYNC_REGIONS = region_mappings.enabled_regions()
+# Source variants and metafield mappings, keyed by store and product ID
+cache = make_cache()
+# Persistent UK -> destination product/variant mappings, consulted before Shopify
+mappings = make_mapping_store()
+# Failed destination writes, retried with backoff until they succeed or are dead-lettered
+outbox = make_outbox()
+# Webhook IDs already seen and the newest updated_at accepted per product
+deduplicator = make_deduplicator()
+
+# Destination stores are updated concurrently ("threads") or one after another ("serial")
+FANOUT_MODE = os.getenv("FANOUT_MODE", "threads").lower()
+REGION_TIMEOUT = float(os.getenv("REGION_TIMEOUT", "60"))
+fanout_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("FANOUT_WORKERS", "8")), thread_name_prefix="fanout"
+)
+# At most REGION_SLOTS syncs per destination store at once, so a slow store can't hold every fan-out thread;
+# a sync that can't get a slot within REGION_SLOT_WAIT seconds is parked in the outbox
+region_slots = {
+    region: Bulkhead(int(os.getenv("REGION_SLOTS", "4")), float(os.getenv("REGION_SLOT_WAIT", "5")))
+    for region in region_mappings.regions
+}
+
+def wake_parked_updates(region, state):
+    # Updates parked while a store's circuit was open are retried as soon as it closes
+    if state == CLOSED:
+        outbox.wake(region)
+
+for region in [SOURCE_REGION, *region_mappings.regions]:
+    clients[region].breaker.listeners.append(wake_parked_updates)
+
+# Only send fields that differ from the destination, and skip writes that would change nothing
+DIFF_SYNC = os.getenv("DIFF_SYNC", "1") == "1"
+# "graphql" writes product, variants and shipping label in one GraphQL request per store
+WRITE_MODE = os.getenv("WRITE_MODE", "rest").lower()
+# Take source variants from the webhook payload instead of re-fetching the UK product
+SOURCE_VARIANTS_FROM_PAYLOAD = os.getenv("SOURCE_VARIANTS_FROM_PAYLOAD", "1") == "1"
+# Read products and metafields with batched GraphQL nodes() queries selecting only the synced fields
+BATCH_READS = os.getenv("BATCH_READS", "1") == "1"
+read_options = {"variants_page": int(os.getenv("READ_VARIANTS_PAGE", "25")), "max_batch": int(os.getenv("READ_BATCH", "50"))}
+READ_QUERIES = {
+    region: ProductQuery(mapping.product_fields, mapping.variant_fields, label="shipping_label" in mapping.metafields, **read_options)
+    for region, mapping in region_mappings.regions.items()
 }
+# The source product is only read for its variants, when the webhook's are incomplete
+READ_QUERIES[SOURCE_REGION] = ProductQuery(
+    variant_fields=sorted({source for region in SYNC_REGIONS for source in region_mappings[region].variant_sources}), **read_options
+)
+LINKS_QUERY = ProductQuery(label=True, links=True, **read_options)
+# With CAPTURE_DIR set, webhook deliveries and Shopify calls are recorded for replay.py
+capture = make_capture()
+if capture:
+    for client in clients.values():
+        client.call_listeners.append(capture.call)
+# The app's webhook signing secret; deliveries without a valid X-Shopify-Hmac-Sha256 are rejected when it is set
+WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+logs.register_secrets(WEBHOOK_SECRET)
+if not WEBHOOK_SECRET:
+    logger.warning("SHOPIFY_WEBHOOK_SECRET is not set; webhook signatures are not verified")
 
 @app.route('/webhook/product-update', methods=['POST'])
 def product_update_webhook():
-    data = request.json
-    product_id = data.get('id')
-    print(f"Updating for product ID: {product_id}")
+    body = request.get_data(cache=False)
+    if WEBHOOK_SECRET and not verify_hmac(body, request.headers.get("X-Shopify-Hmac-Sha256"), WEBHOOK_SECRET):
+        metrics.WEBHOOKS.labels("unauthorized").inc()
+        return jsonify({"message": "Invalid signature"}), 401
+    # Only after verification, so forged or unsigned bodies never reach the capture
+    if capture:
+        capture.webhook(body, request.headers)
 
+    data = parse_body(body)
+    if not isinstance(data, dict):
+        metrics.WEBHOOKS.labels("invalid").inc()
+        return jsonify({"message": "Invalid payload"}), 400
+
+    product_id = data.get('id')
     # if not product_id or product_id != 8098008498397:
     if not product_id:
+        metrics.WEBHOOKS.labels("ignored").inc()
         return jsonify({"message": "No need to update"}), 200
 
-    source_store_url = get_store_url(store_configs['UK'])
-    metafields_data = get_product_metafields(source_store_url, product_id)
-    if not metafields_data:
-        return jsonify({"message": "No destination IDs found"}), 404
+    # Redeliveries and payloads older than one already accepted would only repeat or revert a write
+    webhook_id = request.headers.get("X-Shopify-Webhook-Id")
+    rejected = deduplicator.check(webhook_id, product_id, updated_at_seconds(data))
+    if rejected:
+        metrics.WEBHOOKS.labels(rejected).inc()
+        with logs.bind(product_id=product_id, webhook_id=webhook_id):
+            logger.info("Skipped delivery", extra={"reason": rejected})
+        return jsonify({"message": f"Skipped {rejected} delivery for product ID {product_id}"}), 200
+
+    # Carried with the payload so the worker's log lines can be traced back to the delivery
+    if webhook_id:
+        data["_webhook_id"] = webhook_id
+    metrics.WEBHOOKS.labels("queued").inc()
+    coalescer.submit(product_id, data)
+    with logs.bind(product_id=product_id, webhook_id=webhook_id):
+        logger.info("Queued update")
+    return jsonify({"message": f"Product with ID {product_id} queued for update"}), 200
+
+def sync_product(data):
+    """Run the metafields -> variants -> update pipeline for one webhook payload.
+
+    Returns a per-region result dict, e.g. {"DUCO": {"status": "updated", ...}};
+    if the source lookup fails or its store's circuit is open, the sync is
+    queued in the outbox and reported under the source region instead.
+    """
+    product_id = data.get('id')
+    with logs.bind(product_id=product_id, webhook_id=data.get('_webhook_id')):
+        logger.info("Syncing product")
 
-    destination_ids = metafields_data.get("destination_ids")
-    shipping_label = metafields_data.get("shipping_label")
+        source_client = clients[SOURCE_REGION]
+        started_at = time.time()
+        invalidate_if_newer(source_client, product_id, data.get('updated_at'))
+        try:
+            with metrics.timed("metafield_lookup", SOURCE_REGION):
+                metafields_data = get_product_metafields(source_client, product_id)
+        except CircuitOpenError as e:
+            return defer_source_lookup(data, "parked", str(e), e.retry_in)
+        except requests.RequestException as e:
+            return defer_source_lookup(data, "failed", repr(e))
+        if metafields_data is None:
+            return defer_source_lookup(data, "failed", "metafields lookup failed")
+        # A retry of an older delivery's failed lookup would only sync stale data now
+        outbox.resolve(SOURCE_REGION, product_id, started_at, updated_at_seconds(data))
 
-    for region, config in store_configs.items():
-        if region != "UK" and region == 'DUCO':  # Skip source store
+        destination_ids = metafields_data.get("destination_ids")
+        # A label carried by the webhook is current; the stored one may be up to MAPPINGS_MAX_AGE old
+        shipping_label = payload_shipping_label(data)
+        if shipping_label is None:
+            shipping_label = metafields_data.get("shipping_label")
+
+        targets = {}
+        for region in SYNC_REGIONS:
             dest_product_id = destination_ids.get(region)
             if dest_product_id:
-                print(f"{region} product ID: {dest_product_id}")
+                targets[region] = (clients[region], dest_product_id)
+        if not targets:
+            logger.info("No destination IDs found")
+            return {}
 
-                store_url = get_store_url(config)
-                destination_variants = get_variants_details(store_url, dest_product_id)
-                updated_data = prepare_update_data(region, source_store_url, data, destination_variants, product_id)
-                update_product_in_destination(store_url, region, dest_product_id, updated_data)
-                update_product_metafield(store_url, dest_product_id, shipping_label)
+        def run(region):
+            client, dest_product_id = targets[region]
+            with logs.bind(region=region, dest_product_id=dest_product_id):
+                return sync_region(region, client, source_client, data, dest_product_id, shipping_label)
 
-    return jsonify({"message": f"Product with ID {product_id} updates processed successfully"}), 200
+        if FANOUT_MODE == "serial":
+            results = run_serially(targets, run)
+        else:
+            results = fan_out(targets, run, REGION_TIMEOUT)
 
-def get_store_url(config):
-    store_url = f"https://{config['API_KEY']}:{config['PASSWORD']}@{config['SHOP_NAME']}.myshopify.com/admin/api/{config['API_VERSION']}"
+        for region, result in results.items():
+            metrics.REGION_RESULTS.labels(region, result["status"]).inc()
+            if result["status"] == "updated" and updated_at_seconds(data) is not None:
+                metrics.WEBHOOK_LAG.labels(region).observe(max(0, time.time() - updated_at_seconds(data)))
+            if result["status"] not in ("updated", "unchanged"):
+                payload = {"source_data": data, "shipping_label": shipping_label}
+                outbox.add(
+                    region, product_id, result["product_id"], payload, result.get("error") or result["status"],
+                    delay=result.get("retry_in"), updated_at=updated_at_seconds(data),
+                )
 
-    return store_url
+        statuses = {region: result["status"] for region, result in results.items()}
+        if any(status not in ("updated", "unchanged") for status in statuses.values()):
+            logger.warning("Sync finished with failures", extra={"results": results})
+        else:
+            logger.info("Sync finished", extra={"statuses": statuses})
+        return results
 
-def get_variants_details(store_url, product_id):
-    """Fetch variant details for a given product from a store."""
-    url = f"{store_url}/products/{product_id}.json"
-    response = requests.get(url)
+def defer_source_lookup(data, status, error, retry_in=None):
+    """Queue a sync whose source lookup failed for the outbox to run again, and report it under the source region.
+
+    Unlike a product without links, a failed lookup says nothing about where
+    the update should go, so dropping it would lose the update.
+    """
+    product_id = data['id']
+    logger.warning("Source lookup failed, queued for retry", extra={"status": status, "error": error})
+    metrics.REGION_RESULTS.labels(SOURCE_REGION, status).inc()
+    outbox.add(SOURCE_REGION, product_id, product_id, {"source_data": data}, error, delay=retry_in, updated_at=updated_at_seconds(data))
+    return {SOURCE_REGION: {"status": status, "product_id": product_id, "error": error, "retry_in": retry_in}}
+
+def prefetch_products(payloads):
+    """Warm the cache for a batch of queued webhooks with a few batched reads per store.
+
+    The links of every source product are read together, then each destination
+    store's linked products, so the syncs that follow find them in the cache.
+    """
+    source_client = clients[SOURCE_REGION]
+    payloads = [data for data in payloads if data.get('id')]
+    for data in payloads:
+        invalidate_if_newer(source_client, data['id'], data.get('updated_at'))
+
+    try:
+        with metrics.timed("prefetch", SOURCE_REGION):
+            links = get_many_product_metafields(source_client, [data['id'] for data in payloads])
+            incomplete = [
+                data['id'] for data in payloads
+                if "variants" in data and not all(payload_variants_complete(data, region_mappings[region].variant_sources) for region in SYNC_REGIONS)
+            ]
+            if incomplete:
+                get_products(source_client, incomplete)
+    except CircuitOpenError:
+        # Each sync parks itself when its own lookup is rejected
+        return
+    for region in SYNC_REGIONS:
+        dest_product_ids = [link["destination_ids"].get(region) for link in links.values() if link["destination_ids"].get(region)]
+        if not dest_product_ids:
+            continue
+        try:
+            with metrics.timed("prefetch", region):
+                get_products(clients[region], dest_product_ids)
+        except CircuitOpenError:
+            # The syncs themselves will park this store's updates
+            continue
+
+def retry_outbox_entry(entry):
+    """Re-run one failed region sync from the outbox; return None on success or an error description."""
+    payload = entry["payload"]
+    region = entry["region"]
+    if region == SOURCE_REGION:
+        # The source lookup failed: run the whole sync again; destinations that fail then get entries of their own
+        with logs.bind(outbox_id=entry["id"]):
+            result = sync_product(payload["source_data"]).get(SOURCE_REGION)
+        if result is None:
+            return None
+        if result["status"] == "parked":
+            raise Deferred(result["error"], result["retry_in"] or outbox.base_delay)
+        return f"source lookup: {result['error']}"
+    with logs.bind(product_id=entry["source_product_id"], webhook_id=payload["source_data"].get("_webhook_id"),
+                   region=region, dest_product_id=entry["dest_product_id"], outbox_id=entry["id"]):
+        result = sync_region(region, clients[region], clients[SOURCE_REGION], payload["source_data"], entry["dest_product_id"], payload["shipping_label"])
+    if result["status"] in ("updated", "unchanged"):
+        return None
+    if result["status"] in ("parked", "busy"):
+        # The store is unavailable or saturated; that shouldn't count towards dead-lettering the write
+        raise Deferred(result["error"], result.get("retry_in") or outbox.base_delay)
+    return f"product {result['product']}, metafield {result['metafield']}"
+
+def sync_region(region, client, source_client, source_data, dest_product_id, shipping_label):
+    """Sync one destination store and report what happened.
+
+    The status is "parked" when a store's circuit is open and "busy" when the
+    region had no free slot; either way nothing was written.
+    """
+    started = time.monotonic()
+    started_at = time.time()
+    slots = region_slots[region]
+    if not slots.acquire():
+        logger.warning("No free slot for region, parking update")
+        return {"status": "busy", "product_id": dest_product_id, "error": f"{region}: all {slots.slots} slots busy"}
+    metrics.REGION_SLOTS_IN_USE.labels(region).inc()
+    try:
+        product_status, metafield_status = write_region_with_retry(region, client, source_client, source_data, dest_product_id, shipping_label)
+    except CircuitOpenError as e:
+        logger.warning("Store unavailable, parking update", extra={"retry_in": round(e.retry_in, 1)})
+        return {"status": "parked", "product_id": dest_product_id, "error": str(e), "retry_in": e.retry_in}
+    finally:
+        slots.release()
+        metrics.REGION_SLOTS_IN_USE.labels(region).dec()
+
+    statuses = {product_status, metafield_status}
+    if "failed" not in statuses:
+        # Anything still pending for this product that is no newer than what was just written
+        outbox.resolve(region, dest_product_id, started_at, updated_at_seconds(source_data))
+    return {
+        "status": "failed" if "failed" in statuses else "updated" if "updated" in statuses else "unchanged",
+        "product_id": dest_product_id,
+        "product": product_status,
+        "metafield": metafield_status,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+def write_region_with_retry(region, client, source_client, source_data, dest_product_id, shipping_label):
+    """Write one destination, refreshing its mappings and trying once more if the first attempt fails."""
+    with metrics.timed("region_total", region):
+        product_status, metafield_status = write_region(region, client, source_client, source_data, dest_product_id, shipping_label)
+    if "failed" in (product_status, metafield_status):
+        # The stored mapping may be stale (variant deleted, product re-created): refresh it and retry once
+        logger.warning("Write failed, refreshing mappings and retrying")
+        forget_destination(client, source_data['id'], dest_product_id)
+        product_status, metafield_status = write_region(region, client, source_client, source_data, dest_product_id, shipping_label)
+    return product_status, metafield_status
+
+def write_region(region, client, source_client, source_data, dest_product_id, shipping_label):
+    """Build, diff and send one destination's update; return (product status, metafield status)."""
+    with metrics.timed("variant_fetch", region):
+        # Without a diff only the destination's variant IDs are needed, and the SKU index has them
+        indexed_variants = None if DIFF_SYNC else mappings.get_variants(region, dest_product_id)
+        if indexed_variants is not None:
+            destination_product = {"id": dest_product_id, "variants": indexed_variants}
+        else:
+            destination_product = get_product_details(client, dest_product_id)
+    if not destination_product:
+        # Without the destination's variant IDs a write would drop every variant change; leave it to the outbox
+        logger.warning("Destination product unavailable, not writing")
+        return "failed", "skipped"
+    with metrics.timed("payload_build", region):
+        destination_variants = destination_product.get('variants', [])
+        updated_data = prepare_update_data(region, source_client, source_data, destination_variants, source_data['id'])
+        if DIFF_SYNC:
+            updated_data = diff_update_data(updated_data, destination_product)
+
+    # The destination's metafield isn't in the product GET; the remembered product carries the label we last wrote
+    label_changed = "shipping_label" in region_mappings[region].metafields and not (
+        DIFF_SYNC and destination_product.get("shipping_label") == shipping_label
+    )
+
+    if WRITE_MODE == "graphql" and graphql_input_supported(updated_data):
+        if updated_data is None and not label_changed:
+            ok = True
+        else:
+            with metrics.timed("graphql_mutation", region):
+                ok = update_product_graphql(client, region, dest_product_id, updated_data, shipping_label if label_changed else None)
+        product_status = "unchanged" if updated_data is None else "updated" if ok else "failed"
+        metafield_status = "unchanged" if not label_changed else "updated" if ok else "failed"
+    else:
+        if updated_data is None:
+            product_status = "unchanged"
+        else:
+            with metrics.timed("put", region):
+                product_status = "updated" if update_product_in_destination(client, region, dest_product_id, updated_data) else "failed"
+        if not label_changed:
+            metafield_status = "unchanged"
+        else:
+            with metrics.timed("graphql_mutation", region):
+                metafield_status = "updated" if update_product_metafield(client, dest_product_id, shipping_label) else "failed"
+
+    remember_written_product(
+        client, dest_product_id,
+        updated_data if product_status == "updated" else None,
+        shipping_label if metafield_status == "updated" else None,
+    )
+
+    return product_status, metafield_status
+
+def forget_destination(client, source_product_id, dest_product_id):
+    """Drop everything remembered about a destination product and its link from the UK product."""
+    cache.delete(f"product:{client.region}:{dest_product_id}", f"metafields:{SOURCE_REGION}:{source_product_id}")
+    mappings.forget_product(client.region, dest_product_id)
+    mappings.forget_links(source_product_id)
+
+def run_serially(targets, run):
+    """Run run(region) for every region in turn; a region that raises doesn't stop the ones after it."""
+    results = {}
+    for region in targets:
+        try:
+            results[region] = run(region)
+        except Exception as e:
+            results[region] = {"status": "error", "product_id": targets[region][1], "error": repr(e)}
+    return results
+
+def fan_out(targets, run, timeout):
+    """Run run(region) for every region concurrently; latency is the slowest store, not the sum."""
+    # Each thread runs in a copy of the caller's context so log lines keep their correlation IDs
+    futures = {region: fanout_executor.submit(contextvars.copy_context().run, run, region) for region in targets}
+    deadline = time.monotonic() + timeout
+    results = {}
+    for region, future in futures.items():
+        try:
+            results[region] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            # The thread keeps running; the caller just stops waiting for it
+            results[region] = {"status": "timeout", "product_id": targets[region][1]}
+        except Exception as e:
+            results[region] = {"status": "error", "product_id": targets[region][1], "error": repr(e)}
+    return results
+
+def invalidate_if_newer(client, product_id, updated_at):
+    """Drop cached source data for a product when this webhook is newer than the one it was cached for."""
+    marker_key = f"updated_at:{client.region}:{product_id}"
+    seen = timestamp_seconds(cache.get(marker_key))
+    updated = timestamp_seconds(updated_at)
+    if seen is not None and updated is not None and updated <= seen:
+        return
+    # The stored links survive: destination IDs don't change under a product edit, and are refreshed when a write fails
+    cache.delete(f"product:{client.region}:{product_id}", f"metafields:{client.region}:{product_id}")
+    if updated is not None:
+        cache.set(marker_key, updated_at)
+
+def get_products(client, product_ids):
+    """Look up several products of one store: cache, then the mapping store, then batched GraphQL reads.
+
+    Returns {product_id: product} for the products found; get_product_details
+    fetches any others (e.g. with more variants than one read returns) over REST.
+    """
+    products = {}
+    missing = []
+    # Destination products mostly change when we write them, so their last known state is kept on disk for a while
+    is_destination = client.region != SOURCE_REGION
+    for product_id in product_ids:
+        cache_key = f"product:{client.region}:{product_id}"
+        product = cache.get(cache_key)
+        if product is None and is_destination:
+            product = mappings.get_product(client.region, product_id)
+            if product is not None:
+                cache.set(cache_key, product)
+        if product is None:
+            missing.append(product_id)
+        else:
+            products[product_id] = product
+
+    query = READ_QUERIES.get(client.region)
+    if missing and BATCH_READS and query and query.supported:
+        fetched = query.fetch(client, missing)
+        for product_id, product in fetched.items():
+            cache.set(f"product:{client.region}:{product_id}", product)
+        if is_destination and fetched:
+            mappings.put_many_products(client.region, list(fetched.values()))
+        products.update(fetched)
+    return products
+
+def get_product_details(client, product_id):
+    """Fetch a product with its variants from a store, or None if the request failed."""
+    product = get_products(client, [product_id]).get(product_id)
+    if product is not None:
+        return product
+
+    response = client.get(f"/products/{product_id}.json")
     if response.status_code == 200:
-        return response.json().get('product', {}).get('variants', [])
+        product = response.json().get('product', {})
+        # Keep the cache entry small; none of these fields are synced
+        for key in ('body_html', 'images', 'image', 'options'):
+            product.pop(key, None)
+        cache.set(f"product:{client.region}:{product_id}", product)
+        if client.region != SOURCE_REGION:
+            mappings.put_product(client.region, product)
+        return product
     else:
-        print(f"Failed to fetch product variants from store: {response.text}")
-        return []
+        logger.warning("Failed to fetch product", extra={
+            "store": client.region, "fetched_product_id": product_id, "status": response.status_code, "response": response.text[:500],
+        })
+        return None
+
+def get_variants_details(client, product_id):
+    """Fetch variant details for a given product from a store."""
+    product = get_product_details(client, product_id)
+    return product.get('variants', []) if product else []
+
+def same_value(a, b):
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return float(a) == float(b)
+    return a == b
+
+def diff_update_data(updated_data, destination_product):
+    """Reduce prepared update data to the fields that differ from the destination; None if nothing does."""
+    product = updated_data["product"]
+    changed = {
+        key: value for key, value in product.items()
+        if key not in ("id", "variants") and not same_value(value, destination_product.get(key))
+    }
+
+    current_variants = {variant["id"]: variant for variant in destination_product.get("variants", [])}
+    variants = []
+    variants_changed = False
+    for variant in product.get("variants", []):
+        current = current_variants.get(variant["id"], {})
+        fields = {key: value for key, value in variant.items() if key != "id" and not same_value(value, current.get(key))}
+        # A weight is meaningless without its unit, so they are always sent together
+        if "weight" in fields or "weight_unit" in fields:
+            fields.update({key: variant[key] for key in ("weight", "weight_unit") if key in variant})
+        variants_changed = variants_changed or bool(fields)
+        # Unchanged variants keep their ID in the list so the PUT never drops them
+        variants.append({"id": variant["id"], **fields})
+
+    if not changed and not variants_changed:
+        return None
+    diff = {"product": {"id": product["id"], **changed}}
+    if variants_changed:
+        diff["product"]["variants"] = variants
+    return diff
+
+def remember_written_product(client, product_id, updated_data, shipping_label=None):
+    """Fold a successful write into the remembered destination product so the next diff sees it."""
+    if updated_data is None and shipping_label is None:
+        return
+    # The next read takes the folded state from the mapping store, which still expires when the product read does
+    cache.delete(f"product:{client.region}:{product_id}")
+    product = mappings.get_product(client.region, product_id)
+    if product is None:
+        return
+    if shipping_label is not None:
+        product["shipping_label"] = shipping_label
+    written = dict(updated_data["product"]) if updated_data else {"variants": []}
+    written.pop("id", None)
+    written_variants = {variant["id"]: variant for variant in written.pop("variants", [])}
+    product.update(written)
+    for variant in product.get("variants", []):
+        variant.update({key: value for key, value in written_variants.get(variant["id"], {}).items() if key != "id"})
+    mappings.update_product(client.region, product)
     
-def prepare_update_data(region, source_store_url, source_data, destination_variants, product_id):
+def prepare_update_data(region, source_client, source_data, destination_variants, product_id):
     """Prepare data for updating destination products."""
-    general_data = ['id', 'title', 'vendor', 'product_type']
-    general_variant_data = ['weight', 'weight_unit']
-
-    match region:
-        case "US":
-            product_data = general_data
-            variant_data = general_variant_data
-        case "EU":
-            product_data = general_data + ['status']
-            variant_data = general_variant_data
-        case "DUCO":
-            product_data = general_data + ['status']
-            variant_data = general_variant_data + ['inventory_policy']
+    source_variants = None
+    if "variants" in source_data:
+        source_variants = get_source_variants(source_client, source_data, region_mappings[region].variant_sources, product_id)
+    return build_update_data(region, source_data, source_variants, destination_variants)
+
+def build_update_data(region, source_data, source_variants, destination_variants):
+    """Build the REST update body for a region from source and destination data already in hand."""
+    mapping = region_mappings[region]
 
     updated_data = {
-            "product": {key: source_data[key] for key in product_data}
+            "product": mapping.extract_product(source_data)
         }
 
     # Update specific fields for variants based on SKU
-    if "variants" in source_data:
-        variants_to_update = []
-        source_variants = get_variants_details(source_store_url, product_id)
-        for src_variant in source_variants:
-            for dest_variant in destination_variants:
-                if src_variant["sku"] == dest_variant["sku"]:
-                    updated_variant = {
-                        "id": dest_variant["id"],  # Use destination variant ID for the update
-                        **{key: src_variant[key] for key in variant_data}
-                    }
-                    variants_to_update.append(updated_variant)
+    if source_variants is not None:
+        matches, unmatched = match_variants_by_sku(source_variants, destination_variants)
+        if unmatched:
+            logger.warning("Source variants have no matching SKU", extra={"unmatched_count": len(unmatched), "unmatched": unmatched[:10]})
+
+        variants_to_update = [
+            {
+                "id": dest_variant["id"],  # Use destination variant ID for the update
+                **mapping.extract_variant(src_variant)
+            }
+            for src_variant, dest_variant in matches
+        ]
 
         if variants_to_update:
             updated_data["product"]["variants"] = variants_to_update
     
     return updated_data
 
-def get_product_metafields(store_url, product_id):
+def match_variants_by_sku(source_variants, destination_variants):
+    """Pair source and destination variants by SKU using a dict index on the destination.
+
+    Returns (matches, unmatched) where matches is a list of (source, destination)
+    pairs and unmatched lists the source SKUs with no destination variant.
+    Variants without a SKU are never matched; if the source repeats a SKU only
+    its first variant is used, and every destination variant sharing a SKU is updated.
+    """
+    destination_index = {}
+    for dest_variant in destination_variants:
+        sku = dest_variant.get("sku")
+        if sku:
+            destination_index.setdefault(sku, []).append(dest_variant)
+
+    matches = []
+    unmatched = []
+    seen = set()
+    for src_variant in source_variants:
+        sku = src_variant.get("sku")
+        if not sku:
+            unmatched.append(sku)
+            continue
+        if sku in seen:
+            logger.warning("Duplicate source SKU, using its first variant only", extra={"sku": sku})
+            continue
+        seen.add(sku)
+        dest_variants = destination_index.get(sku)
+        if not dest_variants:
+            unmatched.append(sku)
+            continue
+        if len(dest_variants) > 1:
+            logger.info("SKU appears on several destination variants, updating all of them", extra={"sku": sku, "variant_count": len(dest_variants)})
+        matches.extend((src_variant, dest_variant) for dest_variant in dest_variants)
+    return matches, unmatched
+
+def payload_variants_complete(source_data, variant_data):
+    """True if the payload's variants carry every field we sync, so they needn't be fetched."""
+    payload_variants = source_data.get("variants") or []
+    return bool(SOURCE_VARIANTS_FROM_PAYLOAD and payload_variants and all(
+        "sku" in variant and all(key in variant for key in variant_data) for variant in payload_variants
+    ))
+
+def get_source_variants(source_client, source_data, variant_data, product_id):
+    """Use the payload's variants when they carry every field we sync, otherwise fetch them."""
+    if payload_variants_complete(source_data, variant_data):
+        return source_data["variants"]
+    return get_variants_details(source_client, product_id)
+
+def get_many_product_metafields(client, product_ids):
+    """Look up the parsed metafields of several source products: cache, then the mapping store, then batched GraphQL reads."""
+    results = {}
+    missing = []
+    for product_id in product_ids:
+        cache_key = f"metafields:{client.region}:{product_id}"
+        result = cache.get(cache_key)
+        if result is None:
+            result = mappings.get_links(product_id)
+            if result is not None:
+                cache.set(cache_key, result)
+        if result is None:
+            missing.append(product_id)
+        else:
+            results[product_id] = result
+
+    if missing and BATCH_READS:
+        fetched = {
+            product_id: {
+                "destination_ids": parse_product_metafields(product["metafields"])["destination_ids"],
+                "shipping_label": product["shipping_label"],
+            }
+            for product_id, product in LINKS_QUERY.fetch(client, missing).items()
+        }
+        for product_id, result in fetched.items():
+            cache.set(f"metafields:{client.region}:{product_id}", result)
+        if fetched:
+            mappings.put_many_links(list(fetched.items()))
+        results.update(fetched)
+    return results
+
+def get_product_metafields(client, product_id):
     """Fetch metafields for a given product ID in the source store."""
-    url = f"{store_url}/products/{product_id}/metafields.json"
-    response = requests.get(url)
+    result = get_many_product_metafields(client, [product_id]).get(product_id)
+    if result is not None:
+        return result
+
+    cache_key = f"metafields:{client.region}:{product_id}"
+    response = client.get(f"/products/{product_id}/metafields.json")
 
     if response.status_code == 200:
-        metafields = response.json().get('metafields', [])
-        dest_ids = {mf['key'].split('_')[0].upper(): mf['value'] for mf in metafields if mf['namespace'] == 'custom' and mf['key'].endswith('_product_id')}
-        shipping_label = next((mf['value'] for mf in metafields if mf['namespace'] == 'shipping_information' and mf['key'] == 'shipping_label'), "")
-        return {"destination_ids": dest_ids, "shipping_label": shipping_label}
+        result = parse_product_metafields(response.json().get('metafields', []))
+        cache.set(cache_key, result)
+        mappings.put_links(product_id, result)
+        return result
     else:
-        print(f"Failed to fetch metafields: {response.json()}")
+        logger.warning("Failed to fetch metafields", extra={"status": response.status_code, "response": response.text[:500]})
         return None
 
-def update_product_metafield(store_url, product_id, shipping_label):
+def parse_product_metafields(metafields):
+    """Pull the destination product IDs and the shipping label out of a product's metafields."""
+    dest_ids = {mf['key'].split('_')[0].upper(): mf['value'] for mf in metafields if mf['namespace'] == 'custom' and mf['key'].endswith('_product_id')}
+    shipping_label = next((mf['value'] for mf in metafields if mf['namespace'] == 'shipping_information' and mf['key'] == 'shipping_label'), "")
+    return {"destination_ids": dest_ids, "shipping_label": shipping_label}
+
+def payload_shipping_label(data):
+    """The shipping label in a webhook payload, or None if its subscription doesn't include the metafield."""
+    for metafield in data.get('metafields') or []:
+        if metafield.get('namespace') == 'shipping_information' and metafield.get('key') == 'shipping_label':
+            return metafield.get('value') or ""
+    return None
+
+def update_product_metafield(client, product_id, shipping_label):
     """Update the shipping label metafield in a destination store."""
-    url = f"{store_url}/graphql.json"
     mutation = """
     mutation updateProductMetafield($input: ProductInput!) {
       productUpdate(input: $input) {
@@ -133,31 +698,200 @@ def update_product_metafield(store_url, product_id, shipping_label):
         }
     }
 
-    response = requests.post(url, json={'query': mutation, 'variables': product_input})
+    response = client.graphql(mutation, product_input)
     data = response.json()
     if 'errors' in data:
-        print("API Error:", data['errors'])
-    else:
-        errors = data.get('data', {}).get('productUpdate', {}).get('userErrors', [])
-        if errors:
-            for error in errors:
-                print("Error:", error['field'], "-", error['message'])
-        else:
-            metafield_node = data.get('data', {}).get('productUpdate', {}).get('product', {}).get('metafields', {}).get('edges', [])
-            if metafield_node:
-                updated_metafield = metafield_node[-1]['node']
-                print(f"Metafield updated for {product_id}: Namespace={updated_metafield['namespace']}, Key={updated_metafield['key']}, Value={updated_metafield['value']}")
+        logger.error("GraphQL request failed", extra={"errors": data['errors']})
+        return False
+    errors = data.get('data', {}).get('productUpdate', {}).get('userErrors', [])
+    if errors:
+        logger.error("GraphQL update rejected", extra={"user_errors": errors})
+        return False
+    metafield_node = data.get('data', {}).get('productUpdate', {}).get('product', {}).get('metafields', {}).get('edges', [])
+    if metafield_node:
+        updated_metafield = metafield_node[-1]['node']
+        logger.info("Metafield updated", extra={
+            "namespace": updated_metafield['namespace'], "key": updated_metafield['key'], "value": updated_metafield['value'],
+        })
+    return True
+
+PRODUCT_GRAPHQL_FIELDS = {
+    "title": ("title", None),
+    "vendor": ("vendor", None),
+    "product_type": ("productType", None),
+    "status": ("status", str.upper),
+}
+WEIGHT_UNITS = {"g": "GRAMS", "kg": "KILOGRAMS", "oz": "OUNCES", "lb": "POUNDS"}
+
+def graphql_input_supported(updated_data):
+    """True if every field in the REST-shaped update has a GraphQL equivalent."""
+    if updated_data is None:
+        return True
+    product = updated_data["product"]
+    variant_fields = {key for variant in product.get("variants", []) for key in variant}
+    return (
+        set(product) - {"id", "variants"} <= set(PRODUCT_GRAPHQL_FIELDS)
+        and variant_fields <= {"id", "weight", "weight_unit", "inventory_policy"}
+    )
+
+def to_graphql_variant(variant):
+    """Translate a REST-shaped variant update into a ProductVariantsBulkInput."""
+    variant_input = {"id": f"gid://shopify/ProductVariant/{variant['id']}"}
+    if "inventory_policy" in variant:
+        variant_input["inventoryPolicy"] = variant["inventory_policy"].upper()
+    if "weight" in variant:
+        variant_input["inventoryItem"] = {"measurement": {"weight": {
+            "value": float(variant["weight"]),
+            "unit": WEIGHT_UNITS.get(variant.get("weight_unit"), "KILOGRAMS"),
+        }}}
+    return variant_input
 
-def update_product_in_destination(store_url, region, product_id, updated_data):
+def to_graphql_inputs(product_id, updated_data, shipping_label):
+    """Translate a REST-shaped update into (ProductInput, [ProductVariantsBulkInput]).
+
+    Variants that only carry their ID are left out of the variant list.
+    """
+    product = updated_data["product"] if updated_data else {}
+    product_input = {"id": f'gid://shopify/Product/{product_id}'}
+    for key, value in product.items():
+        if key in PRODUCT_GRAPHQL_FIELDS:
+            name, transform = PRODUCT_GRAPHQL_FIELDS[key]
+            product_input[name] = transform(value) if transform else value
+    if shipping_label is not None:
+        product_input["metafields"] = [{"namespace": "shipping_information", "key": "shipping_label", "value": shipping_label, "type": "single_line_text_field"}]
+    variants = [to_graphql_variant(variant) for variant in product.get("variants", []) if len(variant) > 1]
+    return product_input, variants
+
+def update_product_graphql(client, region, product_id, updated_data, shipping_label):
+    """Write product fields, variant fields and the shipping label in a single GraphQL request.
+
+    updated_data may be None (only the label changed) and shipping_label may be
+    None (only product data changed). Both mutations return just their userErrors.
+    """
+    product_gid = f'gid://shopify/Product/{product_id}'
+    product_input, variants = to_graphql_inputs(product_id, updated_data, shipping_label)
+
+    variables = {"input": product_input}
+    fields = ["productUpdate(input: $input) { userErrors { field message } }"]
+    params = ["$input: ProductInput!"]
+    if variants:
+        variables.update({"productId": product_gid, "variants": variants})
+        fields.append("productVariantsBulkUpdate(productId: $productId, variants: $variants) { userErrors { field message } }")
+        params += ["$productId: ID!", "$variants: [ProductVariantsBulkInput!]!"]
+    mutation = f"mutation syncProduct({', '.join(params)}) {{ {' '.join(fields)} }}"
+
+    response = client.graphql(mutation, variables)
+    data = response.json()
+    if 'errors' in data:
+        logger.error("GraphQL request failed", extra={"errors": data['errors']})
+        return False
+    errors = [error for result in (data.get('data') or {}).values() for error in (result or {}).get('userErrors', [])]
+    if errors:
+        logger.error("GraphQL update rejected", extra={"user_errors": errors})
+        return False
+    logger.info("Product updated via GraphQL")
+    return True
+
+def update_product_in_destination(client, region, product_id, updated_data):
     """Update a product in a destination store."""
-    url = f"{store_url}/products/{product_id}.json"
-    # print(f"Updating product in {config['SHOP_NAME']}: {url}")
-    response = requests.put(url, json=updated_data)
+    response = client.put(f"/products/{product_id}.json", json=updated_data)
 
     if response.status_code == 200:
-        print(f"Product updated successfully in store {region}: {product_id}")
+        logger.info("Product updated")
+        return True
+    logger.error("Failed to update product", extra={"status": response.status_code, "response": response.text[:500]})
+    return False
+
+# Webhooks are acknowledged immediately and synced by background workers
+job_queue = make_queue()
+# Each worker claims up to PREFETCH_JOBS queued webhooks and reads their products in batches before syncing them
+worker_pool = WorkerPool(
+    job_queue, sync_product, int(os.getenv("SYNC_WORKERS", "4")),
+    prefetch=prefetch_products if BATCH_READS else None, batch_size=int(os.getenv("PREFETCH_JOBS", "10")),
+)
+# Bursts of deliveries for one product within COALESCE_WINDOW seconds are synced once; the durable
+# queue holds them itself, so a restart inside the window can't drop a delivery that was acknowledged
+coalescer = Coalescer(float(os.getenv("COALESCE_WINDOW", "2")), job_queue.put, hold=getattr(job_queue, "hold", None))
+
+def reconcile_product(data, handler=None):
+    """Pass on a product the reconciler found updated, unless this version already arrived by webhook.
+
+    The product goes to handler, or to the coalescer as a webhook would;
+    returns whether it was passed on.
+    """
+    product_id = data.get('id')
+    if not product_id or deduplicator.check(None, product_id, updated_at_seconds(data), strict=True):
+        return False
+    with logs.bind(product_id=product_id):
+        logger.info("Found update without a webhook", extra={"updated_at": data.get('updated_at')})
+    if handler:
+        handler(data)
     else:
-        print(f"Failed to update product: {response.json()}")
+        coalescer.submit(product_id, data)
+    return True
+
+# Every RECONCILE_INTERVAL seconds one process polls the source store for updates whose webhooks never arrived
+reconciler = make_reconciler(
+    clients[SOURCE_REGION], reconcile_product,
+    fields=sorted({"id", "updated_at", "variants"}.union(*(region_mappings[region].product_sources for region in SYNC_REGIONS))),
+)
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(cache.stats()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    metrics.QUEUE_DEPTH.set(job_queue.size())
+    metrics.OUTBOX_PENDING.set(outbox.size())
+    metrics.OUTBOX_DEAD.set(outbox.dead_letter_size())
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@app.route('/outbox/stats', methods=['GET'])
+def outbox_stats():
+    return jsonify({"pending": outbox.size(), "dead_letter": outbox.dead_letter_size()}), 200
+
+@app.route('/dedup/stats', methods=['GET'])
+def dedup_stats():
+    return jsonify(deduplicator.stats()), 200
+
+@app.route('/regions/health', methods=['GET'])
+def regions_health():
+    """Circuit breaker state per store and bulkhead slot usage per destination."""
+    return jsonify({
+        region: {"circuit": client.breaker.stats(), **({"slots": region_slots[region].stats()} if region in region_slots else {})}
+        for region, client in clients.items()
+    }), 200
+
+@app.route('/reconcile/stats', methods=['GET'])
+def reconcile_stats():
+    return jsonify(reconciler.state()), 200
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok"}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """200 once warm-up has connected to the stores, so traffic is only routed to a warm process."""
+    status = warmup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.route('/coalescer/stats', methods=['GET'])
+def coalescer_stats():
+    return jsonify(coalescer.stats()), 200
+
+@app.before_request
+def start_workers():
+    # Started lazily so each gunicorn worker gets its own threads after forking
+    warmup.start()
+    worker_pool.start()
+    outbox.start(retry_outbox_entry)
+    reconciler.start()
+
+warmup.mark("import")
 
 if __name__ == '__main__':
-    app.run(port=5000)
+    start_workers()
+    app.run(port=int(os.getenv("PORT", "5000")))
@@ -0,0 +1,262 @@
+"""Micro-benchmarks for the sync pipeline. Run e.g. `python bench.py sku`."""
+import argparse
+import atexit
+import base64
+import hashlib
+import hmac
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+# app.py reads store settings at import time; benchmarks never talk to Shopify
+for region in ["UK", "US", "EU", "DUCO"]:
+    os.environ.setdefault(f"{region}_SHOP_NAME", region.lower())
+    os.environ.setdefault(f"{region}_API_VERSION", "2024-07")
+    # Nothing listens on the discard port, so a stray call fails at once whatever credentials are set
+    os.environ[f"{region}_BASE_URL"] = f"http://127.0.0.1:9/{region.lower()}"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+def load_app():
+    """Import app for an in-process benchmark, from a scratch directory and with its background work off.
+
+    The first request starts the app's threads; with no stores to warm, no
+    reconcile schedule and an empty outbox they have nothing to do, and the
+    SQLite files they open are removed on exit rather than left in the checkout.
+    """
+    if os.getenv("REGION_MAPPINGS_FILE"):
+        os.environ["REGION_MAPPINGS_FILE"] = os.path.abspath(os.environ["REGION_MAPPINGS_FILE"])
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+    os.chdir(work_dir)
+    os.environ.update({"WARMUP_CONNECTIONS": "0", "RECONCILE_INTERVAL": "0"})
+    os.environ.pop("CAPTURE_DIR", None)
+    import app
+    return app
+
+
+def make_variants(count, id_offset=0):
+    return [
+        {"id": id_offset + i, "sku": f"SKU-{i}", "weight": i % 7, "weight_unit": "kg", "inventory_policy": "deny"}
+        for i in range(count)
+    ]
+
+
+def nested_loop_match(source_variants, destination_variants):
+    """The O(n*m) matching prepare_update_data used before the SKU index."""
+    return [
+        (src_variant, dest_variant)
+        for src_variant in source_variants
+        for dest_variant in destination_variants
+        if src_variant["sku"] == dest_variant["sku"]
+    ]
+
+
+def bench_sku(args):
+    match_variants_by_sku = load_app().match_variants_by_sku
+
+    print(f"{'variants':>8} {'nested loop':>14} {'sku index':>14} {'speedup':>8}")
+    for count in args.sizes:
+        source = make_variants(count)
+        destination = list(reversed(make_variants(count, id_offset=100000)))
+        number = max(1, args.repeat // count)
+        nested = min(timeit.repeat(lambda: nested_loop_match(source, destination), number=number, repeat=3)) / number
+        indexed = min(timeit.repeat(lambda: match_variants_by_sku(source, destination), number=number, repeat=3)) / number
+        print(f"{count:>8} {nested * 1e3:>11.3f} ms {indexed * 1e3:>11.3f} ms {nested / indexed:>7.1f}x")
+
+
+def write_bulk_export(path, lines, variants_per_product=3):
+    """Write a synthetic products bulk export: each product line is followed by its variants and one metafield."""
+    per_product = variants_per_product + 2
+    with open(path, "w") as fh:
+        for n in range(lines // per_product):
+            product_gid = f"gid://shopify/Product/{n}"
+            fh.write(json.dumps({
+                "id": product_gid, "legacyResourceId": str(n), "title": f"Product {n}", "vendor": "BMW",
+                "productType": "Engine", "status": "ACTIVE", "shippingLabel": {"value": "Standard"},
+            }) + "\n")
+            for v in range(variants_per_product):
+                fh.write(json.dumps({
+                    "id": f"gid://shopify/ProductVariant/{n * 10 + v}", "legacyResourceId": str(n * 10 + v),
+                    "sku": f"SKU-{n}-{v}", "inventoryPolicy": "DENY",
+                    "inventoryItem": {"measurement": {"weight": {"unit": "KILOGRAMS", "value": 1.5}}},
+                    "__parentId": product_gid,
+                }) + "\n")
+            fh.write(json.dumps({
+                "id": f"gid://shopify/Metafield/{n}", "namespace": "custom", "key": "duco_product_id",
+                "value": str(n + 1000000), "__parentId": product_gid,
+            }) + "\n")
+
+
+def max_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_jsonl(args):
+    load_app()
+    from resync import iter_products
+    from jsonl import ChunkedJSONLWriter
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "export.jsonl")
+        write_bulk_export(path, args.lines)
+        size_mb = os.path.getsize(path) / 1e6
+        baseline = max_rss_mb()
+
+        started = time.perf_counter()
+        products = 0
+        with ChunkedJSONLWriter(os.path.join(tmp, "out")) as writer:
+            for product in iter_products(path):
+                products += 1
+                writer.write({"input": {"id": product["id"], "title": product["title"]}})
+        elapsed = time.perf_counter() - started
+
+        print(f"{args.lines} lines ({size_mb:.0f} MB) -> {products} products in {elapsed:.1f}s "
+              f"({args.lines / elapsed:,.0f} lines/s), {len(writer.paths)} output chunk(s)")
+        print(f"peak RSS {max_rss_mb():.0f} MB (before streaming: {baseline:.0f} MB)")
+
+
+def make_webhook_body(size):
+    """A product webhook body of roughly size bytes, padded out with variants."""
+    product = {"id": 1, "title": "Product", "vendor": "BMW", "product_type": "Engine", "status": "active", "variants": []}
+    while len(json.dumps(product)) < size:
+        product["variants"].extend(make_variants(1, id_offset=len(product["variants"])))
+    return json.dumps(product).encode()
+
+
+def bench_hmac(args):
+    app = load_app()
+    from webhooks import orjson, verify_hmac
+
+    # Measure request handling only: nothing is queued or synced
+    app.coalescer.submit = lambda product_id, payload: None
+    client = app.app.test_client()
+    secret = "bench-secret"
+
+    print(f"{'payload':>8} {'hmac':>9} {'json':>9} {'orjson':>9} {'request':>10} {'+verify':>10}")
+    for size in args.sizes:
+        body = make_webhook_body(size)
+        signature = base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+        number = max(10, args.repeat * 1000 // len(body))
+
+        def per_call(fn):
+            return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+        verify = per_call(lambda: verify_hmac(body, signature, secret))
+        stdlib = per_call(lambda: json.loads(body))
+        fast = per_call(lambda: orjson.loads(body)) if orjson else float("nan")
+        timings = []
+        for webhook_secret in (None, secret):
+            app.WEBHOOK_SECRET = webhook_secret
+
+            def post():
+                response = client.post("/webhook/product-update", data=body, content_type="application/json",
+                                       headers={"X-Shopify-Hmac-Sha256": signature})
+                assert response.status_code == 200, response.status_code
+            timings.append(per_call(post))
+        print(f"{len(body) / 1024:>6.0f}KB {verify:>6.1f} us {stdlib:>6.1f} us {fast:>6.1f} us "
+              f"{timings[0]:>7.1f} us {timings[1]:>7.1f} us")
+    print(f"parse_body uses {'orjson' if orjson else 'json'}")
+
+
+def wait_for(url, timeout, ok=(200,)):
+    """Poll url until it answers with one of the ok statuses; return the seconds that took, or None."""
+    import requests
+
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            if requests.get(url, timeout=1).status_code in ok:
+                return time.perf_counter() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    return None
+
+
+def bench_startup(args):
+    import subprocess
+    import requests
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        # Run from a scratch directory so the app's SQLite files don't land in the checkout
+        env = {**os.environ, "PYTHONPATH": here, "RECONCILE_INTERVAL": "0"}
+        imports = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "import app"], cwd=tmp, env=env, check=True, capture_output=True)
+            imports.append(time.perf_counter() - started)
+        print(f"python -c 'import app': best {min(imports) * 1e3:.0f} ms, median {sorted(imports)[len(imports) // 2] * 1e3:.0f} ms")
+
+        shop_url = f"http://127.0.0.1:{args.shop_port}"
+        stores = {region: region.lower() for region in ["UK", "US", "EU", "DUCO"]}
+        fake = subprocess.Popen(
+            [sys.executable, os.path.join(here, "fake_shopify.py"), "--port", str(args.shop_port), "--products", "10",
+             "--latency", str(args.latency), "--source", "uk", "--destinations", "us", "eu", "duco"],
+            cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            if wait_for(f"{shop_url}/_stats", 10) is None:
+                raise SystemExit("fake_shopify.py did not start")
+            app_env = {**env, "PORT": str(args.port), **{f"{region}_BASE_URL": f"{shop_url}/{shop}" for region, shop in stores.items()}}
+            print(f"{'warm-up':>8} {'/healthz':>10} {'/readyz':>10}  stores")
+            for connections in (0, args.connections):
+                started = time.perf_counter()
+                server = subprocess.Popen(
+                    [sys.executable, os.path.join(here, "app.py")], cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    env={**app_env, "WARMUP_CONNECTIONS": str(connections)},
+                )
+                try:
+                    healthy = wait_for(f"http://127.0.0.1:{args.port}/healthz", 30)
+                    ready = wait_for(f"http://127.0.0.1:{args.port}/readyz", 60)
+                    ready = ready and time.perf_counter() - started
+                    status = requests.get(f"http://127.0.0.1:{args.port}/readyz", timeout=5).json()
+                finally:
+                    server.terminate()
+                    server.wait()
+                label = f"{connections} conn" if connections else "off"
+                print(f"{label:>8} {healthy * 1e3:>7.0f} ms {ready * 1e3:>7.0f} ms  {status['stores']} {status['startup_seconds']}")
+        finally:
+            fake.terminate()
+            fake.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    sku = commands.add_parser("sku", help="SKU matching in prepare_update_data")
+    sku.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 2000])
+    sku.add_argument("--repeat", type=int, default=20000, help="approximate variant comparisons per timing")
+    sku.set_defaults(func=bench_sku)
+
+    stream = commands.add_parser("jsonl", help="streaming bulk-export parsing on a synthetic file")
+    stream.add_argument("--lines", type=int, default=1000000)
+    stream.set_defaults(func=bench_jsonl)
+
+    signed = commands.add_parser("hmac", help="webhook signature verification and body parsing overhead")
+    signed.add_argument("--sizes", type=int, nargs="+", default=[1024, 500 * 1024], help="payload sizes in bytes")
+    signed.add_argument("--repeat", type=int, default=2000, help="approximate kilobytes processed per timing")
+    signed.set_defaults(func=bench_hmac)
+
+    start = commands.add_parser("startup", help="import time, and time until /readyz against fake_shopify.py")
+    start.add_argument("--repeat", type=int, default=5, help="cold imports to time")
+    start.add_argument("--latency", type=float, default=0.1, help="fake Shopify response time, standing in for DNS and TLS")
+    start.add_argument("--connections", type=int, default=2, help="WARMUP_CONNECTIONS for the warmed-up run")
+    start.add_argument("--port", type=int, default=5077)
+    start.add_argument("--shop-port", type=int, default=8077)
+    start.set_defaults(func=bench_startup)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from storage import SQLiteDB
+
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries also expire after ttl seconds."""
+
+    def __init__(self, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {"backend": "memory", "hits": self.hits, "misses": self.misses, "size": size}
+
+
+class SQLiteCache:
+    """Cache shared by every gunicorn worker on the host through a local SQLite file.
+
+    Values must be JSON-serialisable. Hit/miss counters are per process.
+    """
+
+    def __init__(self, path, ttl=300, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self.db = SQLiteDB(path, schema=(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)",
+        ))
+
+    def get(self, key):
+        row = self.db.execute("SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, time.time())).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        self.db.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + (ttl or self.ttl)),
+        )
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._evict()
+
+    def _evict(self):
+        self.db.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        # Drop the entries closest to expiry once the table outgrows max_entries
+        self.db.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires_at LIMIT max(0, (SELECT COUNT(*) FROM cache) - ?))",
+            (self.max_entries,),
+        )
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        self.db.execute(f"DELETE FROM cache WHERE key IN ({','.join('?' * len(keys))})", keys)
+
+    def stats(self):
+        size = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {"backend": "sqlite", "hits": self.hits, "misses": self.misses, "size": size}
+
+
+def make_cache(backend=None, path=None):
+    """Build the cache selected by CACHE_BACKEND ("memory" or "sqlite" for multi-worker setups)."""
+    backend = (backend or os.getenv("CACHE_BACKEND", "memory")).lower()
+    ttl = float(os.getenv("CACHE_TTL", "300"))
+    max_entries = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+    if backend == "memory":
+        return TTLCache(ttl, max_entries)
+    if backend == "sqlite":
+        return SQLiteCache(path or os.getenv("CACHE_PATH", "sync_cache.db"), ttl, max_entries)
+    raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
@@ -0,0 +1,217 @@
+"""Opt-in capture of webhook traffic and Shopify calls, for replay.py.
+
+With CAPTURE_DIR set, the app records two kinds of line. For every delivery
+to /webhook/product-update whose signature verified (every delivery when
+SHOPIFY_WEBHOOK_SECRET is unset) it keeps the raw body and the X-Shopify-*
+headers. For every HTTP exchange with Shopify it keeps the method, path,
+status and duration, plus the response unless CAPTURE_RESPONSES=0. Lines are
+JSON, appended to gzip files in that directory; a new file is started once
+CAPTURE_FILE_BYTES of JSON have been written, and only the newest
+CAPTURE_KEEP_FILES files are kept, apart from files another worker is still
+writing (each writer holds an flock on its open file). A background thread
+does the writing, and records are dropped rather than waited for if it falls
+behind. Calls carry the webhook_id and product_id bound in the logging
+context, so each can be traced to the delivery that caused it.
+
+Captured bodies hold product data, not credentials: outbound request headers
+(and so access tokens) are never recorded.
+"""
+import atexit
+import fcntl
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from urllib.parse import urlencode
+import logs
+
+logger = logging.getLogger(__name__)
+
+# Response headers replay needs to pace and paginate the way production did
+RESPONSE_HEADERS = ("Content-Type", "Link", "Retry-After", "X-Shopify-Shop-Api-Call-Limit")
+
+
+def request_digest(payload):
+    """A short stable hash of a JSON request body (or GraphQL query), used to pair replayed calls with recorded ones."""
+    if payload is None:
+        return None
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def call_key(path, params=None):
+    """The path plus sorted query string, the same however the parameters were passed."""
+    if not params:
+        return path
+    items = params.items() if isinstance(params, dict) else params
+    return f"{path}?{urlencode(sorted((str(key), str(value)) for key, value in items))}"
+
+
+class TrafficCapture:
+    """Appends webhook and Shopify call records to rolling gzip JSONL files in directory."""
+
+    def __init__(self, directory, file_bytes=64 * 1024 * 1024, keep=10, responses=True, queue_size=10000):
+        self.directory = directory
+        self.file_bytes = file_bytes
+        self.keep = keep
+        self.responses = responses
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._file = None
+        self._writer = None
+        self._written = 0
+        self._sequence = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def webhook(self, body, headers):
+        self._put({
+            "kind": "webhook",
+            "t": time.time(),
+            "headers": {key: value for key, value in headers.items() if key.lower().startswith("x-shopify-") or key.lower() == "content-type"},
+            # surrogateescape keeps any invalid UTF-8 byte-exact, so the HMAC still verifies on replay
+            "body": body.decode("utf-8", "surrogateescape"),
+        })
+
+    def call(self, region, method, path, kwargs, response, seconds, error):
+        context = logs.current_context()
+        payload = kwargs.get("json") if isinstance(kwargs.get("json"), dict) else {}
+        record = {
+            "kind": "call",
+            "t": time.time(),
+            "region": region,
+            "method": method,
+            "path": call_key(path, kwargs.get("params")),
+            "request": request_digest(kwargs.get("json")),
+            # GraphQL calls also record which query they ran and, for nodes() reads, the IDs they asked for
+            "query": request_digest(payload.get("query")),
+            "ids": (payload.get("variables") or {}).get("ids"),
+            "status": response.status_code if response is not None else None,
+            "seconds": round(seconds, 6),
+            "error": error,
+            "webhook_id": context.get("webhook_id"),
+            "product_id": context.get("product_id"),
+        }
+        if self.responses and response is not None:
+            record["response"] = {
+                "headers": {key: response.headers[key] for key in RESPONSE_HEADERS if key in response.headers},
+                "body": response.text,
+            }
+        self._put(record)
+
+    def _put(self, record):
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # A file inherited from the parent process belongs to its writer
+                self._file = None
+                self._writer = threading.Thread(target=self._run, name="capture", daemon=True)
+                self._writer.start()
+                self._pid = os.getpid()
+                atexit.register(self.close)
+
+    def close(self, timeout=5.0):
+        """Write what is queued and close the current file."""
+        if self._pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._writer.join(timeout)
+        self._pid = None
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while records[-1] is not None:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for record in records:
+                    if record is not None:
+                        self._write(json.dumps(record, default=str) + "\n")
+                if records[-1] is None:
+                    if self._file is not None:
+                        self._file.close()
+                        self._file = None
+                    return
+                # A sync flush leaves every complete line readable even if the process dies before close()
+                self._file.flush()
+            except Exception:
+                logger.exception("Traffic capture write failed")
+
+    def _write(self, line):
+        if self._file is None or self._written >= self.file_bytes:
+            self._rotate()
+        self._file.write(line)
+        self._written += len(line)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        self._sequence += 1
+        name = f"capture-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{os.getpid()}-{self._sequence:04d}.jsonl.gz"
+        self._file = gzip.open(os.path.join(self.directory, name), "wt", encoding="utf-8")
+        # Held until the file is closed or this process exits, so other workers' pruning leaves it alone
+        fcntl.flock(self._file.buffer.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._written = 0
+        # Names start with the UTC time they were opened, so the oldest sort first
+        for path in sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl.gz")))[:-self.keep]:
+            try:
+                with open(path, "rb") as fh:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.remove(path)
+            except BlockingIOError:
+                pass  # still being written by another worker
+            except FileNotFoundError:
+                pass  # another worker pruned it first
+
+
+def read_capture(paths):
+    """Return the records of capture files (or directories of them) in time order.
+
+    A file cut short by a crash is read up to its last complete line.
+    """
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, "capture-*.jsonl.gz"))) if os.path.isdir(path) else [path])
+    records = []
+    for path in files:
+        with gzip.open(path, "rt", encoding="utf-8") as fh:
+            try:
+                for line in fh:
+                    if line.endswith("\n"):
+                        records.append(json.loads(line))
+            except EOFError:
+                pass
+    records.sort(key=lambda record: record["t"])
+    return records
+
+
+def make_capture():
+    """Return a TrafficCapture if CAPTURE_DIR is set, else None."""
+    directory = os.getenv("CAPTURE_DIR")
+    if not directory:
+        return None
+    return TrafficCapture(
+        directory,
+        file_bytes=int(os.getenv("CAPTURE_FILE_BYTES", str(64 * 1024 * 1024))),
+        keep=int(os.getenv("CAPTURE_KEEP_FILES", "10")),
+        responses=os.getenv("CAPTURE_RESPONSES", "1") == "1",
+    )
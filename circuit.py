@@ -0,0 +1,115 @@
+"""Per-store failure isolation: circuit breakers and bulkheads.
+
+A CircuitBreaker opens after `failure_threshold` consecutive failed calls to a
+store and rejects calls with CircuitOpenError for `reset_timeout` seconds;
+then a single probe call is let through (half-open) and its outcome closes or
+re-opens the circuit. A Bulkhead caps how many syncs run against one store at
+once, so a slow store can't take every worker thread.
+"""
+import threading
+import time
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+
+class CircuitOpenError(Exception):
+    """A call was rejected without being sent; retry_in says when the circuit may let calls through."""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name}: circuit open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self.listeners = []
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may be sent now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError(self.name, self.retry_in())
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def retry_in(self):
+        """Seconds until an open circuit will let a probe through (0 if it would now)."""
+        if self.state == CLOSED or self.opened_at is None:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def _set_state(self, state):
+        self.state = state
+        for listener in self.listeners:
+            listener(self.name, state)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_in": round(self.retry_in(), 1),
+                "rejected": self.rejected,
+            }
+
+
+class Bulkhead:
+    """A bounded number of concurrent slots; acquire() gives up after `wait` seconds."""
+
+    def __init__(self, slots, wait=5.0):
+        self.slots = slots
+        self.wait = wait
+        self.in_use = 0
+        self.rejected = 0
+        self._semaphore = threading.BoundedSemaphore(slots)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self._semaphore.acquire(timeout=self.wait):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.in_use += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+        self._semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            return {"slots": self.slots, "in_use": self.in_use, "rejected": self.rejected}
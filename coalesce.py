@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+import time
+from dedup import updated_at_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """Collapse bursts of webhooks for the same product into one sync.
+
+    The first delivery for a product opens a window of `window` seconds; later
+    deliveries inside it replace the held payload (unless their updated_at is
+    older) and count as collapsed. When the window closes the surviving payload
+    is passed to emit. Each process coalesces only the deliveries it receives.
+
+    With hold (e.g. SQLiteQueue.hold) nothing is held in memory: each delivery
+    goes to hold(product_id, payload, window), which returns True if it was
+    collapsed into one already waiting, so an acknowledged webhook is never
+    only in this process when it exits.
+    """
+
+    def __init__(self, window, emit, hold=None):
+        self.window = window
+        self.emit = emit
+        self.hold = hold
+        self.received = 0
+        self.collapsed = 0
+        self.emitted = 0
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def submit(self, product_id, payload):
+        if self.window <= 0:
+            self.emit(payload)
+            with self._cond:
+                self.received += 1
+                self.emitted += 1
+            return
+        if self.hold:
+            collapsed = self.hold(product_id, payload, self.window)
+            with self._cond:
+                self.received += 1
+                if collapsed:
+                    self.collapsed += 1
+                else:
+                    self.emitted += 1
+            return
+        self._start()
+        with self._cond:
+            self.received += 1
+            held = self._pending.get(product_id)
+            if held is None:
+                self._pending[product_id] = [time.monotonic() + self.window, payload]
+                self._cond.notify()
+                return
+            self.collapsed += 1
+            if not is_older(payload, held[1]):
+                held[1] = payload
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name="coalescer", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [product_id for product_id, (deadline, _) in self._pending.items() if deadline <= now]
+                if not due:
+                    self._cond.wait(min(deadline for deadline, _ in self._pending.values()) - now)
+                    continue
+                payloads = [self._pending.pop(product_id)[1] for product_id in due]
+            for payload in payloads:
+                try:
+                    self.emit(payload)
+                except Exception:
+                    logger.exception("Failed to hand off coalesced update", extra={"product_id": payload.get('id')})
+                    continue
+                with self._cond:
+                    self.emitted += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                "window_seconds": self.window,
+                "received": self.received,
+                "collapsed": self.collapsed,
+                "emitted": self.emitted,
+                "pending": len(self._pending),
+            }
+
+
+def is_older(payload, other):
+    """True if payload's updated_at is strictly older than other's; unknown timestamps are never older."""
+    updated_at, other_updated_at = updated_at_seconds(payload), updated_at_seconds(other)
+    return updated_at is not None and other_updated_at is not None and updated_at < other_updated_at
@@ -0,0 +1,172 @@
+"""Reject webhook deliveries that were already seen or are older than what we have synced.
+
+Shopify delivers webhooks at least once and in no particular order. Each
+delivery is checked against the X-Shopify-Webhook-Id values seen recently and
+against a per-product high-water mark on the payload's updated_at, before the
+webhook is queued and before any Shopify call is made.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from storage import SQLiteDB
+
+DUPLICATE = "duplicate"
+STALE = "stale"
+
+
+def parse_timestamp(value):
+    """An ISO 8601 timestamp as Shopify writes it (possibly ending in Z) as a datetime; raises ValueError if malformed."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def timestamp_seconds(value):
+    """An ISO 8601 timestamp as epoch seconds, or None if missing or unparseable."""
+    try:
+        return parse_timestamp(value).timestamp()
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def updated_at_seconds(payload):
+    """The payload's updated_at as epoch seconds, or None if missing or unparseable."""
+    try:
+        return timestamp_seconds(payload.get("updated_at"))
+    except AttributeError:
+        return None
+
+
+class MemoryDeduplicator:
+    """Per-process dedup store holding at most max_entries webhook IDs and product marks each."""
+
+    def __init__(self, ttl=172800, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.duplicates = 0
+        self.stale = 0
+        self._webhook_ids = OrderedDict()
+        self._marks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, webhook_id, product_id, updated_at, strict=False):
+        """Record a delivery; return None if it should be processed, else DUPLICATE or STALE.
+
+        strict also counts a payload as STALE when its updated_at equals the
+        mark, i.e. that version of the product was already accepted.
+        """
+        now = time.time()
+        with self._lock:
+            if webhook_id:
+                seen_at = self._webhook_ids.get(webhook_id)
+                if seen_at is not None and seen_at >= now - self.ttl:
+                    self.duplicates += 1
+                    return DUPLICATE
+            if updated_at is not None:
+                mark = self._marks.get(product_id)
+                if mark is not None and (updated_at <= mark if strict else updated_at < mark):
+                    self.stale += 1
+                    return STALE
+                self._marks[product_id] = updated_at
+                self._marks.move_to_end(product_id)
+            if webhook_id:
+                self._webhook_ids[webhook_id] = now
+                self._webhook_ids.move_to_end(webhook_id)
+            for entries in (self._webhook_ids, self._marks):
+                while len(entries) > self.max_entries:
+                    entries.popitem(last=False)
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory", "duplicates": self.duplicates, "stale": self.stale,
+                "webhook_ids": len(self._webhook_ids), "products": len(self._marks),
+            }
+
+
+class SQLiteDeduplicator:
+    """Dedup store shared by every gunicorn worker on the host. Counters are per process."""
+
+    def __init__(self, path, ttl=172800, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.duplicates = 0
+        self.stale = 0
+        self._writes = 0
+        self.db = SQLiteDB(path, schema=(
+            "CREATE TABLE IF NOT EXISTS webhook_ids (webhook_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS webhook_ids_seen_at ON webhook_ids (seen_at)",
+            "CREATE TABLE IF NOT EXISTS product_marks (product_id TEXT PRIMARY KEY, updated_at REAL NOT NULL, seen_at REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS product_marks_seen_at ON product_marks (seen_at)",
+        ))
+
+    def check(self, webhook_id, product_id, updated_at, strict=False):
+        """Record a delivery; return None if it should be processed, else DUPLICATE or STALE.
+
+        strict also counts a payload as STALE when its updated_at equals the
+        mark, i.e. that version of the product was already accepted.
+        """
+        now = time.time()
+        conn = self.db.conn()
+        # One write transaction, so two workers can't both accept the same delivery
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if webhook_id and conn.execute(
+                "SELECT 1 FROM webhook_ids WHERE webhook_id = ? AND seen_at >= ?", (webhook_id, now - self.ttl)
+            ).fetchone():
+                conn.execute("COMMIT")
+                self.duplicates += 1
+                return DUPLICATE
+            if updated_at is not None:
+                row = conn.execute("SELECT updated_at FROM product_marks WHERE product_id = ?", (str(product_id),)).fetchone()
+                if row and (updated_at <= row[0] if strict else updated_at < row[0]):
+                    conn.execute("COMMIT")
+                    self.stale += 1
+                    return STALE
+                conn.execute(
+                    "INSERT OR REPLACE INTO product_marks (product_id, updated_at, seen_at) VALUES (?, ?, ?)",
+                    (str(product_id), updated_at, now),
+                )
+            if webhook_id:
+                conn.execute("INSERT OR REPLACE INTO webhook_ids (webhook_id, seen_at) VALUES (?, ?)", (webhook_id, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._evict()
+        return None
+
+    def _evict(self):
+        self.db.execute("DELETE FROM webhook_ids WHERE seen_at < ?", (time.time() - self.ttl,))
+        # Forget the least recently seen entries once a table outgrows max_entries
+        for table, key in (("webhook_ids", "webhook_id"), ("product_marks", "product_id")):
+            self.db.execute(
+                f"DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM {table} ORDER BY seen_at LIMIT max(0, (SELECT COUNT(*) FROM {table}) - ?))",
+                (self.max_entries,),
+            )
+
+    def stats(self):
+        return {
+            "backend": "sqlite", "duplicates": self.duplicates, "stale": self.stale,
+            "webhook_ids": self.db.execute("SELECT COUNT(*) FROM webhook_ids").fetchone()[0],
+            "products": self.db.execute("SELECT COUNT(*) FROM product_marks").fetchone()[0],
+        }
+
+
+def make_deduplicator(backend=None, path=None):
+    """Build the dedup store selected by DEDUP_BACKEND ("memory" or "sqlite" for multi-worker setups).
+
+    Webhook IDs are remembered for DEDUP_TTL seconds (Shopify retries for up to
+    48 hours); each table keeps at most DEDUP_MAX_ENTRIES rows.
+    """
+    backend = (backend or os.getenv("DEDUP_BACKEND", "memory")).lower()
+    ttl = float(os.getenv("DEDUP_TTL", "172800"))
+    max_entries = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+    if backend == "memory":
+        return MemoryDeduplicator(ttl, max_entries)
+    if backend == "sqlite":
+        return SQLiteDeduplicator(path or os.getenv("DEDUP_PATH", "dedup.db"), ttl, max_entries)
+    raise ValueError(f"Unknown DEDUP_BACKEND: {backend}")
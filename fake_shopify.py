@@ -0,0 +1,395 @@
+"""A local stand-in for the Shopify Admin API, for load tests that must not touch real stores.
+
+One server plays every store; a store's requests are prefixed with its shop
+name, so point the app at it with {REGION}_BASE_URL:
+
+    python fake_shopify.py --products 1000 --latency 0.05 --error-rate 0.01
+    UK_BASE_URL=http://127.0.0.1:8001/uk DUCO_BASE_URL=http://127.0.0.1:8001/duco python app.py
+
+The source store holds products 1..N whose custom.<region>_product_id
+metafields link them to a product with the same SKUs in each destination
+store. It serves the REST shop, products (single and paginated list),
+metafields and webhooks endpoints, GraphQL nodes(ids:) product reads and the
+productUpdate/productVariantsBulkUpdate mutations, whose writes land in the
+store like a REST PUT's so a test can read them back, with Shopify-style
+rate-limit headers (429 once the REST bucket is full, THROTTLED once the
+GraphQL bucket is), optional latency and randomly injected 5xx errors.
+GET /_stats returns call counts per store and endpoint; POST /_reset clears them.
+POST /_touch?products=1,2 bumps source products' updated_at without a webhook.
+"""
+import argparse
+import base64
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+from flask import Flask, jsonify, request
+from dedup import parse_timestamp
+
+DESTINATION_ID_OFFSET = 10_000_000
+# ProductInput field -> REST product field, as the productUpdate mutation applies them
+PRODUCT_INPUT_FIELDS = {"title": "title", "vendor": "vendor", "productType": "product_type", "status": "status"}
+WEIGHT_UNITS = {"GRAMS": "g", "KILOGRAMS": "kg", "OUNCES": "oz", "POUNDS": "lb"}
+
+
+def source_product(n, variants=3):
+    """Product n of the source store, as it appears in a products/update webhook."""
+    return {
+        "id": n,
+        "title": f"Product {n}",
+        "vendor": "BMW",
+        "product_type": "Engine",
+        "status": "active",
+        "updated_at": "2024-01-01T00:00:00+00:00",
+        "variants": [
+            {"id": n * 100 + v, "product_id": n, "sku": f"SKU-{n}-{v}", "weight": 1.5, "weight_unit": "kg", "inventory_policy": "deny"}
+            for v in range(variants)
+        ],
+    }
+
+
+def destination_product_id(index, n):
+    return (index + 1) * DESTINATION_ID_OFFSET + n
+
+
+class Bucket:
+    """Shopify's leaky bucket as the server sees it: `used` drains at `rate` per second."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.used = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, cost=1):
+        """Spend cost if it fits; return (accepted, used after the call)."""
+        with self.lock:
+            now = time.monotonic()
+            self.used = max(0.0, self.used - (now - self.updated) * self.rate)
+            self.updated = now
+            if self.used + cost > self.capacity:
+                return False, self.used
+            self.used += cost
+            return True, self.used
+
+
+class FakeShopify:
+    def __init__(self, source="uk", destinations=("duco",), products=1000, variants=3,
+                 latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=True):
+        self.source = source
+        self.destinations = list(destinations)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.calls = Counter()
+        self.webhooks = []
+        self.lock = threading.Lock()
+        self.rest_buckets = {}
+        self.graphql_buckets = {}
+        self.stores = {shop: {} for shop in [source, *self.destinations]}
+        self.labels = {shop: {} for shop in [source, *self.destinations]}
+        for n in range(1, products + 1):
+            self.add_source_product(source_product(n, variants))
+
+    def add_source_product(self, product, label="Standard"):
+        """Add a source product, linked to a copy with the same SKUs in every destination store."""
+        n = product["id"]
+        self.stores[self.source][n] = product
+        self.labels[self.source][n] = label
+        for index, shop in enumerate(self.destinations):
+            product_id = destination_product_id(index, n)
+            copy = {**product, "id": product_id, "title": f"Old product {n}"}
+            copy["variants"] = [
+                {**variant, "id": product_id * 10 + position, "product_id": product_id}
+                for position, variant in enumerate(product.get("variants", []))
+            ]
+            self.stores[shop][product_id] = copy
+
+    def metafields(self, n):
+        links = [
+            {"namespace": "custom", "key": f"{shop}_product_id", "value": str(destination_product_id(index, n))}
+            for index, shop in enumerate(self.destinations)
+        ]
+        return links + [{"namespace": "shipping_information", "key": "shipping_label", "value": self.labels[self.source][n]}]
+
+    def bucket(self, buckets, shop, capacity, rate):
+        with self.lock:
+            if shop not in buckets:
+                buckets[shop] = Bucket(capacity, rate)
+            return buckets[shop]
+
+    def record(self, shop, endpoint):
+        with self.lock:
+            self.calls[(shop, endpoint)] += 1
+
+    def stats(self):
+        with self.lock:
+            calls = dict(self.calls)
+        by_store = Counter()
+        for (shop, _), count in calls.items():
+            by_store[shop] += count
+        return {
+            "total": sum(calls.values()),
+            "by_store": dict(by_store),
+            "by_endpoint": {f"{shop} {endpoint}": count for (shop, endpoint), count in sorted(calls.items())},
+        }
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+
+def create_app(shop):
+    app = Flask(__name__)
+
+    def simulate():
+        if shop.latency or shop.jitter:
+            time.sleep(max(0.0, shop.latency + random.uniform(-shop.jitter, shop.jitter)))
+        if shop.error_rate and random.random() < shop.error_rate:
+            return jsonify({"errors": "Injected error"}), random.choice([500, 502, 503])
+        return None
+
+    def rest(store, endpoint, handler):
+        if store not in shop.stores:
+            return jsonify({"errors": "Not Found"}), 404
+        shop.record(store, endpoint)
+        failure = simulate()
+        if failure:
+            return failure
+        headers = {}
+        if shop.rate_limit:
+            bucket = shop.bucket(shop.rest_buckets, store, 40, 2.0)
+            accepted, used = bucket.take()
+            headers["X-Shopify-Shop-Api-Call-Limit"] = f"{int(used + 0.999)}/{bucket.capacity}"
+            if not accepted:
+                return jsonify({"errors": "Exceeded 2 calls per second for api client. Reduce request rates to resume uninterrupted service."}), 429, {**headers, "Retry-After": "1.0"}
+        body, status, *extra = handler()
+        return jsonify(body), status, {**headers, **(extra[0] if extra else {})}
+
+    @app.route("/<store>/admin/api/<version>/products/<int:product_id>.json", methods=["GET", "PUT"])
+    def product(store, version, product_id):
+        def handle():
+            product = shop.stores[store].get(product_id)
+            if product is None:
+                return {"errors": "Not Found"}, 404
+            if request.method == "PUT":
+                update = (request.get_json(silent=True) or {}).get("product") or {}
+                variants = {variant["id"]: variant for variant in product["variants"]}
+                for key, value in update.items():
+                    if key not in ("id", "variants"):
+                        product[key] = value
+                for variant in update.get("variants", []):
+                    if variant.get("id") not in variants:
+                        return {"errors": {"variants": [f"variant {variant.get('id')} not found"]}}, 422
+                    variants[variant["id"]].update(variant)
+            return {"product": product}, 200
+        return rest(store, f"{request.method} products/{{id}}.json", handle)
+
+    @app.route("/<store>/admin/api/<version>/products.json", methods=["GET"])
+    def products(store, version):
+        # Filters and the offset reached travel in the opaque page_info cursor, as they do on Shopify
+        if request.args.get("page_info"):
+            page = json.loads(base64.urlsafe_b64decode(request.args["page_info"]))
+        else:
+            page = {"min": request.args.get("updated_at_min"), "max": request.args.get("updated_at_max"), "offset": 0}
+        limit = min(250, int(request.args.get("limit", 50)))
+        fields = set(request.args["fields"].split(",")) if request.args.get("fields") else None
+
+        def handle():
+            matching = sorted(
+                (product for product in shop.stores[store].values()
+                 if (not page["min"] or parse_timestamp(product["updated_at"]) >= parse_timestamp(page["min"]))
+                 and (not page["max"] or parse_timestamp(product["updated_at"]) <= parse_timestamp(page["max"]))),
+                # Shopify pages the list by ID whatever the filters, not by updated_at
+                key=lambda product: product["id"],
+            )
+            batch = matching[page["offset"]:page["offset"] + limit]
+            headers = {}
+            if page["offset"] + limit < len(matching):
+                cursor = base64.urlsafe_b64encode(json.dumps({**page, "offset": page["offset"] + limit}).encode()).decode()
+                query = urlencode({"limit": limit, "page_info": cursor, **({"fields": request.args["fields"]} if fields else {})})
+                headers["Link"] = f'<{request.base_url}?{query}>; rel="next"'
+            return {"products": [{key: value for key, value in product.items() if not fields or key in fields} for product in batch]}, 200, headers
+
+        return rest(store, "GET products.json", handle)
+
+    @app.route("/<store>/admin/api/<version>/products/<int:product_id>/metafields.json", methods=["GET"])
+    def metafields(store, version, product_id):
+        def handle():
+            if store != shop.source or product_id not in shop.stores[store]:
+                return {"metafields": []}, 200
+            return {"metafields": shop.metafields(product_id)}, 200
+        return rest(store, "GET products/{id}/metafields.json", handle)
+
+    @app.route("/<store>/admin/api/<version>/shop.json", methods=["GET"])
+    def shop_info(store, version):
+        return rest(store, "GET shop.json", lambda: ({"shop": {"name": store, "myshopify_domain": f"{store}.myshopify.com"}}, 200))
+
+    @app.route("/<store>/admin/api/<version>/webhooks.json", methods=["GET", "POST"])
+    def webhooks(store, version):
+        def handle():
+            if request.method == "GET":
+                return {"webhooks": shop.webhooks}, 200
+            webhook = {"id": len(shop.webhooks) + 1, **((request.get_json(silent=True) or {}).get("webhook") or {})}
+            shop.webhooks.append(webhook)
+            return {"webhook": webhook}, 201
+        return rest(store, f"{request.method} webhooks.json", handle)
+
+    @app.route("/<store>/admin/api/<version>/graphql.json", methods=["POST"])
+    def graphql(store, version):
+        if store not in shop.stores:
+            return jsonify({"errors": "Not Found"}), 404
+        body = request.get_json(silent=True) or {}
+        query = body.get("query", "")
+        roots = [name for name in ("nodes", "productUpdate", "productVariantsBulkUpdate") if re.search(rf"\b{name}\s*\(", query)]
+        shop.record(store, f"graphql {'+'.join(roots) or 'query'}")
+        failure = simulate()
+        if failure:
+            return failure
+
+        variables = body.get("variables") or {}
+        cost = 10 * max(1, len(roots)) + 5 * len(variables.get("ids") or [])
+        bucket = shop.bucket(shop.graphql_buckets, store, 1000, 50.0)
+        accepted, used = bucket.take(cost) if shop.rate_limit else (True, 0.0)
+        extensions = {"cost": {
+            "requestedQueryCost": cost,
+            "actualQueryCost": cost if accepted else None,
+            "throttleStatus": {"maximumAvailable": 1000.0, "currentlyAvailable": bucket.capacity - used, "restoreRate": 50.0},
+        }}
+        if not accepted:
+            return jsonify({"errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}], "extensions": extensions})
+
+        data = {}
+        if "nodes" in roots:
+            data["nodes"] = [product_node(store, gid, query) for gid in variables.get("ids") or []]
+        if "productUpdate" in roots:
+            data["productUpdate"] = apply_product_update(store, variables.get("input") or {})
+        if "productVariantsBulkUpdate" in roots:
+            data["productVariantsBulkUpdate"] = apply_variants_update(store, variables.get("productId"), variables.get("variants") or [])
+        return jsonify({"data": data, "extensions": extensions})
+
+    def product_node(store, gid, query):
+        """A product as nodes() returns it, with roughly the parts the query selects."""
+        product_id = int(gid.rsplit("/", 1)[-1])
+        product = shop.stores[store].get(product_id)
+        if product is None:
+            return None
+        node = {
+            "id": gid, "legacyResourceId": str(product_id), "title": product["title"], "vendor": product["vendor"],
+            "productType": product["product_type"], "status": product["status"].upper(),
+        }
+        if "shippingLabel" in query:
+            label = shop.labels[store].get(product_id)
+            node["shippingLabel"] = {"value": label} if label is not None else None
+        if "links:" in query:
+            links = shop.metafields(product_id) if store == shop.source else []
+            node["links"] = {"nodes": [mf for mf in links if mf["namespace"] == "custom"], "pageInfo": {"hasNextPage": False}}
+        if "variants(" in query:
+            variants = []
+            for variant in product["variants"]:
+                variant_node = {"legacyResourceId": str(variant["id"]), "sku": variant["sku"]}
+                if "inventoryPolicy" in query:
+                    variant_node["inventoryPolicy"] = variant["inventory_policy"].upper()
+                if "inventoryItem" in query:
+                    unit = {rest: name for name, rest in WEIGHT_UNITS.items()}[variant["weight_unit"]]
+                    variant_node["inventoryItem"] = {"measurement": {"weight": {"unit": unit, "value": float(variant["weight"])}}}
+                variants.append(variant_node)
+            node["variants"] = {"nodes": variants, "pageInfo": {"hasNextPage": False}}
+        return node
+
+    def legacy_id(gid):
+        return int(str(gid or "").rsplit("/", 1)[-1] or 0)
+
+    def apply_product_update(store, product_input):
+        product_id = legacy_id(product_input.get("id"))
+        product = shop.stores[store].get(product_id)
+        if product is None:
+            return {"product": None, "userErrors": [{"field": ["id"], "message": "Product does not exist"}]}
+        for name, field in PRODUCT_INPUT_FIELDS.items():
+            if name in product_input:
+                product[field] = product_input[name].lower() if name == "status" else product_input[name]
+        edges = []
+        for metafield in product_input.get("metafields", []):
+            if metafield.get("key") == "shipping_label":
+                shop.labels[store][product_id] = metafield["value"]
+            edges.append({"node": {"id": f"gid://shopify/Metafield/{product_id}", **{key: metafield[key] for key in ("namespace", "key", "value")}}})
+        return {"product": {"id": product_input["id"], "metafields": {"edges": edges}}, "userErrors": []}
+
+    def apply_variants_update(store, product_gid, variant_inputs):
+        product = shop.stores[store].get(legacy_id(product_gid))
+        if product is None:
+            return {"productVariants": None, "userErrors": [{"field": ["productId"], "message": "Product does not exist"}]}
+        variants = {variant["id"]: variant for variant in product["variants"]}
+        # Validated first: Shopify applies none of the variants when any of them is rejected
+        errors = [
+            {"field": ["variants", str(position), "id"], "message": "Product variant does not exist"}
+            for position, variant_input in enumerate(variant_inputs) if legacy_id(variant_input.get("id")) not in variants
+        ]
+        if errors:
+            return {"productVariants": None, "userErrors": errors}
+        for variant_input in variant_inputs:
+            variant = variants[legacy_id(variant_input["id"])]
+            if "inventoryPolicy" in variant_input:
+                variant["inventory_policy"] = variant_input["inventoryPolicy"].lower()
+            weight = ((variant_input.get("inventoryItem") or {}).get("measurement") or {}).get("weight")
+            if weight:
+                variant["weight"] = weight["value"]
+                variant["weight_unit"] = WEIGHT_UNITS[weight["unit"]]
+        return {"productVariants": [{"id": variant_input["id"]} for variant_input in variant_inputs], "userErrors": []}
+
+    @app.route("/_touch", methods=["POST"])
+    def touch():
+        """Mark source products as updated now without sending a webhook, as if Shopify dropped it."""
+        ids = [int(n) for n in request.args.get("products", "").split(",") if n]
+        updated_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        for n in ids:
+            if n in shop.stores[shop.source]:
+                shop.stores[shop.source][n]["updated_at"] = updated_at
+                shop.stores[shop.source][n]["title"] = f"Product {n} touched {updated_at}"
+        return jsonify({"updated_at": updated_at, "products": ids})
+
+    @app.route("/_stats", methods=["GET"])
+    def stats():
+        return jsonify(shop.stats())
+
+    @app.route("/_reset", methods=["POST"])
+    def reset():
+        shop.reset()
+        return jsonify(shop.stats())
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--source", default="uk", help="shop name of the source store")
+    parser.add_argument("--destinations", nargs="+", default=["duco"], help="shop names of the destination stores")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--variants", type=int, default=3, help="variants per product")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random +/- seconds on top of --latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with a 5xx")
+    parser.add_argument("--no-rate-limit", action="store_true", help="never answer 429 or THROTTLED")
+    args = parser.parse_args(argv)
+
+    shop = FakeShopify(
+        args.source, args.destinations, args.products, args.variants,
+        args.latency, args.jitter, args.error_rate, not args.no_rate_limit,
+    )
+    import logging
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    create_app(shop).run(args.host, args.port, threaded=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""Which source fields are synced to which destination store.
+
+The mapping is declarative JSON, read from the file named by
+REGION_MAPPINGS_FILE or from the REGION_MAPPINGS environment variable, and
+falls back to DEFAULT_MAPPINGS:
+
+    {
+      "source": "UK",
+      "regions": {
+        "DUCO": {
+          "enabled": true,
+          "product": ["title", "vendor", {"name": "product_type", "transform": "strip"}],
+          "variant": ["weight", "weight_unit"],
+          "metafields": ["shipping_label"]
+        }
+      }
+    }
+
+A field is either a name or an object with "name" (the destination field),
+optional "source" (the source field, defaults to name), "transform" (one of
+TRANSFORMS, applied to non-null values) and "enabled". The product ID is always
+sent. Every listed region gets a store client from its {REGION}_* settings;
+only enabled regions are synced. The config is validated and compiled into
+extractor functions once, at startup.
+"""
+import json
+import os
+from operator import itemgetter
+
+TRANSFORMS = {
+    "strip": str.strip,
+    "lower": str.lower,
+    "upper": str.upper,
+    "str": str,
+    "int": int,
+    "float": float,
+}
+METAFIELDS = {"shipping_label"}
+
+_COMMON_PRODUCT = ["title", "vendor", "product_type"]
+_COMMON_VARIANT = ["weight", "weight_unit"]
+DEFAULT_MAPPINGS = {
+    "source": "UK",
+    "regions": {
+        "US": {"enabled": False, "product": _COMMON_PRODUCT, "variant": _COMMON_VARIANT, "metafields": ["shipping_label"]},
+        "EU": {"enabled": False, "product": _COMMON_PRODUCT + ["status"], "variant": _COMMON_VARIANT, "metafields": ["shipping_label"]},
+        "DUCO": {
+            "enabled": True,
+            "product": _COMMON_PRODUCT + ["status"],
+            "variant": _COMMON_VARIANT + ["inventory_policy"],
+            "metafields": ["shipping_label"],
+        },
+    },
+}
+
+
+class RegionMapping:
+    """The compiled field mapping for one destination store.
+
+    extract_product(source_product) and extract_variant(source_variant) return
+    the destination fields as a dict; product_sources and variant_sources name
+    the source keys a product and a variant must carry.
+    """
+
+    def __init__(self, region, enabled, product_fields, variant_fields, metafields):
+        self.region = region
+        self.enabled = enabled
+        self.product_fields = tuple(name for name, _, _ in product_fields)
+        self.variant_fields = tuple(name for name, _, _ in variant_fields)
+        self.product_sources = tuple(source for _, source, _ in product_fields)
+        self.variant_sources = tuple(source for _, source, _ in variant_fields)
+        self.metafields = frozenset(metafields)
+        self.extract_product = compile_extractor([("id", "id", None)] + product_fields)
+        self.extract_variant = compile_extractor(variant_fields)
+
+    def __repr__(self):
+        return f"RegionMapping({self.region!r}, enabled={self.enabled}, product={self.product_fields}, variant={self.variant_fields})"
+
+
+class FieldMappings:
+    """The source store and the compiled mapping of every destination store, in config order."""
+
+    def __init__(self, source, regions):
+        self.source = source
+        self.regions = regions
+
+    def __getitem__(self, region):
+        return self.regions[region]
+
+    def enabled_regions(self):
+        return [region for region, mapping in self.regions.items() if mapping.enabled]
+
+
+def compile_extractor(fields):
+    """Build a function turning a source dict into {destination name: value} for (name, source, transform) fields.
+
+    Missing source keys raise KeyError, as a required field would.
+    """
+    names = tuple(name for name, _, _ in fields)
+    if not fields:
+        return lambda item: {}
+    if any(transform for _, _, transform in fields):
+        steps = tuple(fields)
+        return lambda item: {
+            name: transform(item[source]) if transform and item[source] is not None else item[source]
+            for name, source, transform in steps
+        }
+    getter = itemgetter(*(source for _, source, _ in fields))
+    if len(fields) == 1:
+        name = names[0]
+        return lambda item: {name: getter(item)}
+    return lambda item: dict(zip(names, getter(item)))
+
+
+def _compile_fields(region, kind, specs):
+    if not isinstance(specs, list):
+        raise ValueError(f"{region}.{kind} must be a list of fields")
+    fields = []
+    for spec in specs:
+        if isinstance(spec, str):
+            spec = {"name": spec}
+        if not isinstance(spec, dict) or not isinstance(spec.get("name"), str):
+            raise ValueError(f"{region}.{kind}: each field must be a name or an object with a \"name\", got {spec!r}")
+        unknown = set(spec) - {"name", "source", "transform", "enabled"}
+        if unknown:
+            raise ValueError(f"{region}.{kind}.{spec['name']}: unknown keys {sorted(unknown)}")
+        if not spec.get("enabled", True):
+            continue
+        if spec["name"] == "id":
+            raise ValueError(f"{region}.{kind}: \"id\" is always synced and can't be mapped")
+        transform = spec.get("transform")
+        if transform is not None and transform not in TRANSFORMS:
+            raise ValueError(f"{region}.{kind}.{spec['name']}: unknown transform {transform!r} (expected one of {sorted(TRANSFORMS)})")
+        fields.append((spec["name"], spec.get("source", spec["name"]), TRANSFORMS.get(transform)))
+    if len({name for name, _, _ in fields}) != len(fields):
+        raise ValueError(f"{region}.{kind}: duplicate field names")
+    return fields
+
+
+def compile_mappings(config):
+    """Validate a mapping config and compile it; raises ValueError describing the first problem found."""
+    if not isinstance(config, dict) or not isinstance(config.get("regions"), dict) or not config["regions"]:
+        raise ValueError("Region mappings need a non-empty \"regions\" object")
+    source = config.get("source", "UK")
+    regions = {}
+    for region, spec in config["regions"].items():
+        if region == source:
+            raise ValueError(f"{region} is the source store and can't also be a destination")
+        if not isinstance(spec, dict):
+            raise ValueError(f"{region}: expected an object, got {spec!r}")
+        unknown = set(spec) - {"enabled", "product", "variant", "metafields"}
+        if unknown:
+            raise ValueError(f"{region}: unknown keys {sorted(unknown)}")
+        metafields = spec.get("metafields", [])
+        if not isinstance(metafields, list) or set(metafields) - METAFIELDS:
+            raise ValueError(f"{region}.metafields: expected a list of {sorted(METAFIELDS)}, got {metafields!r}")
+        regions[region] = RegionMapping(
+            region,
+            bool(spec.get("enabled", True)),
+            _compile_fields(region, "product", spec.get("product", [])),
+            _compile_fields(region, "variant", spec.get("variant", [])),
+            metafields,
+        )
+    return FieldMappings(source, regions)
+
+
+def load_mappings(path=None):
+    """Load and compile the mappings from REGION_MAPPINGS_FILE, REGION_MAPPINGS or the defaults."""
+    path = path or os.getenv("REGION_MAPPINGS_FILE")
+    if path:
+        with open(path) as fh:
+            config = json.load(fh)
+    elif os.getenv("REGION_MAPPINGS"):
+        config = json.loads(os.getenv("REGION_MAPPINGS"))
+    else:
+        config = DEFAULT_MAPPINGS
+    return compile_mappings(config)
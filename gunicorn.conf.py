@@ -0,0 +1,8 @@
+# Read by gunicorn from the working directory, e.g. `gunicorn app:app`.
+
+
+def post_worker_init(worker):
+    # Warm up and start the background threads as soon as a worker has loaded the app,
+    # instead of on its first request, so it is ready by the time it is routed webhooks
+    from app import start_workers
+    start_workers()
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from coalesce import is_older
+from storage import SQLiteDB
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryQueue:
+    """In-process FIFO queue. Pending jobs are lost when the process exits."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, payload):
+        job_id = uuid.uuid4().hex
+        self._queue.put((job_id, payload))
+        return job_id
+
+    def get(self, timeout=None):
+        """Return the next (job_id, payload) pair, or None if nothing arrived within timeout."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def renew(self, job_id):
+        return True
+
+    def ack(self, job_id):
+        pass
+
+    def size(self):
+        return self._queue.qsize()
+
+
+class SQLiteQueue:
+    """Durable queue backed by a local SQLite file, shared by every process on the host.
+
+    Jobs are claimed rather than deleted on get() and removed on ack(), so a job
+    whose worker died mid-sync is handed out again once its claim goes stale.
+    A worker holding several claimed jobs calls renew() as it starts each one,
+    so a job waiting behind slow ones isn't handed out twice.
+    hold() queues a job that only becomes claimable after a delay and collapses
+    later jobs with the same key into it, so coalescing survives a restart.
+    """
+
+    def __init__(self, path, claim_timeout=300, poll_interval=0.2):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self.poll_interval = poll_interval
+        # job_id -> claimed_at of the claims this instance holds
+        self._claims = {}
+        self.db = SQLiteDB(path, schema=(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed_at REAL,
+                available_at REAL,
+                coalesce_key TEXT
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS jobs_enqueued_at ON jobs (enqueued_at)",
+        ))
+        self.db.add_columns("jobs", {"available_at": "REAL", "coalesce_key": "TEXT"})
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_coalesce_key ON jobs (coalesce_key)")
+
+    def put(self, payload):
+        job_id = uuid.uuid4().hex
+        self.db.execute(
+            "INSERT INTO jobs (id, payload, enqueued_at) VALUES (?, ?, ?)",
+            (job_id, json.dumps(payload), time.time()),
+        )
+        return job_id
+
+    def hold(self, key, payload, delay):
+        """Queue payload, claimable after delay seconds, unless an unclaimed job with the same key is waiting.
+
+        A waiting job takes payload instead of its own unless payload's
+        updated_at is older. Returns True if payload went into a waiting job.
+        """
+        now = time.time()
+        conn = self.db.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id, payload FROM jobs WHERE coalesce_key = ? AND claimed_at IS NULL", (str(key),)
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    "INSERT INTO jobs (id, payload, enqueued_at, available_at, coalesce_key) VALUES (?, ?, ?, ?, ?)",
+                    (uuid.uuid4().hex, json.dumps(payload), now, now + delay, str(key)),
+                )
+            elif not is_older(payload, json.loads(row[1])):
+                conn.execute("UPDATE jobs SET payload = ? WHERE id = ?", (json.dumps(payload), row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row is not None
+
+    def _claim(self):
+        now = time.time()
+        row = self.db.execute(
+            """
+            UPDATE jobs SET claimed_at = ?
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE (claimed_at IS NULL OR claimed_at < ?) AND (available_at IS NULL OR available_at <= ?)
+                ORDER BY enqueued_at LIMIT 1
+            )
+            RETURNING id, payload
+            """,
+            (now, now - self.claim_timeout, now),
+        ).fetchone()
+        if row:
+            self._claims[row[0]] = now
+            return row[0], json.loads(row[1])
+        return None
+
+    def get(self, timeout=None):
+        """Claim the next (job_id, payload) pair, polling until timeout expires."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self._claim()
+            if job or (deadline is not None and time.monotonic() >= deadline):
+                return job
+            time.sleep(self.poll_interval)
+
+    def renew(self, job_id):
+        """Restart the claim on a job; False if it went stale and another worker has claimed it since."""
+        now = time.time()
+        renewed = self.db.execute(
+            "UPDATE jobs SET claimed_at = ? WHERE id = ? AND claimed_at = ?", (now, job_id, self._claims.get(job_id)),
+        ).rowcount
+        if renewed:
+            self._claims[job_id] = now
+        else:
+            self._claims.pop(job_id, None)
+        return bool(renewed)
+
+    def ack(self, job_id):
+        self._claims.pop(job_id, None)
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def size(self):
+        return self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+def make_queue(backend=None, path=None):
+    """Build the queue backend selected by QUEUE_BACKEND ("memory" or "sqlite")."""
+    backend = (backend or os.getenv("QUEUE_BACKEND", "memory")).lower()
+    if backend == "memory":
+        return MemoryQueue()
+    if backend == "sqlite":
+        return SQLiteQueue(path or os.getenv("QUEUE_PATH", "sync_queue.db"))
+    raise ValueError(f"Unknown QUEUE_BACKEND: {backend}")
+
+
+class WorkerPool:
+    """Daemon threads that drain a queue and hand each payload to handler.
+
+    With a prefetch function, each worker claims up to batch_size jobs that are
+    already waiting and calls prefetch(payloads) once before handling them.
+    """
+
+    def __init__(self, job_queue, handler, count, prefetch=None, batch_size=1):
+        self.job_queue = job_queue
+        self.handler = handler
+        self.count = count
+        self.prefetch = prefetch
+        self.batch_size = batch_size if prefetch else 1
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """Start the workers once per process; safe to call on every request."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = [
+                threading.Thread(target=self._run, name=f"sync-worker-{i}", daemon=True)
+                for i in range(self.count)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            job = self.job_queue.get(timeout=1)
+            if job is None:
+                continue
+            jobs = [job]
+            while len(jobs) < self.batch_size:
+                job = self.job_queue.get(timeout=0)
+                if job is None:
+                    break
+                jobs.append(job)
+            if self.prefetch:
+                try:
+                    self.prefetch([payload for _, payload in jobs])
+                except Exception:
+                    # Only a warm-up: each job still fetches whatever it is missing
+                    logger.exception("Prefetch failed", extra={"jobs": len(jobs)})
+            for job_id, payload in jobs:
+                if not self.job_queue.renew(job_id):
+                    logger.warning("Job was handed to another worker while waiting in the batch, skipping it",
+                                   extra={"job_id": job_id, "product_id": payload.get("id")})
+                    continue
+                try:
+                    self.handler(payload)
+                except Exception:
+                    logger.exception("Sync job failed", extra={"job_id": job_id, "product_id": payload.get("id")})
+                finally:
+                    self.job_queue.ack(job_id)
@@ -0,0 +1,157 @@
+"""Replay bursts of products/update webhooks against the app and report how it copes.
+
+Run against fake_shopify.py so no real store is touched:
+
+    python fake_shopify.py --products 1000 --latency 0.05 &
+    UK_BASE_URL=http://127.0.0.1:8001/uk DUCO_BASE_URL=http://127.0.0.1:8001/duco python app.py &
+    python loadgen.py --webhooks 2000 --burst 200 --concurrency 20
+
+Webhook bodies are the fake source store's products with a fresh updated_at
+(and, with --secret, a valid X-Shopify-Hmac-Sha256). Reports webhook response
+latency (p50/p99) and throughput, then waits for the background sync to go
+quiet and reports the Shopify calls the fake server saw per accepted webhook.
+"""
+import argparse
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import requests
+from fake_shopify import source_product
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float("nan")
+
+
+def make_webhook(n, variants, sequence, secret=None):
+    """Return (body, headers) for a products/update delivery of source product n."""
+    product = source_product(n, variants)
+    product["title"] = f"Product {n} v{sequence}"
+    started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    product["updated_at"] = (started + timedelta(seconds=sequence)).isoformat()
+    body = json.dumps(product).encode()
+    headers = {
+        "Content-Type": "application/json",
+        "X-Shopify-Topic": "products/update",
+        "X-Shopify-Webhook-Id": str(uuid.uuid4()),
+    }
+    if secret:
+        headers["X-Shopify-Hmac-Sha256"] = base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+    return body, headers
+
+
+def fake_stats(shop_url):
+    return requests.get(f"{shop_url}/_stats", timeout=10).json()
+
+
+def wait_until_quiet(shop_url, quiet=2.0, timeout=300.0):
+    """Wait until the fake server has seen no new calls for `quiet` seconds; return the final stats."""
+    deadline = time.monotonic() + timeout
+    last = fake_stats(shop_url)
+    last_change = time.monotonic()
+    while time.monotonic() < deadline:
+        time.sleep(0.25)
+        stats = fake_stats(shop_url)
+        if stats["total"] != last["total"]:
+            last, last_change = stats, time.monotonic()
+        elif time.monotonic() - last_change >= quiet:
+            return stats
+    return last
+
+
+def run(args):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    requests.post(f"{args.shop_url}/_reset", timeout=10)
+
+    pool = range(1, (args.hot_products or args.products) + 1)
+    deliveries = []
+    for sequence in range(args.webhooks):
+        if deliveries and random.random() < args.redeliver:
+            # Shopify retries resend the same body and webhook ID
+            deliveries.append(random.choice(deliveries))
+            continue
+        deliveries.append(make_webhook(random.choice(pool), args.variants, sequence, args.secret))
+
+    def send(delivery):
+        body, headers = delivery
+        started = time.perf_counter()
+        try:
+            response = session.post(args.url, data=body, headers=headers, timeout=30)
+            status = response.status_code
+            message = response.json().get("message", "") if response.headers.get("Content-Type", "").startswith("application/json") else ""
+        except requests.RequestException as e:
+            status, message = type(e).__name__, ""
+        return time.perf_counter() - started, status, message
+
+    latencies = []
+    statuses = Counter()
+    queued = 0
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as executor:
+        for offset in range(0, len(deliveries), args.burst):
+            burst_started = time.perf_counter()
+            for elapsed, status, message in executor.map(send, deliveries[offset:offset + args.burst]):
+                latencies.append(elapsed)
+                statuses[status] += 1
+                queued += status == 200 and "queued" in message
+            if args.interval:
+                time.sleep(max(0.0, args.interval - (time.perf_counter() - burst_started)))
+    sent_in = time.perf_counter() - started
+
+    stats = wait_until_quiet(args.shop_url, args.quiet, args.timeout)
+    synced_in = time.perf_counter() - started - args.quiet
+
+    report = {
+        "webhooks": len(deliveries),
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "queued": queued,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50) * 1e3, 2),
+            "p99": round(percentile(latencies, 0.99) * 1e3, 2),
+            "max": round(max(latencies) * 1e3, 2),
+        },
+        "webhooks_per_second": round(len(deliveries) / sent_in, 1),
+        "sync_seconds": round(synced_in, 2),
+        "shopify_calls": stats["total"],
+        "shopify_calls_per_webhook": round(stats["total"] / len(deliveries), 2),
+        "shopify_calls_per_queued_webhook": round(stats["total"] / queued, 2) if queued else None,
+        "shopify_calls_by_endpoint": stats["by_endpoint"],
+    }
+    print(json.dumps(report, indent=2))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:5000/webhook/product-update")
+    parser.add_argument("--shop-url", default="http://127.0.0.1:8001", help="fake_shopify.py server")
+    parser.add_argument("--webhooks", type=int, default=1000)
+    parser.add_argument("--burst", type=int, default=100, help="webhooks sent together before waiting for --interval")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds from the start of one burst to the next")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--products", type=int, default=1000, help="must match fake_shopify.py --products")
+    parser.add_argument("--variants", type=int, default=3, help="must match fake_shopify.py --variants")
+    parser.add_argument("--hot-products", type=int, help="only update products 1..N, to exercise coalescing")
+    parser.add_argument("--redeliver", type=float, default=0.0, help="share of deliveries that repeat an earlier one")
+    parser.add_argument("--secret", help="sign deliveries with this webhook secret")
+    parser.add_argument("--quiet", type=float, default=3.0, help="seconds without Shopify calls that count as done")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args(argv)
+    run(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+import json
+import os
+import time
+from storage import SQLiteDB
+
+
+class MappingStore:
+    """Persistent index of UK products to their destination products and variants.
+
+    links: UK product ID -> {"destination_ids": {region: product ID}, "shipping_label": ...},
+    i.e. the parsed result of the UK metafields call.
+    products: the last known state of each destination product (the fields the
+    pipeline syncs plus its variants). Links and products are only returned for
+    max_age seconds after they were read from Shopify, since either can be
+    edited there; the per-SKU variant ID table alongside is kept until a write
+    to the product fails, as variant IDs don't change under an edit.
+    Entries are filled lazily by the pipeline or in bulk by `resync.py --backfill`.
+    """
+
+    def __init__(self, path, max_age=3600):
+        self.max_age = max_age
+        self.db = SQLiteDB(path, schema=(
+            """
+            CREATE TABLE IF NOT EXISTS links (
+                source_product_id TEXT PRIMARY KEY,
+                destination_ids TEXT NOT NULL,
+                shipping_label TEXT NOT NULL,
+                refreshed_at REAL NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                region TEXT NOT NULL,
+                product_id TEXT NOT NULL,
+                product TEXT NOT NULL,
+                refreshed_at REAL NOT NULL,
+                PRIMARY KEY (region, product_id)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS variants (
+                region TEXT NOT NULL,
+                product_id TEXT NOT NULL,
+                sku TEXT NOT NULL,
+                variant_id TEXT NOT NULL,
+                PRIMARY KEY (region, product_id, variant_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS variants_sku ON variants (region, sku)",
+        ))
+
+    def get_links(self, source_product_id):
+        """Return the stored metafields result, or None if unknown or older than max_age."""
+        row = self.db.execute(
+            "SELECT destination_ids, shipping_label FROM links WHERE source_product_id = ? AND refreshed_at >= ?",
+            (str(source_product_id), time.time() - self.max_age),
+        ).fetchone()
+        if row is None:
+            return None
+        return {"destination_ids": json.loads(row[0]), "shipping_label": row[1]}
+
+    def put_links(self, source_product_id, metafields_data):
+        self.put_many_links([(source_product_id, metafields_data)])
+
+    def put_many_links(self, items):
+        now = time.time()
+        self._write(
+            "INSERT OR REPLACE INTO links (source_product_id, destination_ids, shipping_label, refreshed_at) VALUES (?, ?, ?, ?)",
+            [(str(product_id), json.dumps(data["destination_ids"]), data["shipping_label"] or "", now) for product_id, data in items],
+        )
+
+    def forget_links(self, source_product_id):
+        self.db.execute("DELETE FROM links WHERE source_product_id = ?", (str(source_product_id),))
+
+    def get_product(self, region, product_id):
+        """Return the stored destination product, or None if unknown or older than max_age."""
+        row = self.db.execute(
+            "SELECT product FROM products WHERE region = ? AND product_id = ? AND refreshed_at >= ?",
+            (region, str(product_id), time.time() - self.max_age),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_product(self, region, product):
+        self.put_many_products(region, [product])
+
+    def put_many_products(self, region, products):
+        now = time.time()
+        conn = self.db.conn()
+        conn.execute("BEGIN")
+        try:
+            for product in products:
+                product_id = str(product["id"])
+                conn.execute(
+                    "INSERT OR REPLACE INTO products (region, product_id, product, refreshed_at) VALUES (?, ?, ?, ?)",
+                    (region, product_id, json.dumps(product), now),
+                )
+                conn.execute("DELETE FROM variants WHERE region = ? AND product_id = ?", (region, product_id))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO variants (region, product_id, sku, variant_id) VALUES (?, ?, ?, ?)",
+                    [(region, product_id, variant["sku"], str(variant["id"])) for variant in product.get("variants", []) if variant.get("sku")],
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def update_product(self, region, product):
+        """Replace a stored product's state but not the time it was read, so it still expires max_age after that."""
+        self.db.execute(
+            "UPDATE products SET product = ? WHERE region = ? AND product_id = ?", (json.dumps(product), region, str(product["id"]))
+        )
+
+    def forget_product(self, region, product_id):
+        conn = self.db.conn()
+        conn.execute("DELETE FROM products WHERE region = ? AND product_id = ?", (region, str(product_id)))
+        conn.execute("DELETE FROM variants WHERE region = ? AND product_id = ?", (region, str(product_id)))
+
+    def get_variants(self, region, product_id):
+        """Return a destination product's variants as [{"id": ..., "sku": ...}], or None if none are indexed."""
+        rows = self.db.execute(
+            "SELECT variant_id, sku FROM variants WHERE region = ? AND product_id = ? ORDER BY rowid", (region, str(product_id))
+        ).fetchall()
+        return [{"id": int(variant_id), "sku": sku} for variant_id, sku in rows] or None
+
+    def _write(self, sql, rows):
+        conn = self.db.conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(sql, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def make_mapping_store(path=None):
+    """Open the mapping store at MAPPINGS_PATH; links and products older than MAPPINGS_MAX_AGE seconds are re-fetched."""
+    return MappingStore(
+        path or os.getenv("MAPPINGS_PATH", "mappings.db"),
+        float(os.getenv("MAPPINGS_MAX_AGE", "3600")),
+    )
@@ -0,0 +1,63 @@
+"""Prometheus metrics for the sync pipeline.
+
+With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty
+writable directory so /metrics aggregates every worker's samples.
+"""
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest, multiprocess,
+)
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+
+WEBHOOKS = Counter("sync_webhooks_total", "Webhook deliveries by outcome", ["outcome"])
+STAGE_SECONDS = Histogram(
+    "sync_stage_seconds", "Time spent in each pipeline stage", ["stage", "region"], buckets=STAGE_BUCKETS,
+)
+REGION_RESULTS = Counter("sync_region_results_total", "Per-region sync outcomes", ["region", "status"])
+WEBHOOK_LAG = Histogram(
+    "sync_webhook_to_destination_seconds", "From the product's updated_at to its destination write finishing",
+    ["region"], buckets=LAG_BUCKETS,
+)
+SHOPIFY_RESPONSES = Counter("shopify_responses_total", "Shopify API responses", ["region", "api", "status"])
+SHOPIFY_SECONDS = Histogram(
+    "shopify_request_seconds", "Shopify API call latency", ["region", "api"], buckets=STAGE_BUCKETS,
+)
+RATE_LIMIT_AVAILABLE = Gauge(
+    "shopify_rate_limit_available_ratio", "Share of the store's rate-limit bucket still available",
+    ["region", "api"], multiprocess_mode="livemin",
+)
+CIRCUIT_STATE = Gauge(
+    "shopify_circuit_state", "Store circuit breaker state: 0 closed, 1 half-open, 2 open", ["region"], multiprocess_mode="livemax",
+)
+REGION_SLOTS_IN_USE = Gauge(
+    "sync_region_slots_in_use", "Region syncs currently holding a bulkhead slot", ["region"], multiprocess_mode="livesum",
+)
+RECONCILED = Counter("sync_reconciled_products_total", "Updated products found by the polling reconciler", ["outcome"])
+STARTUP_SECONDS = Gauge(
+    "sync_startup_seconds", "Seconds from process start to the end of each startup phase", ["phase"], multiprocess_mode="livemax",
+)
+QUEUE_DEPTH = Gauge("sync_queue_depth", "Jobs waiting in the sync queue", multiprocess_mode="liveall")
+OUTBOX_PENDING = Gauge("sync_outbox_pending", "Failed writes waiting for retry", multiprocess_mode="livemax")
+OUTBOX_DEAD = Gauge("sync_outbox_dead_letters", "Failed writes that exhausted their retries", multiprocess_mode="livemax")
+
+
+@contextmanager
+def timed(stage, region):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage, region).observe(time.perf_counter() - started)
+
+
+def render():
+    """Return (body, content type) for a /metrics response."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
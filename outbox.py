@@ -0,0 +1,325 @@
+"""Durable outbox of destination writes that failed and must be retried.
+
+Failed per-region syncs are stored with an idempotency key and retried with
+exponential backoff by a background thread; entries that keep failing move to
+a dead-letter table. Inspect and replay them from the command line:
+
+    python outbox.py list [--dead]
+    python outbox.py replay [ID ...]   # move dead letters back to the outbox (all if no IDs)
+    python outbox.py drain             # process every due entry now, in this process
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from storage import SQLiteDB
+
+logger = logging.getLogger(__name__)
+
+class Deferred(Exception):
+    """Raised by a retry handler to push an entry back by `delay` seconds without counting an attempt."""
+
+    def __init__(self, reason, delay):
+        super().__init__(reason)
+        self.delay = delay
+
+
+COLUMNS = "id, idempotency_key, region, source_product_id, dest_product_id, payload, attempts, last_error, created_at, updated_at"
+
+
+class Outbox:
+    """Pending per-region writes in SQLite, shared by every process on the host.
+
+    Each entry carries the updated_at (epoch seconds) of the source version it
+    would write, when known, so a write only ever replaces or resolves entries
+    for versions no newer than its own.
+    """
+
+    def __init__(self, path, max_attempts=8, base_delay=30.0, max_delay=3600.0, claim_timeout=300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.claim_timeout = claim_timeout
+        self._pid = None
+        self._lock = threading.Lock()
+        table = """
+            CREATE TABLE IF NOT EXISTS {} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                region TEXT NOT NULL,
+                source_product_id TEXT NOT NULL,
+                dest_product_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL,
+                {}
+            )
+        """
+        self.db = SQLiteDB(path, schema=(
+            table.format("outbox", "next_attempt_at REAL NOT NULL, claimed_at REAL"),
+            table.format("dead_letter", "failed_at REAL NOT NULL"),
+            "CREATE INDEX IF NOT EXISTS outbox_next_attempt_at ON outbox (next_attempt_at)",
+        ))
+        for name in ("outbox", "dead_letter"):
+            self.db.add_columns(name, {"updated_at": "REAL"})
+
+    @staticmethod
+    def idempotency_key(region, dest_product_id, payload):
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:32]
+        return f"{region}:{dest_product_id}:{digest}"
+
+    def add(self, region, source_product_id, dest_product_id, payload, error, delay=None, updated_at=None):
+        """Queue a failed write for retry after delay (default base_delay) seconds.
+
+        The write replaces pending ones for the same destination product unless
+        one of them is for a newer updated_at, in which case it is dropped and
+        None returned instead of its idempotency key.
+        """
+        key = self.idempotency_key(region, dest_product_id, payload)
+        now = time.time()
+        conn = self.db.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if updated_at is not None and conn.execute(
+                "SELECT 1 FROM outbox WHERE region = ? AND dest_product_id = ? AND updated_at > ?",
+                (region, str(dest_product_id), updated_at),
+            ).fetchone():
+                conn.execute("COMMIT")
+                return None
+            # Replaying an older payload after a newer one would revert the destination
+            conn.execute(
+                "DELETE FROM outbox WHERE region = ? AND dest_product_id = ? AND idempotency_key != ?",
+                (region, str(dest_product_id), key),
+            )
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO outbox
+                    (idempotency_key, region, source_product_id, dest_product_id, payload, last_error, created_at, updated_at,
+                     next_attempt_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (key, region, str(source_product_id), str(dest_product_id), json.dumps(payload), error, now, updated_at,
+                 now + (self.base_delay if delay is None else delay)),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return key
+
+    def resolve(self, region, dest_product_id, started_at, updated_at=None):
+        """Drop the pending retries and dead letters that a successful write to a destination product made obsolete.
+
+        Those are entries for a version no newer than the written updated_at.
+        Where either version is unknown, only entries created before the write
+        started (started_at) go, so a newer sync that failed while this write
+        was in flight keeps its entry.
+        """
+        for table in ("outbox", "dead_letter"):
+            self.db.execute(
+                f"""
+                DELETE FROM {table} WHERE region = ? AND dest_product_id = ? AND CASE
+                    WHEN updated_at IS NOT NULL AND ? IS NOT NULL THEN updated_at <= ?
+                    ELSE created_at < ?
+                END
+                """,
+                (region, str(dest_product_id), updated_at, updated_at, started_at),
+            )
+
+    def claim_due(self, limit=20):
+        """Claim up to limit entries whose retry time has come."""
+        now = time.time()
+        rows = self.db.execute(
+            f"""
+            UPDATE outbox SET claimed_at = ?
+            WHERE id IN (
+                SELECT id FROM outbox
+                WHERE next_attempt_at <= ? AND (claimed_at IS NULL OR claimed_at < ?)
+                ORDER BY next_attempt_at LIMIT ?
+            )
+            RETURNING {COLUMNS}
+            """,
+            (now, now, now - self.claim_timeout, limit),
+        ).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def succeeded(self, entry):
+        self.db.execute("DELETE FROM outbox WHERE id = ?", (entry["id"],))
+
+    def failed(self, entry, error):
+        """Schedule the next attempt with exponential backoff, or dead-letter the entry."""
+        attempts = entry["attempts"] + 1
+        if attempts >= self.max_attempts:
+            conn = self.db.conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    f"""
+                    INSERT OR REPLACE INTO dead_letter ({COLUMNS}, failed_at)
+                    SELECT {COLUMNS.replace('attempts, last_error', '?, ?')}, ? FROM outbox WHERE id = ?
+                    """,
+                    (attempts, error, time.time(), entry["id"]),
+                )
+                conn.execute("DELETE FROM outbox WHERE id = ?", (entry["id"],))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            logger.error("Outbox entry dead-lettered", extra={
+                "idempotency_key": entry['idempotency_key'], "attempts": attempts, "error": error,
+            })
+            return
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        self.db.execute(
+            "UPDATE outbox SET attempts = ?, last_error = ?, next_attempt_at = ?, claimed_at = NULL WHERE id = ?",
+            (attempts, error, time.time() + delay, entry["id"]),
+        )
+
+    def defer(self, entry, delay, reason):
+        """Retry the entry after delay seconds without counting an attempt (the store was unavailable, not the write)."""
+        self.db.execute(
+            "UPDATE outbox SET last_error = ?, next_attempt_at = ?, claimed_at = NULL WHERE id = ?",
+            (reason, time.time() + delay, entry["id"]),
+        )
+
+    def wake(self, region):
+        """Make every unclaimed entry for a region due now, e.g. once its store is reachable again."""
+        now = time.time()
+        self.db.execute(
+            "UPDATE outbox SET next_attempt_at = ? WHERE region = ? AND claimed_at IS NULL AND next_attempt_at > ?",
+            (now, region, now),
+        )
+
+    def replay(self, ids=None):
+        """Move dead letters (all, or the given IDs) back into the outbox for immediate retry."""
+        where, params = ("", ()) if not ids else (f"WHERE id IN ({','.join('?' * len(ids))})", tuple(ids))
+        conn = self.db.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(f"SELECT {COLUMNS} FROM dead_letter {where}", params).fetchall()
+            for row in rows:
+                entry = self._entry(row)
+                newer = conn.execute(
+                    "SELECT 1 FROM outbox WHERE region = ? AND dest_product_id = ? AND created_at > ?",
+                    (entry["region"], entry["dest_product_id"], entry["created_at"]),
+                ).fetchone()
+                if newer:
+                    # A newer write for this product is already pending; the dead letter is obsolete
+                    continue
+                conn.execute("DELETE FROM outbox WHERE region = ? AND dest_product_id = ?", (entry["region"], entry["dest_product_id"]))
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO outbox
+                        (idempotency_key, region, source_product_id, dest_product_id, payload, last_error, created_at, updated_at,
+                         next_attempt_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (entry["idempotency_key"], entry["region"], entry["source_product_id"], entry["dest_product_id"],
+                     json.dumps(entry["payload"]), entry["last_error"], entry["created_at"], entry["updated_at"], time.time()),
+                )
+            conn.execute(f"DELETE FROM dead_letter {where}", params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def entries(self, dead=False):
+        table = "dead_letter" if dead else "outbox"
+        return [self._entry(row) for row in self.db.execute(f"SELECT {COLUMNS} FROM {table} ORDER BY id")]
+
+    def size(self):
+        return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def dead_letter_size(self):
+        return self.db.execute("SELECT COUNT(*) FROM dead_letter").fetchone()[0]
+
+    def drain(self, handler):
+        """Retry every due entry once; handler(entry) returns None on success or an error message."""
+        processed = 0
+        while True:
+            entries = self.claim_due()
+            if not entries:
+                return processed
+            for entry in entries:
+                try:
+                    error = handler(entry)
+                except Deferred as e:
+                    self.defer(entry, e.delay, str(e))
+                    processed += 1
+                    continue
+                except Exception as e:
+                    error = repr(e)
+                if error:
+                    self.failed(entry, error)
+                else:
+                    self.succeeded(entry)
+                processed += 1
+
+    def start(self, handler, interval=5.0):
+        """Start the retry thread once per process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            def run():
+                while True:
+                    try:
+                        self.drain(handler)
+                    except Exception:
+                        logger.exception("Outbox retry loop error")
+                    time.sleep(interval)
+
+            threading.Thread(target=run, name="outbox", daemon=True).start()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _entry(row):
+        keys = [column.strip() for column in COLUMNS.split(",")]
+        entry = dict(zip(keys, row))
+        entry["payload"] = json.loads(entry["payload"])
+        return entry
+
+
+def make_outbox(path=None):
+    return Outbox(
+        path or os.getenv("OUTBOX_PATH", "outbox.db"),
+        max_attempts=int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8")),
+        base_delay=float(os.getenv("OUTBOX_BASE_DELAY", "30")),
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    listing = commands.add_parser("list", help="show pending (or dead-lettered) writes")
+    listing.add_argument("--dead", action="store_true")
+    replay = commands.add_parser("replay", help="move dead letters back into the outbox")
+    replay.add_argument("ids", nargs="*", type=int)
+    commands.add_parser("drain", help="retry every due entry now")
+    args = parser.parse_args(argv)
+
+    if args.command == "drain":
+        from app import outbox, retry_outbox_entry
+        print(f"Processed {outbox.drain(retry_outbox_entry)} outbox entries")
+        return 0
+
+    outbox = make_outbox()
+    if args.command == "list":
+        for entry in outbox.entries(dead=args.dead):
+            print(f"{entry['id']:>6} {entry['region']:<5} {entry['dest_product_id']:<16} attempts={entry['attempts']} {entry['last_error']}")
+    elif args.command == "replay":
+        print(f"Replayed {outbox.replay(args.ids)} dead-lettered writes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
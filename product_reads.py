@@ -0,0 +1,131 @@
+"""Batched, projected product reads over GraphQL.
+
+A ProductQuery selects only the fields the pipeline syncs (plus variant IDs
+and SKUs) and fetches many products per request with nodes(ids: [...]),
+returning them in the same REST shape as GET /products/{id}.json. Batches
+are sized so each query stays under Shopify's single-query cost limit.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# REST field -> (GraphQL field, value transform)
+PRODUCT_FIELDS = {
+    "title": ("title", None),
+    "vendor": ("vendor", None),
+    "product_type": ("productType", None),
+    "status": ("status", str.lower),
+}
+VARIANT_FIELDS = {"sku", "inventory_policy", "weight", "weight_unit"}
+WEIGHT_UNITS = {"GRAMS": "g", "KILOGRAMS": "kg", "OUNCES": "oz", "POUNDS": "lb"}
+LABEL_SELECTION = 'shippingLabel: metafield(namespace: "shipping_information", key: "shipping_label") { value }'
+# Shopify rejects any single query whose requested cost is above this
+MAX_QUERY_COST = 1000
+
+
+def product_gid(product_id):
+    return f"gid://shopify/Product/{product_id}"
+
+
+def to_rest_variant(node):
+    """Reshape a GraphQL variant node into REST variant fields, keeping only what was selected."""
+    variant = {"id": int(node["legacyResourceId"])}
+    if "sku" in node:
+        variant["sku"] = node["sku"]
+    if "inventoryPolicy" in node:
+        variant["inventory_policy"] = node["inventoryPolicy"].lower()
+    if "inventoryItem" in node:
+        weight = ((node["inventoryItem"] or {}).get("measurement") or {}).get("weight") or {}
+        variant["weight"] = weight.get("value")
+        variant["weight_unit"] = WEIGHT_UNITS.get(weight.get("unit"))
+    return variant
+
+
+class ProductQuery:
+    """A nodes(ids: [...]) product read projected to the given REST fields.
+
+    product_fields and variant_fields name REST fields; variant_fields=None
+    skips variants altogether. label adds the shipping label as
+    "shipping_label" and links adds the custom-namespace metafields as
+    "metafields". `supported` is False when a field has no GraphQL equivalent.
+    Products with more variants or metafields than one page holds are not
+    returned, so the caller can fall back to REST for them.
+    """
+
+    def __init__(self, product_fields=(), variant_fields=None, label=False, links=False,
+                 variants_page=25, links_page=20, max_batch=50):
+        unsupported = set(product_fields) - set(PRODUCT_FIELDS) - {"id"}
+        unsupported |= set(variant_fields or ()) - VARIANT_FIELDS - {"id"}
+        self.supported = not unsupported
+        self.product_fields = [field for field in product_fields if field in PRODUCT_FIELDS]
+
+        # Objects and connection items cost 1 point each, a connection 2 more
+        selection = ["legacyResourceId"] + [PRODUCT_FIELDS[field][0] for field in self.product_fields]
+        cost = 1
+        if label:
+            selection.append(LABEL_SELECTION)
+            cost += 1
+        if links:
+            selection.append(f'links: metafields(namespace: "custom", first: {links_page}) '
+                             '{ nodes { namespace key value } pageInfo { hasNextPage } }')
+            cost += 3 + links_page
+        self.variants = variant_fields is not None
+        if self.variants:
+            variant_selection = ["legacyResourceId", "sku"]
+            per_variant = 1
+            if "inventory_policy" in variant_fields:
+                variant_selection.append("inventoryPolicy")
+            if {"weight", "weight_unit"} & set(variant_fields):
+                variant_selection.append("inventoryItem { measurement { weight { unit value } } }")
+                per_variant += 3
+            selection.append(f"variants(first: {variants_page}) {{ nodes {{ {' '.join(variant_selection)} }} pageInfo {{ hasNextPage }} }}")
+            cost += 3 + variants_page * per_variant
+        self.label = label
+        self.links = links
+        self.cost = cost
+        self.batch_size = max(1, min(max_batch, MAX_QUERY_COST // cost))
+        self.query = "query products($ids: [ID!]!) { nodes(ids: $ids) { ... on Product { %s } } }" % " ".join(selection)
+
+    def to_rest_product(self, node):
+        """Reshape a product node, or return None if it is missing or had more variants/metafields than fetched."""
+        if not node or "legacyResourceId" not in node:
+            return None
+        product = {"id": int(node["legacyResourceId"])}
+        for field in self.product_fields:
+            name, transform = PRODUCT_FIELDS[field]
+            value = node.get(name)
+            product[field] = transform(value) if transform and value is not None else value
+        if self.label:
+            product["shipping_label"] = (node.get("shippingLabel") or {}).get("value") or ""
+        if self.links:
+            if node["links"]["pageInfo"]["hasNextPage"]:
+                return None
+            product["metafields"] = node["links"]["nodes"]
+        if self.variants:
+            if node["variants"]["pageInfo"]["hasNextPage"]:
+                return None
+            product["variants"] = [to_rest_variant(variant) for variant in node["variants"]["nodes"]]
+        return product
+
+    def fetch(self, client, product_ids):
+        """Return {product_id: product} for the IDs that could be read in full, in as few requests as the cost limit allows."""
+        products = {}
+        product_ids = list(dict.fromkeys(product_ids))
+        for start in range(0, len(product_ids), self.batch_size):
+            batch = product_ids[start:start + self.batch_size]
+            response = client.graphql(self.query, {"ids": [product_gid(product_id) for product_id in batch]})
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            nodes = (body.get("data") or {}).get("nodes")
+            if response.status_code != 200 or body.get("errors") or not isinstance(nodes, list):
+                logger.warning("Batched product read failed", extra={
+                    "store": client.region, "status": response.status_code, "errors": body.get("errors"), "products": len(batch),
+                })
+                continue
+            for product_id, node in zip(batch, nodes):
+                product = self.to_rest_product(node)
+                if product is not None:
+                    products[product_id] = product
+        return products
@@ -0,0 +1,255 @@
+"""Catch source product updates whose webhooks never arrived.
+
+Shopify does not guarantee webhook delivery, so a Reconciler periodically
+lists the source store's products updated since a persisted cursor
+(GET /products.json with updated_at_min, following the Link header's
+page_info cursor) and hands each one to the same pipeline a webhook would.
+Products updated in the last `settle` seconds are left for their webhook, and
+each pass re-reads `overlap` seconds before the cursor so updates committed
+out of order are not missed; versions already accepted are skipped by the
+caller's submit function. The listing comes in product ID order, not
+updated_at order, so the cursor only moves (to the pass's updated_at_max)
+once a pass has read every page; a pass that fails part-way leaves it where
+it was and the next one starts over.
+
+Every gunicorn worker schedules the job, but a pass holds an exclusive flock
+on the lock file and is skipped if another process ran one less than half an
+interval ago, so the store is polled once per interval per host.
+
+    python reconcile.py run                 # one pass now, in this process
+    python reconcile.py status
+    python reconcile.py reset [--since ISO]  # move the cursor (default: now)
+"""
+import argparse
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
+from circuit import CircuitOpenError
+from dedup import parse_timestamp
+from storage import SQLiteDB
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def next_page_info(response):
+    """The page_info cursor of the next page from a REST response's Link header, or None on the last page."""
+    url = response.links.get("next", {}).get("url")
+    if not url:
+        return None
+    return (parse_qs(urlsplit(url).query).get("page_info") or [None])[0]
+
+
+class Reconciler:
+    """Polls one store for updated products and passes each to submit(product).
+
+    submit returns True if the product was queued for sync and False if it
+    was skipped. The cursor and the time of the last pass are kept in SQLite
+    at `path`, shared by every process on the host.
+    """
+
+    def __init__(self, client, submit, path, lock_path, interval=900.0, settle=120.0, overlap=60.0,
+                 lookback=3600.0, page_size=250, fields=None):
+        self.client = client
+        self.submit = submit
+        self.lock_path = lock_path
+        self.interval = interval
+        self.settle = settle
+        self.overlap = overlap
+        self.lookback = lookback
+        self.page_size = page_size
+        self.fields = ",".join(fields) if fields else None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.db = SQLiteDB(path, schema=(
+            """
+            CREATE TABLE IF NOT EXISTS reconcile_state (
+                store TEXT PRIMARY KEY,
+                cursor TEXT NOT NULL,
+                last_run_at REAL,
+                last_run_products INTEGER
+            )
+            """,
+        ))
+
+    def state(self):
+        row = self.db.execute(
+            "SELECT cursor, last_run_at, last_run_products FROM reconcile_state WHERE store = ?", (self.client.region,)
+        ).fetchone()
+        if row is None:
+            return {"store": self.client.region, "cursor": None, "last_run_at": None, "last_run_products": None}
+        return {"store": self.client.region, "cursor": row[0], "last_run_at": row[1], "last_run_products": row[2]}
+
+    def reset(self, since=None):
+        """Set the cursor to since (an aware datetime, default now), stored in UTC; a naive one raises ValueError."""
+        if since is not None and since.utcoffset() is None:
+            raise ValueError(f"{since.isoformat()} has no UTC offset")
+        since = since or datetime.now(timezone.utc)
+        self.db.execute(
+            """
+            INSERT INTO reconcile_state (store, cursor) VALUES (?, ?)
+            ON CONFLICT (store) DO UPDATE SET cursor = excluded.cursor
+            """,
+            (self.client.region, since.astimezone(timezone.utc).isoformat()),
+        )
+
+    def _save(self, cursor, started_at=None, products=None):
+        self.db.execute(
+            """
+            INSERT INTO reconcile_state (store, cursor, last_run_at, last_run_products) VALUES (?, ?, ?, ?)
+            ON CONFLICT (store) DO UPDATE SET
+                cursor = excluded.cursor,
+                last_run_at = coalesce(excluded.last_run_at, last_run_at),
+                last_run_products = coalesce(excluded.last_run_products, last_run_products)
+            """,
+            (self.client.region, cursor, started_at, products),
+        )
+
+    @contextmanager
+    def _exclusive(self):
+        """Yield True while holding the host-wide lock, or False if another process holds it."""
+        with open(self.lock_path, "a") as fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def run(self, force=False):
+        """Run one pass unless another process is running one or ran one recently; return its summary or None."""
+        with self._exclusive() as locked:
+            if not locked:
+                return None
+            state = self.state()
+            if not force and state["last_run_at"] and time.time() - state["last_run_at"] < self.interval / 2:
+                return None
+            return self._poll(state["cursor"])
+
+    def _poll(self, cursor):
+        started_at = time.time()
+        now = datetime.now(timezone.utc)
+        cursor = parse_timestamp(cursor) if cursor else now - timedelta(seconds=self.lookback)
+        if cursor.utcoffset() is None:
+            # Saved by `reset --since` before it required an offset
+            cursor = cursor.replace(tzinfo=timezone.utc)
+        until = now - timedelta(seconds=self.settle)
+        params = {
+            "updated_at_min": (cursor - timedelta(seconds=self.overlap)).isoformat(),
+            "updated_at_max": until.isoformat(),
+        }
+        summary = {"store": self.client.region, "pages": 0, "products": 0, "queued": 0, "skipped": 0}
+        complete = False
+        while True:
+            # Only limit and fields may accompany page_info; the filters carry over from the first page
+            params.update({"limit": self.page_size, **({"fields": self.fields} if self.fields else {})})
+            response = self.client.get("/products.json", params=params)
+            if response.status_code != 200:
+                logger.warning("Reconcile page failed", extra={
+                    "store": self.client.region, "status": response.status_code, "body": response.text[:500],
+                })
+                break
+            products = response.json().get("products", [])
+            summary["pages"] += 1
+            for product in products:
+                queued = self.submit(product)
+                summary["queued" if queued else "skipped"] += 1
+                metrics.RECONCILED.labels("queued" if queued else "skipped").inc()
+            summary["products"] += len(products)
+            page_info = next_page_info(response)
+            if not page_info:
+                complete = True
+                break
+            params = {"page_info": page_info}
+        if complete:
+            # Everything updated before updated_at_max has been handed over, so the next pass can start there
+            cursor = max(cursor, until)
+        self._save(cursor.isoformat(), started_at, summary["products"])
+        summary["complete"] = complete
+        summary["cursor"] = cursor.isoformat()
+        summary["seconds"] = round(time.time() - started_at, 3)
+        logger.info("Reconcile pass finished", extra=summary)
+        return summary
+
+    def run_scheduled(self):
+        try:
+            self.run()
+        except CircuitOpenError as e:
+            logger.warning("Reconcile pass skipped", extra={"store": self.client.region, "error": str(e)})
+        except Exception:
+            logger.exception("Reconcile pass failed")
+
+    def start(self):
+        """Schedule passes every `interval` seconds, once per process; interval <= 0 disables them."""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Imported here: APScheduler is a large share of the app's import time and only needed once running
+            from apscheduler.schedulers.background import BackgroundScheduler
+            scheduler = BackgroundScheduler(daemon=True)
+            scheduler.add_job(self.run_scheduled, "interval", seconds=self.interval, max_instances=1, coalesce=True)
+            scheduler.start()
+            self._pid = os.getpid()
+
+
+def make_reconciler(client, submit, fields=None, path=None):
+    return Reconciler(
+        client, submit,
+        path or os.getenv("RECONCILE_PATH", "reconcile.db"),
+        os.getenv("RECONCILE_LOCK", "reconcile.lock"),
+        interval=float(os.getenv("RECONCILE_INTERVAL", "900")),
+        settle=float(os.getenv("RECONCILE_SETTLE", "120")),
+        overlap=float(os.getenv("RECONCILE_OVERLAP", "60")),
+        lookback=float(os.getenv("RECONCILE_LOOKBACK", "3600")),
+        page_size=int(os.getenv("RECONCILE_PAGE_SIZE", "250")),
+        fields=fields,
+    )
+
+
+def aware_timestamp(value):
+    """Parse --since, which must carry an offset to be compared with Shopify's updated_at."""
+    try:
+        since = parse_timestamp(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not an ISO 8601 timestamp: {value!r}")
+    if since.utcoffset() is None:
+        raise argparse.ArgumentTypeError(f"{value!r} has no UTC offset; add one, e.g. {value}Z or {value}+01:00")
+    return since
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="poll for updated products now and queue them")
+    commands.add_parser("status", help="show the cursor and the last pass")
+    reset = commands.add_parser("reset", help="move the cursor")
+    reset.add_argument("--since", type=aware_timestamp, help="ISO 8601 timestamp with offset (default: now)")
+    args = parser.parse_args(argv)
+
+    from app import reconcile_product, reconciler, sync_product
+    if args.command == "run":
+        # Sync each product in this process rather than queueing it for workers that exit with it
+        reconciler.submit = lambda product: reconcile_product(product, sync_product)
+        print(json.dumps(reconciler.run(force=True)))
+    elif args.command == "status":
+        print(json.dumps(reconciler.state()))
+    elif args.command == "reset":
+        reconciler.reset(args.since)
+        print(json.dumps(reconciler.state()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,365 @@
+"""Replay captured webhook traffic through the sync pipeline and profile it.
+
+    CAPTURE_DIR=captures gunicorn app:app      # record traffic (see capture.py)
+    python replay.py captures/ --speed 10 --profile replay.prof --flame replay.folded
+
+Each captured delivery is handed to the webhook handler in this process, with
+its original headers and body, at its original spacing divided by --speed (0,
+the default, sends them back to back). Coalescing is off and each delivery is
+synced, one region after another, before the next is sent, so runs are
+repeatable and all the work happens on the profiled thread.
+
+Shopify is never contacted. With --shopify recorded (the default) each call
+is answered from the captured responses (see Recordings for how they are
+matched), falling back to the stub when none fits; --shopify stub answers
+every call from an in-process fake_shopify.py store seeded with the captured
+products. --latency also waits out each recorded call's original duration,
+and --unthrottled skips the client's rate-limit pacing so the profile shows
+CPU rather than waiting.
+
+The report gives the time per delivery, and per pipeline stage and store API
+how often it ran and the total and mean time spent, followed by the slowest
+functions by cumulative time. --profile saves the cProfile stats (for pstats
+or snakeviz), --flame writes sampled stacks in the folded format read by
+flamegraph.pl and speedscope, and --output saves the report as JSON to compare
+runs before and after a change.
+"""
+import argparse
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from urllib.parse import parse_qsl, urlsplit
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from capture import call_key, read_capture, request_digest
+
+
+class Recordings:
+    """Captured responses, matched to replayed calls from the closest match down.
+
+    1. "exact": the next unused response for the same store, method, path and
+       request body, in capture order.
+    2. "assembled": a nodes(ids:) read answered from the product nodes that
+       earlier reads of the same query returned, when every ID was seen.
+       Replay batches reads differently from the production workers.
+    3. "nearest": for writes only, the last response for the same store, method
+       and path (and GraphQL query), e.g. the result of the same mutation for
+       another product. A read answered this way would hand the pipeline some
+       other product's data.
+    Anything else is left to the stub.
+    """
+
+    def __init__(self, records):
+        self.matches = Counter()
+        self._exact = defaultdict(deque)
+        self._nearest = {}
+        self._nodes = defaultdict(dict)
+        self._extensions = {}
+        for record in records:
+            if record["kind"] != "call" or record.get("response") is None:
+                continue
+            region, method, path = record["region"], record["method"], record["path"]
+            self._exact[(region, method, path, record["request"])].append(record)
+            self._nearest[(region, method, path, record.get("query"))] = record
+            if record.get("ids") and record["status"] == 200:
+                try:
+                    body = json.loads(record["response"]["body"])
+                except ValueError:
+                    continue
+                nodes = (body.get("data") or {}).get("nodes")
+                if isinstance(nodes, list):
+                    self._nodes[(region, record["query"])].update(zip(record["ids"], nodes))
+                    self._extensions[(region, record["query"])] = body.get("extensions")
+
+    def take(self, region, method, path, digest, query=None, ids=None, write=False):
+        """Return (status, headers, body text, recorded seconds), or None if nothing matches."""
+        responses = self._exact.get((region, method, path, digest))
+        if responses:
+            self.matches["exact"] += 1
+            record = responses.popleft()
+            return record["status"], record["response"]["headers"], record["response"]["body"], record["seconds"]
+        nodes = self._nodes.get((region, query))
+        if ids and nodes and all(gid in nodes for gid in ids):
+            self.matches["assembled"] += 1
+            body = {"data": {"nodes": [nodes[gid] for gid in ids]}, "extensions": self._extensions[(region, query)]}
+            return 200, {"Content-Type": "application/json"}, json.dumps(body), 0.0
+        record = self._nearest.get((region, method, path, query)) if write else None
+        if record is not None:
+            self.matches["nearest"] += 1
+            return record["status"], record["response"]["headers"], record["response"]["body"], record["seconds"]
+        return None
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers one store's requests from the recordings or the stub, never the network."""
+
+    def __init__(self, client, recordings, stub, latency=False):
+        super().__init__()
+        self.client = client
+        self.recordings = recordings
+        self.stub = stub
+        self.latency = latency
+        self.stubbed = 0
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        relative = urlsplit(request.url[len(self.client.base_url):])
+        body = request.body.encode() if isinstance(request.body, str) else request.body
+        payload = json.loads(body) if body else None
+        recording = None
+        if self.recordings is not None:
+            graphql = payload if isinstance(payload, dict) else {}
+            query = graphql.get("query")
+            # A GraphQL call writes if it runs a mutation; a REST call if it isn't a GET
+            write = query.lstrip().startswith("mutation") if isinstance(query, str) else request.method != "GET"
+            recording = self.recordings.take(
+                self.client.region, request.method, call_key(relative.path, parse_qsl(relative.query)),
+                request_digest(payload), request_digest(query), (graphql.get("variables") or {}).get("ids"), write,
+            )
+        if recording is not None:
+            status, headers, text, seconds = recording
+            if self.latency:
+                time.sleep(seconds)
+            content = text.encode()
+        else:
+            self.stubbed += 1
+            answer = self.stub.open(url.path, method=request.method, query_string=url.query, data=body,
+                                    headers={"Content-Type": request.headers.get("Content-Type", "application/json")})
+            status, headers, content = answer.status_code, dict(answer.headers), answer.get_data()
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class StackSampler:
+    """Samples one thread's Python stack every `interval` seconds, counting identical stacks."""
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+
+
+def configure_environment(work_dir):
+    """Point every store at the replay adapter and keep all state in work_dir, before app is imported."""
+    from field_mappings import load_mappings
+
+    mappings = load_mappings()
+    for region in [mappings.source, *mappings.regions]:
+        os.environ.setdefault(f"{region}_SHOP_NAME", region.lower())
+        os.environ.setdefault(f"{region}_API_VERSION", "2024-07")
+        # Never the real store, whatever the environment says
+        os.environ[f"{region}_BASE_URL"] = f"http://replay/{region.lower()}"
+    # Always the in-process synchronous path, whatever the shell or .env says: a delivery handed to a
+    # coalescer thread or a durable queue would never be drained here, and the profile would measure nothing
+    os.environ.update({
+        "COALESCE_WINDOW": "0", "FANOUT_MODE": "serial", "DEDUP_BACKEND": "memory", "QUEUE_BACKEND": "memory",
+        "CACHE_BACKEND": "memory", "RECONCILE_INTERVAL": "0",
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    for key, name in {
+        "MAPPINGS_PATH": "mappings.db", "OUTBOX_PATH": "outbox.db", "DEDUP_PATH": "dedup.db", "QUEUE_PATH": "sync_queue.db",
+        "CACHE_PATH": "sync_cache.db", "RECONCILE_PATH": "reconcile.db", "RECONCILE_LOCK": "reconcile.lock",
+    }.items():
+        os.environ[key] = os.path.join(work_dir, name)
+    os.environ.pop("CAPTURE_DIR", None)
+    return mappings
+
+
+def histogram_totals(histogram):
+    """{label values: [count, total seconds]} from a prometheus_client Histogram."""
+    totals = defaultdict(lambda: [0, 0.0])
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            key = tuple(sample.labels.values())
+            if sample.name.endswith("_count"):
+                totals[key][0] = int(sample.value)
+            elif sample.name.endswith("_sum"):
+                totals[key][1] = sample.value
+    return {key: value for key, value in totals.items() if value[0]}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else float("nan")
+
+
+def replay(args):
+    records = read_capture(args.captures)
+    deliveries = [record for record in records if record["kind"] == "webhook"][:args.limit]
+    if not deliveries:
+        raise SystemExit("No webhook deliveries in the capture")
+
+    # Removed when this process exits; the app keeps its SQLite connections open until then
+    work_dir = tempfile.mkdtemp(prefix="replay-")
+    atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+    mappings = configure_environment(work_dir)
+    import app
+    import metrics
+    from fake_shopify import FakeShopify, create_app
+
+    # Sync each delivery inside its handler call instead of queueing it for worker threads
+    app.coalescer.emit = app.sync_product
+
+    shop = FakeShopify(
+        source=mappings.source.lower(), destinations=[region.lower() for region in mappings.regions], products=0, rate_limit=False,
+    )
+    stub = create_app(shop).test_client()
+    recordings = Recordings(records) if args.shopify == "recorded" else None
+    adapters = []
+    for client in app.clients.values():
+        adapter = ReplayAdapter(client, recordings, stub, args.latency)
+        client.session.mount("http://", adapter)
+        client.session.mount("https://", adapter)
+        adapters.append(adapter)
+        if args.unthrottled:
+            # The buckets still track the limits responses report; they just never make a call wait
+            for bucket in (client.rest_bucket, client.graphql_bucket):
+                bucket.acquire = lambda cost=1: None
+
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident(), args.sample_interval) if args.flame else None
+    latencies = []
+    statuses = Counter()
+    behind = 0.0
+    first = deliveries[0]["t"]
+    started = time.perf_counter()
+    if sampler:
+        sampler.start()
+    profiler.enable()
+    for delivery in deliveries:
+        if args.speed:
+            wait = (delivery["t"] - first) / args.speed - (time.perf_counter() - started)
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                behind = max(behind, -wait)
+        body = delivery["body"].encode("utf-8", "surrogateescape")
+        payload = app.parse_body(body)
+        if isinstance(payload, dict) and payload.get("id"):
+            if payload["id"] in shop.stores[shop.source]:
+                shop.stores[shop.source][payload["id"]] = payload
+            else:
+                shop.add_source_product(payload)
+        handled = time.perf_counter()
+        with app.app.test_request_context("/webhook/product-update", method="POST", data=body, headers=delivery["headers"]):
+            _, status = app.product_update_webhook()
+        latencies.append(time.perf_counter() - handled)
+        statuses[status] += 1
+    profiler.disable()
+    if sampler:
+        sampler.stop()
+    wall = time.perf_counter() - started
+
+    report = {
+        "deliveries": len(deliveries),
+        "wall_seconds": round(wall, 3),
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "delivery_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1e3, 3),
+            "p50": round(percentile(latencies, 0.50) * 1e3, 3),
+            "p99": round(percentile(latencies, 0.99) * 1e3, 3),
+            "max": round(max(latencies) * 1e3, 3),
+        },
+        "max_behind_seconds": round(behind, 3) if args.speed else None,
+        "stages": [
+            {"stage": stage, "region": region, "count": count, "total_seconds": round(total, 4), "mean_ms": round(total / count * 1e3, 3)}
+            for (stage, region), (count, total) in sorted(histogram_totals(metrics.STAGE_SECONDS).items())
+        ],
+        "shopify": [
+            {"region": region, "api": api, "count": count, "total_seconds": round(total, 4), "mean_ms": round(total / count * 1e3, 3)}
+            for (region, api), (count, total) in sorted(histogram_totals(metrics.SHOPIFY_SECONDS).items())
+        ],
+        "responses": {
+            **(recordings.matches if recordings else {}),
+            "stubbed": sum(adapter.stubbed for adapter in adapters),
+        },
+    }
+
+    print(f"{report['deliveries']} deliveries in {wall:.2f}s, "
+          f"per delivery mean {report['delivery_ms']['mean']:.2f} ms, p50 {report['delivery_ms']['p50']:.2f} ms, "
+          f"p99 {report['delivery_ms']['p99']:.2f} ms; responses {report['responses']}")
+    print(f"\n{'stage':<20} {'region':<8} {'count':>7} {'total s':>9} {'mean ms':>9}")
+    for row in report["stages"]:
+        print(f"{row['stage']:<20} {row['region']:<8} {row['count']:>7} {row['total_seconds']:>9.3f} {row['mean_ms']:>9.3f}")
+    print(f"\n{'shopify':<20} {'region':<8} {'count':>7} {'total s':>9} {'mean ms':>9}")
+    for row in report["shopify"]:
+        print(f"{row['api']:<20} {row['region']:<8} {row['count']:>7} {row['total_seconds']:>9.3f} {row['mean_ms']:>9.3f}")
+    print()
+    stats = pstats.Stats(profiler)
+    stats.sort_stats(args.sort).print_stats(args.top)
+
+    if args.profile:
+        stats.dump_stats(args.profile)
+    if sampler:
+        sampler.write(args.flame)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(report, fh, indent=2)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", help="capture files or directories")
+    parser.add_argument("--shopify", choices=["recorded", "stub"], default="recorded", help="where Shopify responses come from")
+    parser.add_argument("--speed", type=float, default=0.0, help="replay at N times the captured pace (0: back to back)")
+    parser.add_argument("--latency", action="store_true", help="wait out each recorded call's original duration")
+    parser.add_argument("--unthrottled", action="store_true", help="skip client-side rate-limit pacing")
+    parser.add_argument("--limit", type=int, help="replay only the first N deliveries")
+    parser.add_argument("--profile", help="write cProfile stats here")
+    parser.add_argument("--flame", help="write sampled folded stacks here")
+    parser.add_argument("--sample-interval", type=float, default=0.001, help="seconds between --flame samples")
+    parser.add_argument("--sort", default="cumulative", help="pstats sort key for the report")
+    parser.add_argument("--top", type=int, default=25, help="functions listed in the report")
+    parser.add_argument("--output", help="write the report as JSON here")
+    args = parser.parse_args(argv)
+    replay(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""Full or filtered catalog resync through Shopify Bulk Operations.
+
+Exports the UK catalog and each destination with bulkOperationRunQuery, joins
+them on the custom.<region>_product_id metafields, and pushes only the
+differences back with bulkOperationRunMutation, using the same per-region
+field rules as the webhook. Exports are streamed to disk and joined through an
+on-disk index, so memory use does not grow with the catalog. The exports read
+a fixed set of fields (EXPORTED_PRODUCT_FIELDS, EXPORTED_VARIANT_FIELDS); a
+region whose mapping names any other field is refused before anything runs.
+
+    python resync.py                           # every product, every synced region
+    python resync.py --query "vendor:BMW"      # Shopify product search syntax
+    python resync.py --regions DUCO --dry-run  # report differences without writing
+    python resync.py --backfill --dry-run      # only populate the local mapping store
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import requests
+from app import (
+    SOURCE_REGION, SYNC_REGIONS, clients, mappings, region_mappings, build_update_data, diff_update_data,
+    graphql_input_supported, parse_product_metafields, to_graphql_inputs,
+)
+from jsonl import ChunkedJSONLWriter, download, iter_jsonl, iter_jsonl_url, stitch
+from product_reads import to_rest_variant
+from storage import SQLiteDB
+
+PRODUCT_FIELDS = """
+      id legacyResourceId title vendor productType status
+      shippingLabel: metafield(namespace: "shipping_information", key: "shipping_label") { value }
+      variants { edges { node {
+        id legacyResourceId sku inventoryPolicy
+        inventoryItem { measurement { weight { unit value } } }
+      } } }
+"""
+# The REST fields to_rest_product fills from PRODUCT_FIELDS; a region mapping any other field can't be resynced
+EXPORTED_PRODUCT_FIELDS = {"title", "vendor", "product_type", "status"}
+EXPORTED_VARIANT_FIELDS = {"sku", "inventory_policy", "weight", "weight_unit"}
+SOURCE_QUERY = """
+{ products%s { edges { node {
+  %s
+  metafields(namespace: "custom") { edges { node { id namespace key value } } }
+} } } }
+""" % ("%s", PRODUCT_FIELDS)
+DESTINATION_QUERY = """
+{ products { edges { node {
+  %s
+} } } }
+""" % PRODUCT_FIELDS
+
+PRODUCT_MUTATION = """
+mutation call($input: ProductInput!) { productUpdate(input: $input) { userErrors { field message } } }
+"""
+VARIANTS_MUTATION = """
+mutation call($productId: ID!, $variants: [ProductVariantsBulkInput!]!) {
+  productVariantsBulkUpdate(productId: $productId, variants: $variants) { userErrors { field message } }
+}
+"""
+POLL_INTERVAL = float(os.getenv("BULK_POLL_INTERVAL", "5"))
+# Shopify caps the variables file of a bulk mutation; larger plans are split across several runs
+MUTATION_FILE_BYTES = int(os.getenv("BULK_MUTATION_FILE_BYTES", str(20 * 1024 * 1024)))
+
+
+def graphql_data(client, query, variables=None):
+    """Run a GraphQL call and return its data, raising on transport or top-level errors."""
+    response = client.graphql(query, variables)
+    body = response.json()
+    if response.status_code != 200 or body.get("errors"):
+        raise RuntimeError(f"{client.region}: GraphQL request failed: {body.get('errors') or response.text}")
+    return body["data"]
+
+
+def check_user_errors(client, result):
+    if result.get("userErrors"):
+        raise RuntimeError(f"{client.region}: {result['userErrors']}")
+    return result
+
+
+def wait_for_bulk_operation(client, operation_id):
+    """Poll a bulk operation until it finishes and return its result URL (None if it produced no output)."""
+    query = """
+    query op($id: ID!) { node(id: $id) { ... on BulkOperation { id status errorCode objectCount url } } }
+    """
+    while True:
+        operation = graphql_data(client, query, {"id": operation_id})["node"]
+        if operation["status"] == "COMPLETED":
+            print(f"{client.region}: bulk operation finished, {operation['objectCount']} objects")
+            return operation["url"]
+        if operation["status"] in ("FAILED", "CANCELED", "EXPIRED"):
+            raise RuntimeError(f"{client.region}: bulk operation {operation['status']}: {operation['errorCode']}")
+        time.sleep(POLL_INTERVAL)
+
+
+def run_bulk_query(client, query):
+    mutation = """
+    mutation run($query: String!) {
+      bulkOperationRunQuery(query: $query) { bulkOperation { id } userErrors { field message } }
+    }
+    """
+    result = check_user_errors(client, graphql_data(client, mutation, {"query": query})["bulkOperationRunQuery"])
+    return wait_for_bulk_operation(client, result["bulkOperation"]["id"])
+
+
+def child_list(obj):
+    """Name the product list a bulk export child line belongs in."""
+    return "variants" if obj["id"].startswith("gid://shopify/ProductVariant/") else "metafields"
+
+
+def to_rest_product(node):
+    """Reshape an exported product node into the REST/webhook shape the pipeline works on."""
+    product = {
+        "id": int(node["legacyResourceId"]),
+        "title": node["title"],
+        "vendor": node["vendor"],
+        "product_type": node["productType"],
+        "status": node["status"].lower(),
+        "variants": [to_rest_variant(variant) for variant in node.get("variants", [])],
+        "shipping_label": (node.get("shippingLabel") or {}).get("value") or "",
+        "destination_ids": parse_product_metafields(node.get("metafields", []))["destination_ids"],
+    }
+    return product
+
+
+def export_products(client, query, path):
+    """Run a bulk export and save the raw JSONL result to path."""
+    print(f"{client.region}: exporting products")
+    return download(run_bulk_query(client, query), path)
+
+
+def iter_products(path):
+    """Stream REST-shaped products out of a saved bulk export."""
+    with open(path, "rb") as fh:
+        for node in stitch(iter_jsonl(fh), child_list):
+            yield to_rest_product(node)
+
+
+class ProductIndex:
+    """On-disk product lookup by ID, so joining two catalogs never holds either in memory."""
+
+    def __init__(self, path):
+        self.db = SQLiteDB(path, schema=("CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, product TEXT NOT NULL)",))
+
+    def load(self, products, batch_size=5000):
+        conn = self.db.conn()
+        batch = []
+        for product in products:
+            batch.append((product["id"], json.dumps(product)))
+            if len(batch) >= batch_size:
+                self._insert(conn, batch)
+                batch = []
+        self._insert(conn, batch)
+        return self
+
+    def _insert(self, conn, batch):
+        conn.execute("BEGIN")
+        conn.executemany("INSERT OR REPLACE INTO products (id, product) VALUES (?, ?)", batch)
+        conn.execute("COMMIT")
+
+    def get(self, product_id):
+        row = self.db.execute("SELECT product FROM products WHERE id = ?", (int(product_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def batched(items, size=1000):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def backfill_links(source_path):
+    """Store every UK product's destination IDs and shipping label in the mapping store."""
+    for batch in batched(iter_products(source_path)):
+        mappings.put_many_links(
+            (product["id"], {"destination_ids": product["destination_ids"], "shipping_label": product["shipping_label"]})
+            for product in batch
+        )
+
+
+def backfill_products(region, destination_path):
+    """Store the exported state of every destination product in the mapping store."""
+    for batch in batched(iter_products(destination_path)):
+        for product in batch:
+            del product["destination_ids"]
+        mappings.put_many_products(region, batch)
+
+
+def unexported_fields(region):
+    """The fields a region maps, on either side, that the bulk exports don't read."""
+    mapping = region_mappings[region]
+    product = (set(mapping.product_sources) | set(mapping.product_fields)) - EXPORTED_PRODUCT_FIELDS
+    variant = (set(mapping.variant_sources) | set(mapping.variant_fields)) - EXPORTED_VARIANT_FIELDS
+    return sorted(product) + sorted(f"variant.{field}" for field in variant)
+
+
+def plan_region(region, source_products, destination, product_writer, variant_writer):
+    """Diff every linked product for a region, writing mutation inputs to the writers; return counts."""
+    counts = {"linked": 0, "missing": 0, "unchanged": 0, "changed": 0, "unsupported": 0}
+
+    for source in source_products:
+        dest_product_id = source["destination_ids"].get(region)
+        if not dest_product_id:
+            continue
+        dest = destination.get(dest_product_id)
+        if dest is None:
+            counts["missing"] += 1
+            continue
+        counts["linked"] += 1
+
+        updated_data = diff_update_data(build_update_data(region, source, source["variants"], dest["variants"]), dest)
+        syncs_label = "shipping_label" in region_mappings[region].metafields
+        label = source["shipping_label"] if syncs_label and source["shipping_label"] != dest["shipping_label"] else None
+        if updated_data is None and label is None:
+            counts["unchanged"] += 1
+            continue
+        if not graphql_input_supported(updated_data):
+            counts["unsupported"] += 1
+            continue
+
+        counts["changed"] += 1
+        product_input, variants = to_graphql_inputs(dest["id"], updated_data, label)
+        if len(product_input) > 1:
+            product_writer.write({"input": product_input})
+        if variants:
+            variant_writer.write({"productId": product_input["id"], "variants": variants})
+    return counts
+
+
+def stage_upload(client, path):
+    """Upload a JSONL variables file for a bulk mutation and return its stagedUploadPath."""
+    mutation = """
+    mutation stage($input: [StagedUploadInput!]!) {
+      stagedUploadsCreate(input: $input) {
+        stagedTargets { url parameters { name value } }
+        userErrors { field message }
+      }
+    }
+    """
+    variables = {"input": [{
+        "resource": "BULK_MUTATION_VARIABLES",
+        "filename": os.path.basename(path),
+        "mimeType": "text/jsonl",
+        "httpMethod": "POST",
+    }]}
+    result = check_user_errors(client, graphql_data(client, mutation, variables)["stagedUploadsCreate"])
+    target = result["stagedTargets"][0]
+    parameters = {parameter["name"]: parameter["value"] for parameter in target["parameters"]}
+    with open(path, "rb") as fh:
+        response = requests.post(target["url"], data=parameters, files={"file": fh}, timeout=(10, 300))
+    response.raise_for_status()
+    return parameters["key"]
+
+
+def run_bulk_mutation(client, mutation, path):
+    """Run one bulk mutation over a staged JSONL file and return the number of lines that failed."""
+    run = """
+    mutation run($mutation: String!, $path: String!) {
+      bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) {
+        bulkOperation { id }
+        userErrors { field message }
+      }
+    }
+    """
+    staged_path = stage_upload(client, path)
+    result = check_user_errors(client, graphql_data(client, run, {"mutation": mutation, "path": staged_path})["bulkOperationRunMutation"])
+    print(f"{client.region}: running bulk mutation over {os.path.basename(path)}")
+
+    failed = 0
+    for line in iter_jsonl_url(wait_for_bulk_operation(client, result["bulkOperation"]["id"])):
+        errors = [error for value in (line.get("data") or {}).values() for error in (value or {}).get("userErrors", [])]
+        if errors or line.get("errors"):
+            failed += 1
+            print(f"{client.region}: {errors or line['errors']}")
+    return failed
+
+
+def resync(regions, query=None, dry_run=False, work_dir=None, backfill=False):
+    """Resync the given regions and return a per-region summary.
+
+    With backfill, the exports also (re)populate the mapping store the webhook pipeline reads first.
+    """
+    unexported = {region: fields for region in regions if (fields := unexported_fields(region))}
+    if unexported:
+        raise RuntimeError("the bulk export doesn't read every mapped field: " + "; ".join(
+            f"{region} maps {', '.join(fields)}" for region, fields in unexported.items()
+        ))
+    search = f"(query: {json.dumps(query)})" if query else ""
+    summary = {}
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        source_path = export_products(clients[SOURCE_REGION], SOURCE_QUERY % search, os.path.join(tmp, f"{SOURCE_REGION.lower()}.jsonl"))
+        if backfill:
+            backfill_links(source_path)
+        for region in regions:
+            client = clients[region]
+            name = region.lower()
+            destination_path = export_products(client, DESTINATION_QUERY, os.path.join(tmp, f"{name}.jsonl"))
+            destination = ProductIndex(os.path.join(tmp, f"{name}.db")).load(iter_products(destination_path))
+            if backfill:
+                backfill_products(region, destination_path)
+
+            with ChunkedJSONLWriter(os.path.join(tmp, f"{name}-products"), MUTATION_FILE_BYTES) as product_writer, \
+                    ChunkedJSONLWriter(os.path.join(tmp, f"{name}-variants"), MUTATION_FILE_BYTES) as variant_writer:
+                counts = plan_region(region, iter_products(source_path), destination, product_writer, variant_writer)
+            print(f"{region}: {counts}")
+
+            if not dry_run:
+                counts["failed"] = 0
+                for path in product_writer.paths:
+                    counts["failed"] += run_bulk_mutation(client, PRODUCT_MUTATION, path)
+                for path in variant_writer.paths:
+                    counts["failed"] += run_bulk_mutation(client, VARIANTS_MUTATION, path)
+            summary[region] = counts
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--regions", nargs="+", default=SYNC_REGIONS, choices=list(region_mappings.regions))
+    parser.add_argument("--query", help="Shopify product search filter applied to the UK export")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would change")
+    parser.add_argument("--work-dir", help="directory for the staged JSONL files")
+    parser.add_argument("--backfill", action="store_true", help="also load the exports into the mapping store")
+    args = parser.parse_args(argv)
+
+    try:
+        summary = resync(args.regions, args.query, args.dry_run, args.work_dir, args.backfill)
+    except RuntimeError as e:
+        print(f"Resync failed: {e}")
+        return 1
+    print(json.dumps(summary, indent=2))
+    return 1 if any(counts.get("failed") for counts in summary.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
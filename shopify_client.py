@@ -0,0 +1,249 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+from circuit import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = (
+    float(os.getenv("SHOPIFY_CONNECT_TIMEOUT", "5")),
+    float(os.getenv("SHOPIFY_READ_TIMEOUT", "30")),
+)
+POOL_SIZE = int(os.getenv("SHOPIFY_POOL_SIZE", "10"))
+MAX_RETRIES = int(os.getenv("SHOPIFY_MAX_RETRIES", "5"))
+# Fraction of each bucket left unused so concurrent workers stay just under the limit
+RATE_HEADROOM = float(os.getenv("SHOPIFY_RATE_HEADROOM", "0.05"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Consecutive failed calls (after retries) that open a store's circuit, and how long it stays open
+BREAKER_FAILURES = int(os.getenv("SHOPIFY_BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("SHOPIFY_BREAKER_RESET", "30"))
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class TokenBucket:
+    """Local estimate of one Shopify rate-limit bucket, corrected by the limits Shopify reports.
+
+    REST calls cost one token each and the bucket refills at the store's leak rate;
+    GraphQL calls cost their query cost and refill at the throttleStatus restore rate.
+    """
+
+    def __init__(self, capacity, refill_rate, headroom=RATE_HEADROOM):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.headroom = headroom
+        self.available = capacity
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    def acquire(self, cost=1):
+        """Block until cost tokens can be spent without dipping into the headroom."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                reserve = self.capacity * self.headroom
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.available - cost >= reserve or self.available >= self.capacity:
+                        self.available -= cost
+                        return
+                    wait = (cost + reserve - self.available) / self.refill_rate
+            time.sleep(wait)
+
+    def sync(self, available, capacity=None, refill_rate=None):
+        """Replace the local estimate with the values Shopify just reported."""
+        with self._lock:
+            if capacity:
+                self.capacity = capacity
+            if refill_rate:
+                self.refill_rate = refill_rate
+            self.available = available
+            self._updated = time.monotonic()
+
+    def block(self, seconds):
+        """Pause every caller of this bucket, e.g. for a Retry-After."""
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.available = 0
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class ShopifyClient:
+    """Admin API client for one store, reusing keep-alive connections across calls."""
+
+    def __init__(self, region, shop_name, access_token, api_version, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE,
+                 max_retries=MAX_RETRIES, base_url=None):
+        self.region = region
+        self.shop_name = shop_name
+        # base_url points a store at something other than myshopify.com, e.g. fake_shopify.py
+        self.base_url = f"{(base_url or f'https://{shop_name}.myshopify.com').rstrip('/')}/admin/api/{api_version}"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # Standard plans: 40-call REST bucket leaking 2/s, 1000-point GraphQL bucket restoring 50/s.
+        # Both are resized from the first response headers, so Plus stores get their larger limits.
+        self.rest_bucket = TokenBucket(40, 2.0)
+        self.graphql_bucket = TokenBucket(1000, 50.0)
+        self._query_costs = {}
+        # Opens after repeated 5xx/429/connection failures, so a sick store is not hammered or waited on
+        self.breaker = CircuitBreaker(region, BREAKER_FAILURES, BREAKER_RESET)
+        self.breaker.listeners.append(lambda name, state: metrics.CIRCUIT_STATE.labels(name).set(CIRCUIT_STATES[state]))
+        metrics.CIRCUIT_STATE.labels(region).set(CIRCUIT_STATES["closed"])
+        # Called after every HTTP exchange as listener(region, method, path, kwargs, response, seconds, error),
+        # with response None when the request raised
+        self.call_listeners = []
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "X-Shopify-Access-Token": access_token or "",
+            "Accept": "application/json",
+        })
+
+    @classmethod
+    def from_config(cls, region, config):
+        # For private apps the API password doubles as the Admin API access token
+        return cls(region, config["SHOP_NAME"], config["PASSWORD"], config["API_VERSION"], base_url=config.get("BASE_URL"))
+
+    def request(self, method, path, **kwargs):
+        """Send a paced REST call, retrying 429/5xx and connection errors with jittered backoff."""
+        return self._send(method, path, self.rest_bucket, **kwargs)
+
+    def _send(self, method, path, bucket, **kwargs):
+        """Send through the store's circuit breaker; raises CircuitOpenError while it is open."""
+        self.breaker.before_call()
+        try:
+            response = self._send_with_retries(method, path, bucket, **kwargs)
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500 or response.status_code == 429:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _send_with_retries(self, method, path, bucket, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        url = f"{self.base_url}{path}"
+        api = "rest" if bucket else "graphql"
+        for attempt in range(self.max_retries + 1):
+            if bucket:
+                bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.SHOPIFY_RESPONSES.labels(self.region, api, type(e).__name__).inc()
+                for listener in self.call_listeners:
+                    listener(self.region, method, path, kwargs, None, time.perf_counter() - started, repr(e))
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                continue
+            elapsed = time.perf_counter() - started
+            metrics.SHOPIFY_SECONDS.labels(self.region, api).observe(elapsed)
+            for listener in self.call_listeners:
+                listener(self.region, method, path, kwargs, response, elapsed, None)
+            metrics.SHOPIFY_RESPONSES.labels(self.region, api, str(response.status_code)).inc()
+
+            if bucket:
+                self._sync_rest_limit(response)
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            self._wait_before_retry(bucket or self.graphql_bucket, response, attempt)
+        return response
+
+    def _sync_rest_limit(self, response):
+        # X-Shopify-Shop-Api-Call-Limit: "32/40" -> 32 of 40 calls used
+        limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+        if limit:
+            try:
+                used, size = (int(part) for part in limit.split("/"))
+            except ValueError:
+                return
+            self.rest_bucket.sync(size - used, capacity=size, refill_rate=size / 20)
+            metrics.RATE_LIMIT_AVAILABLE.labels(self.region, "rest").set((size - used) / size)
+
+    def _wait_before_retry(self, bucket, response, attempt):
+        retry_after = response.headers.get("Retry-After")
+        try:
+            delay = float(retry_after) if retry_after else backoff_delay(attempt)
+        except ValueError:
+            delay = backoff_delay(attempt)
+        if response.status_code == 429:
+            bucket.block(delay)
+        logger.warning("Shopify request retrying", extra={"store": self.region, "status": response.status_code, "delay": round(delay, 1)})
+        time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def graphql(self, query, variables=None):
+        """Send a GraphQL call paced by query cost, retrying when Shopify reports THROTTLED."""
+        payload = {"query": query, "variables": variables or {}}
+        for attempt in range(self.max_retries + 1):
+            # Spend what this query cost last time; unseen queries assume a modest cost
+            self.graphql_bucket.acquire(self._query_costs.get(query, 10))
+            # GraphQL is paced by cost alone; it does not draw on the REST call bucket
+            response = self._send("POST", "/graphql.json", None, json=payload)
+            if response.status_code != 200:
+                return response
+            try:
+                body = response.json()
+            except ValueError:
+                return response
+
+            cost = (body.get("extensions") or {}).get("cost") or {}
+            status = cost.get("throttleStatus")
+            if status:
+                self.graphql_bucket.sync(
+                    status["currentlyAvailable"],
+                    capacity=status["maximumAvailable"],
+                    refill_rate=status["restoreRate"],
+                )
+                metrics.RATE_LIMIT_AVAILABLE.labels(self.region, "graphql").set(
+                    status["currentlyAvailable"] / status["maximumAvailable"]
+                )
+            if cost.get("requestedQueryCost"):
+                self._query_costs[query] = cost["requestedQueryCost"]
+
+            throttled = any((error.get("extensions") or {}).get("code") == "THROTTLED" for error in body.get("errors") or [])
+            if not throttled or attempt == self.max_retries:
+                return response
+            delay = backoff_delay(attempt)
+            if status:
+                needed = cost.get("requestedQueryCost", 0) - status["currentlyAvailable"]
+                delay = max(delay, needed / status["restoreRate"])
+            logger.warning("GraphQL throttled, retrying", extra={"store": self.region, "delay": round(delay, 1)})
+            time.sleep(delay)
+        return response
+
+    def __repr__(self):
+        return f"ShopifyClient({self.region!r}, {self.shop_name!r})"
+
+
+def build_clients(store_configs):
+    """Create one pooled client per configured store."""
+    return {region: ShopifyClient.from_config(region, config) for region, config in store_configs.items()}
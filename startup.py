@@ -0,0 +1,115 @@
+"""Warm a freshly started process up before it is sent traffic.
+
+After a cold start the first Shopify call to each store pays DNS resolution
+and a TLS handshake. Warmup calls GET /shop.json on every store in a
+background thread, which does both and leaves the connections in the
+client's keep-alive pool. It also checks each store's credentials. /readyz
+reports not ready until this has finished or `timeout` seconds have passed.
+Stores that fail the check are logged and reported, but they do not hold
+readiness back: their writes go to the outbox like any other failure.
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+import requests
+import metrics
+from circuit import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """Warms every client with `connections` concurrent calls (0 skips them) and records how long startup took.
+
+    started_at is the time.perf_counter() reading taken when the process
+    began importing the app.
+    """
+
+    def __init__(self, clients, started_at, connections=2, timeout=30.0):
+        self.clients = clients
+        self.started_at = started_at
+        self.connections = connections
+        self.timeout = timeout
+        self.stores = {region: "pending" for region in clients}
+        self.timings = {}
+        self._done = threading.Event()
+        self._warm_started = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def mark(self, phase):
+        """Record the seconds from process start to the end of a startup phase."""
+        self.timings[phase] = round(time.perf_counter() - self.started_at, 3)
+        metrics.STARTUP_SECONDS.labels(phase).set(self.timings[phase])
+
+    def check_store(self, region, client):
+        try:
+            response = client.get("/shop.json")
+        except CircuitOpenError:
+            return "unreachable"
+        except requests.RequestException as e:
+            logger.warning("Store unreachable during warm-up", extra={"store": region, "error": repr(e)})
+            return "unreachable"
+        if response.status_code == 200:
+            return "ok"
+        if response.status_code in (401, 403):
+            logger.error("Store rejected its credentials", extra={"store": region, "status": response.status_code})
+            return "invalid_credentials"
+        logger.warning("Store check failed during warm-up", extra={"store": region, "status": response.status_code})
+        return "not_found" if response.status_code == 404 else "unreachable"
+
+    def warm(self):
+        warm_started = time.perf_counter()
+        # Concurrent calls open several pooled connections per store rather than reusing one
+        calls = [(region, client) for region, client in self.clients.items() for _ in range(self.connections)]
+        results = []
+        if calls:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(calls), thread_name_prefix="warmup") as executor:
+                results = list(executor.map(lambda call: (call[0], self.check_store(*call)), calls))
+        for region in self.clients:
+            statuses = [status for store, status in results if store == region]
+            self.stores[region] = "ok" if "ok" in statuses else (statuses or ["skipped"])[0]
+        self.mark("warm")
+        logger.info("Warm-up finished", extra={
+            "stores": self.stores, "seconds": round(time.perf_counter() - warm_started, 3), "startup": self.timings,
+        })
+
+    def start(self):
+        """Start warming up once per process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._done.clear()
+            self._warm_started = time.perf_counter()
+
+            def run():
+                try:
+                    self.warm()
+                except Exception:
+                    logger.exception("Warm-up failed")
+                finally:
+                    self._done.set()
+
+            threading.Thread(target=run, name="warmup", daemon=True).start()
+            self._pid = os.getpid()
+
+    def ready(self):
+        if self._pid != os.getpid():
+            return False
+        # A store that hangs must not keep the process out of rotation for good
+        return self._done.is_set() or time.perf_counter() - self._warm_started >= self.timeout
+
+    def status(self):
+        return {"ready": self.ready(), "stores": dict(self.stores), "startup_seconds": dict(self.timings)}
+
+
+def make_warmup(clients, started_at):
+    return Warmup(
+        clients, started_at,
+        connections=int(os.getenv("WARMUP_CONNECTIONS", "2")),
+        timeout=float(os.getenv("WARMUP_TIMEOUT", "30")),
+    )
@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteDB:
+    """One SQLite connection per thread, in WAL mode so several processes can share the file."""
+
+    def __init__(self, path, schema=()):
+        self.path = path
+        self._local = threading.local()
+        conn = self.conn()
+        for statement in schema:
+            conn.execute(statement)
+
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        # A connection opened before gunicorn forked must not be reused by the child
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.conn().execute(sql, params)
+
+    def add_columns(self, table, columns):
+        """Add the columns ({name: definition}) a table created by an older version lacks."""
+        existing = {row[1] for row in self.execute(f"PRAGMA table_info({table})")}
+        for name, definition in columns.items():
+            if name not in existing:
+                try:
+                    self.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                except sqlite3.OperationalError:
+                    pass  # another process added it first
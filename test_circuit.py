@@ -0,0 +1,71 @@
+"""Tests for the per-store circuit breaker and bulkhead. Run with `python -m unittest test_circuit`."""
+import threading
+import time
+import unittest
+from circuit import CLOSED, HALF_OPEN, OPEN, Bulkhead, CircuitBreaker, CircuitOpenError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.changes = []
+        self.breaker = CircuitBreaker("DUCO", failure_threshold=3, reset_timeout=0.05)
+        self.breaker.listeners.append(lambda name, state: self.changes.append((name, state)))
+
+    def fail(self, times):
+        for _ in range(times):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.before_call()
+        self.assertEqual(raised.exception.name, "DUCO")
+        self.assertGreater(raised.exception.retry_in, 0)
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_lets_one_probe_through_after_the_timeout(self):
+        self.fail(3)
+        time.sleep(0.06)
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.changes, [("DUCO", OPEN), ("DUCO", HALF_OPEN), ("DUCO", CLOSED)])
+
+    def test_failed_probe_reopens(self):
+        self.fail(3)
+        time.sleep(0.06)
+        self.fail(1)
+        self.assertEqual(self.breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+
+class BulkheadTest(unittest.TestCase):
+    def test_rejects_once_every_slot_is_taken(self):
+        bulkhead = Bulkhead(2, wait=0.01)
+        self.assertTrue(bulkhead.acquire())
+        self.assertTrue(bulkhead.acquire())
+        self.assertFalse(bulkhead.acquire())
+        self.assertEqual(bulkhead.stats(), {"slots": 2, "in_use": 2, "rejected": 1})
+        bulkhead.release()
+        self.assertTrue(bulkhead.acquire())
+
+    def test_waits_for_a_slot_to_free_up(self):
+        bulkhead = Bulkhead(1, wait=1.0)
+        bulkhead.acquire()
+        threading.Timer(0.02, bulkhead.release).start()
+        self.assertTrue(bulkhead.acquire())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+"""Tests for webhook coalescing, in memory and in the durable queue. Run with `python -m unittest test_coalesce`."""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from coalesce import Coalescer
+from job_queue import SQLiteQueue
+
+
+def delivery(version, product_id=1):
+    return {"id": product_id, "title": f"v{version}", "updated_at": f"2024-01-01T00:00:0{version}Z"}
+
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.emitted = []
+        self.done = threading.Event()
+
+    def emit(self, payload):
+        self.emitted.append(payload)
+        self.done.set()
+
+    def test_burst_is_synced_once_with_the_latest_payload(self):
+        coalescer = Coalescer(0.05, self.emit)
+        for version in (1, 3, 2):
+            coalescer.submit(1, delivery(version))
+        self.assertTrue(self.done.wait(1))
+        time.sleep(0.05)
+        self.assertEqual([payload["title"] for payload in self.emitted], ["v3"])
+        self.assertEqual(coalescer.stats(), {"window_seconds": 0.05, "received": 3, "collapsed": 2, "emitted": 1, "pending": 0})
+
+    def test_products_are_coalesced_separately(self):
+        coalescer = Coalescer(0.05, self.emit)
+        coalescer.submit(1, delivery(1, product_id=1))
+        coalescer.submit(2, delivery(1, product_id=2))
+        deadline = time.monotonic() + 1
+        while len(self.emitted) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(payload["id"] for payload in self.emitted), [1, 2])
+
+    def test_without_a_window_every_delivery_is_emitted(self):
+        coalescer = Coalescer(0, self.emit)
+        coalescer.submit(1, delivery(1))
+        coalescer.submit(1, delivery(2))
+        self.assertEqual(len(self.emitted), 2)
+        self.assertEqual(coalescer.stats()["emitted"], 2)
+
+
+class SQLiteQueueHoldTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = SQLiteQueue(os.path.join(self.tmp.name, "queue.db"), poll_interval=0.01)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_burst_collapses_into_one_job_with_the_latest_payload(self):
+        self.assertFalse(self.queue.hold(1, delivery(1), 0))
+        self.assertTrue(self.queue.hold(1, delivery(3), 0))
+        self.assertTrue(self.queue.hold(1, delivery(2), 0))
+        self.assertEqual(self.queue.size(), 1)
+        job_id, payload = self.queue.get(timeout=0)
+        self.assertEqual(payload["title"], "v3")
+        self.queue.ack(job_id)
+        self.assertEqual(self.queue.size(), 0)
+
+    def test_held_job_is_not_claimed_before_its_delay(self):
+        self.queue.hold(1, delivery(1), 60)
+        self.assertIsNone(self.queue.get(timeout=0))
+        self.queue.put(delivery(1, product_id=2))
+        self.assertEqual(self.queue.get(timeout=0)[1]["id"], 2)
+
+    def test_delivery_after_the_claim_gets_a_job_of_its_own(self):
+        self.queue.hold(1, delivery(1), 0)
+        job_id, _ = self.queue.get(timeout=0)
+        self.assertFalse(self.queue.hold(1, delivery(2), 0))
+        self.queue.ack(job_id)
+        self.assertEqual(self.queue.get(timeout=0)[1]["title"], "v2")
+
+    def test_coalescer_counts_collapsed_deliveries(self):
+        coalescer = Coalescer(60, self.queue.put, hold=self.queue.hold)
+        for version in (1, 2, 3):
+            coalescer.submit(1, delivery(version))
+        self.assertEqual(self.queue.size(), 1)
+        self.assertEqual(coalescer.stats()["collapsed"], 2)
+        self.assertEqual(coalescer.stats()["emitted"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Tests for webhook deduplication. Run with `python -m unittest test_dedup`."""
+import os
+import tempfile
+import unittest
+from coalesce import is_older
+from dedup import DUPLICATE, STALE, MemoryDeduplicator, SQLiteDeduplicator, timestamp_seconds, updated_at_seconds
+
+
+class TimestampTest(unittest.TestCase):
+    def test_parses_shopify_timestamps(self):
+        self.assertEqual(timestamp_seconds("2024-01-01T00:00:00Z"), 1704067200.0)
+        self.assertEqual(timestamp_seconds("2024-01-01T01:00:00+01:00"), 1704067200.0)
+        self.assertEqual(updated_at_seconds({"updated_at": "2024-01-01T00:00:00-00:00"}), 1704067200.0)
+
+    def test_missing_or_malformed_timestamps_are_none(self):
+        for value in (None, "", "yesterday", 42):
+            self.assertIsNone(timestamp_seconds(value))
+        self.assertIsNone(updated_at_seconds({}))
+        self.assertIsNone(updated_at_seconds(None))
+
+    def test_unknown_timestamps_are_never_older(self):
+        self.assertTrue(is_older({"updated_at": "2024-01-01T00:00:00Z"}, {"updated_at": "2024-01-02T00:00:00Z"}))
+        self.assertFalse(is_older({"updated_at": "2024-01-02T00:00:00Z"}, {"updated_at": "2024-01-01T00:00:00Z"}))
+        self.assertFalse(is_older({}, {"updated_at": "2024-01-02T00:00:00Z"}))
+        self.assertFalse(is_older({"updated_at": "2024-01-01T00:00:00Z"}, {"updated_at": "bad"}))
+
+
+class DeduplicatorTests:
+    """Shared by both backends; make() returns a deduplicator holding at most two entries per table."""
+
+    def test_redelivery_is_duplicate(self):
+        dedup = self.make()
+        self.assertIsNone(dedup.check("w1", 1, 100.0))
+        self.assertEqual(dedup.check("w1", 1, 100.0), DUPLICATE)
+        self.assertEqual(dedup.stats()["duplicates"], 1)
+
+    def test_older_payload_is_stale(self):
+        dedup = self.make()
+        self.assertIsNone(dedup.check("w1", 1, 200.0))
+        self.assertEqual(dedup.check("w2", 1, 100.0), STALE)
+        self.assertIsNone(dedup.check("w3", 2, 100.0))
+        self.assertEqual(dedup.stats()["stale"], 1)
+
+    def test_same_version_is_only_stale_when_strict(self):
+        dedup = self.make()
+        self.assertIsNone(dedup.check("w1", 1, 100.0))
+        self.assertIsNone(dedup.check("w2", 1, 100.0))
+        self.assertEqual(dedup.check(None, 1, 100.0, strict=True), STALE)
+        self.assertIsNone(dedup.check(None, 1, 101.0, strict=True))
+
+    def test_stale_delivery_does_not_record_its_webhook_id(self):
+        dedup = self.make()
+        dedup.check("w1", 1, 200.0)
+        self.assertEqual(dedup.check("w2", 1, 100.0), STALE)
+        self.assertIsNone(dedup.check("w2", 2, 100.0))
+
+    def test_missing_timestamp_skips_the_version_check(self):
+        dedup = self.make()
+        self.assertIsNone(dedup.check("w1", 1, 200.0))
+        self.assertIsNone(dedup.check("w2", 1, None))
+        self.assertEqual(dedup.check("w3", 1, 100.0), STALE)
+
+    def test_oldest_entries_are_evicted(self):
+        dedup = self.make()
+        for n in range(3):
+            dedup.check(f"w{n}", n, 100.0)
+        dedup.flush()
+        self.assertIsNone(dedup.check("w0", 0, 50.0))
+
+
+class MemoryDeduplicatorTest(DeduplicatorTests, unittest.TestCase):
+    def make(self):
+        dedup = MemoryDeduplicator(max_entries=2)
+        dedup.flush = lambda: None
+        return dedup
+
+
+class SQLiteDeduplicatorTest(DeduplicatorTests, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make(self):
+        dedup = SQLiteDeduplicator(os.path.join(self.tmp.name, "dedup.db"), max_entries=2)
+        # Eviction otherwise only runs every 1000 writes
+        dedup.flush = dedup._evict
+        return dedup
+
+    def test_shared_between_instances(self):
+        path = os.path.join(self.tmp.name, "dedup.db")
+        self.assertIsNone(SQLiteDeduplicator(path).check("w1", 1, 100.0))
+        self.assertEqual(SQLiteDeduplicator(path).check("w1", 1, 100.0), DUPLICATE)
+
+
+if __name__ == "__main__":
+    unittest.main()
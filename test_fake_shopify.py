@@ -0,0 +1,59 @@
+"""Tests for the local Shopify stand-in. Run with `python -m unittest test_fake_shopify`."""
+import unittest
+from fake_shopify import FakeShopify, create_app, destination_product_id
+
+MUTATION = (
+    "mutation syncProduct($input: ProductInput!, $productId: ID!, $variants: [ProductVariantsBulkInput!]!) { "
+    "productUpdate(input: $input) { userErrors { field message } } "
+    "productVariantsBulkUpdate(productId: $productId, variants: $variants) { userErrors { field message } } }"
+)
+
+
+class GraphQLWritesTest(unittest.TestCase):
+    def setUp(self):
+        self.shop = FakeShopify(products=2, rate_limit=False)
+        self.client = create_app(self.shop).test_client()
+        self.product_id = destination_product_id(0, 1)
+        self.gid = f"gid://shopify/Product/{self.product_id}"
+
+    def write(self, variants):
+        variables = {
+            "input": {"id": self.gid, "title": "Product 1", "productType": "Brakes", "status": "DRAFT", "metafields": [
+                {"namespace": "shipping_information", "key": "shipping_label", "value": "Oversize", "type": "single_line_text_field"},
+            ]},
+            "productId": self.gid,
+            "variants": variants,
+        }
+        return self.client.post("/duco/admin/api/2024-07/graphql.json", json={"query": MUTATION, "variables": variables}).get_json()
+
+    def read(self):
+        return self.client.get(f"/duco/admin/api/2024-07/products/{self.product_id}.json").get_json()["product"]
+
+    def test_product_and_variant_writes_land_in_the_store(self):
+        variant_id = self.read()["variants"][1]["id"]
+        body = self.write([{
+            "id": f"gid://shopify/ProductVariant/{variant_id}",
+            "inventoryPolicy": "CONTINUE",
+            "inventoryItem": {"measurement": {"weight": {"value": 250.0, "unit": "GRAMS"}}},
+        }])
+        self.assertEqual(body["data"]["productVariantsBulkUpdate"]["userErrors"], [])
+        product = self.read()
+        self.assertEqual((product["title"], product["vendor"], product["product_type"], product["status"]),
+                         ("Product 1", "BMW", "Brakes", "draft"))
+        self.assertEqual(self.shop.labels["duco"][self.product_id], "Oversize")
+        changed, unchanged = product["variants"][1], product["variants"][0]
+        self.assertEqual((changed["inventory_policy"], changed["weight"], changed["weight_unit"]), ("continue", 250.0, "g"))
+        self.assertEqual((unchanged["inventory_policy"], unchanged["weight"], unchanged["weight_unit"]), ("deny", 1.5, "kg"))
+
+    def test_unknown_variant_is_rejected_and_no_variant_changes(self):
+        variant_id = self.read()["variants"][0]["id"]
+        body = self.write([
+            {"id": f"gid://shopify/ProductVariant/{variant_id}", "inventoryPolicy": "CONTINUE"},
+            {"id": "gid://shopify/ProductVariant/1", "inventoryPolicy": "CONTINUE"},
+        ])
+        self.assertEqual(body["data"]["productVariantsBulkUpdate"]["userErrors"][0]["field"], ["variants", "1", "id"])
+        self.assertEqual({variant["inventory_policy"] for variant in self.read()["variants"]}, {"deny"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests for the durable job queue and its workers. Run with `python -m unittest test_job_queue`."""
+import os
+import tempfile
+import threading
+import time
+import unittest
+from job_queue import SQLiteQueue, WorkerPool
+
+
+class SQLiteQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "queue.db")
+        self.queue = SQLiteQueue(self.path, claim_timeout=0.05, poll_interval=0.01)
+        # Another worker process sharing the file
+        self.other = SQLiteQueue(self.path, claim_timeout=0.05, poll_interval=0.01)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_stale_claim_is_handed_out_again(self):
+        self.queue.put({"id": 1})
+        job_id, _ = self.queue.get(timeout=0)
+        self.assertIsNone(self.other.get(timeout=0))
+        time.sleep(0.06)
+        self.assertEqual(self.other.get(timeout=0)[0], job_id)
+
+    def test_renewed_claim_is_not_handed_out(self):
+        self.queue.put({"id": 1})
+        job_id, _ = self.queue.get(timeout=0)
+        time.sleep(0.04)
+        self.assertTrue(self.queue.renew(job_id))
+        time.sleep(0.02)
+        self.assertIsNone(self.other.get(timeout=0))
+
+    def test_claim_taken_by_another_worker_cannot_be_renewed(self):
+        self.queue.put({"id": 1})
+        job_id, _ = self.queue.get(timeout=0)
+        time.sleep(0.06)
+        self.other.get(timeout=0)
+        self.assertFalse(self.queue.renew(job_id))
+        self.assertTrue(self.other.renew(job_id))
+
+    def test_batch_skips_a_job_another_worker_took_over(self):
+        for product_id in (1, 2):
+            self.queue.put({"id": product_id})
+        handled, taken = [], []
+        done = threading.Event()
+
+        def handler(payload):
+            handled.append(payload["id"])
+            if payload["id"] == 1:
+                # Slow enough for the batch's claims to go stale and another worker to pick them up
+                time.sleep(0.06)
+                taken.extend(self.other.get(timeout=0)[1]["id"] for _ in range(2))
+                threading.Timer(0.05, done.set).start()
+
+        WorkerPool(self.queue, handler, 1, prefetch=lambda payloads: None, batch_size=2).start()
+        self.assertTrue(done.wait(2))
+        self.assertEqual((handled, taken), ([1], [1, 2]))
+        # Job 1 was acked by the worker that ran it; job 2 is left to the worker that holds it now
+        self.assertEqual(self.queue.size(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Tests for the bulk-export JSONL readers. Run with `python -m unittest test_jsonl`."""
+import io
+import json
+import unittest
+from jsonl import iter_jsonl, stitch
+
+
+def child_key(obj):
+    return "variants" if "sku" in obj else "metafields"
+
+
+def lines(*objects):
+    return io.BytesIO("\n".join(json.dumps(obj) for obj in objects).encode() + b"\n\n")
+
+
+class StitchTest(unittest.TestCase):
+    def test_children_are_attached_to_their_parents(self):
+        objects = iter_jsonl(lines(
+            {"id": "P1", "title": "One"},
+            {"id": "V1", "sku": "A", "__parentId": "P1"},
+            {"id": "M1", "key": "duco_product_id", "__parentId": "P1"},
+            {"id": "P2", "title": "Two"},
+            {"id": "V2", "sku": "B", "__parentId": "P2"},
+            {"id": "V3", "sku": "C", "__parentId": "P1"},
+        ))
+        self.assertEqual(list(stitch(objects, child_key)), [
+            {"id": "P1", "title": "One", "variants": [{"id": "V1", "sku": "A"}, {"id": "V3", "sku": "C"}],
+             "metafields": [{"id": "M1", "key": "duco_product_id"}]},
+            {"id": "P2", "title": "Two", "variants": [{"id": "V2", "sku": "B"}]},
+        ])
+
+    def test_parents_leave_the_window_in_order(self):
+        objects = [{"id": f"P{n}"} for n in range(4)]
+        stitched = stitch(iter(objects), child_key, window=2)
+        self.assertEqual(next(stitched), {"id": "P0"})
+        self.assertEqual([parent["id"] for parent in stitched], ["P1", "P2", "P3"])
+
+    def test_children_without_an_open_parent_are_skipped(self):
+        objects = [
+            {"id": "V0", "sku": "A", "__parentId": "P1"},
+            {"id": "P1"},
+            {"id": "P2"},
+            {"id": "V1", "sku": "B", "__parentId": "P1"},
+        ]
+        with self.assertLogs("jsonl", "WARNING") as logs:
+            stitched = list(stitch(iter(objects), child_key, window=1))
+        self.assertEqual(stitched, [{"id": "P1"}, {"id": "P2"}])
+        self.assertEqual(logs.records[0].orphans, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
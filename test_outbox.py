@@ -0,0 +1,94 @@
+"""Tests for the retry outbox. Run with `python -m unittest test_outbox`."""
+import os
+import tempfile
+import time
+import unittest
+from outbox import Deferred, Outbox
+
+
+def payload(version):
+    return {"source_data": {"id": 1, "title": f"v{version}"}, "shipping_label": "Standard"}
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.outbox = Outbox(os.path.join(self.tmp.name, "outbox.db"), max_attempts=2, base_delay=0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def pending(self):
+        return [entry["payload"]["source_data"]["title"] for entry in self.outbox.entries()]
+
+    def test_newer_write_replaces_older(self):
+        self.outbox.add("DUCO", 1, 101, payload(1), "failed", updated_at=1.0)
+        self.outbox.add("DUCO", 1, 101, payload(2), "failed", updated_at=2.0)
+        self.assertEqual(self.pending(), ["v2"])
+
+    def test_older_write_does_not_replace_newer(self):
+        self.outbox.add("DUCO", 1, 101, payload(2), "failed", updated_at=2.0)
+        self.assertIsNone(self.outbox.add("DUCO", 1, 101, payload(1), "failed", updated_at=1.0))
+        self.assertEqual(self.pending(), ["v2"])
+
+    def test_same_write_is_queued_once(self):
+        first = self.outbox.add("DUCO", 1, 101, payload(1), "failed", updated_at=1.0)
+        second = self.outbox.add("DUCO", 1, 101, payload(1), "failed again", updated_at=1.0)
+        self.assertEqual(first, second)
+        self.assertEqual(self.outbox.size(), 1)
+
+    def test_resolve_drops_versions_no_newer_than_written(self):
+        self.outbox.add("DUCO", 1, 101, payload(1), "failed", updated_at=1.0)
+        self.outbox.add("EU", 1, 201, payload(1), "failed", updated_at=1.0)
+        self.outbox.resolve("DUCO", 101, time.time(), updated_at=1.0)
+        self.assertEqual([entry["region"] for entry in self.outbox.entries()], ["EU"])
+
+    def test_resolve_keeps_newer_write_added_during_retry(self):
+        # The retry thread claims v1 and starts writing it ...
+        self.outbox.add("DUCO", 1, 101, payload(1), "failed", updated_at=1.0)
+        [claimed] = self.outbox.claim_due()
+        started_at = time.time()
+        # ... while a sync of v2 fails and replaces the v1 entry ...
+        self.outbox.add("DUCO", 1, 101, payload(2), "failed", updated_at=2.0)
+        # ... and then the v1 write succeeds
+        self.outbox.resolve("DUCO", 101, started_at, updated_at=1.0)
+        self.outbox.succeeded(claimed)
+        self.assertEqual(self.pending(), ["v2"])
+
+    def test_resolve_without_versions_keeps_entries_added_after_the_write_started(self):
+        self.outbox.add("DUCO", 1, 101, payload(1), "failed")
+        started_at = time.time()
+        time.sleep(0.01)
+        self.outbox.add("DUCO", 1, 101, payload(2), "failed")
+        self.outbox.resolve("DUCO", 101, started_at)
+        self.assertEqual(self.pending(), ["v2"])
+        self.outbox.resolve("DUCO", 101, time.time())
+        self.assertEqual(self.pending(), [])
+
+    def test_failures_dead_letter_and_replay(self):
+        self.outbox.add("DUCO", 1, 101, payload(1), "failed", updated_at=1.0)
+        for _ in range(2):
+            self.outbox.drain(lambda entry: "still failing")
+            self.outbox.db.execute("UPDATE outbox SET next_attempt_at = 0")
+        self.assertEqual((self.outbox.size(), self.outbox.dead_letter_size()), (0, 1))
+        [dead] = self.outbox.entries(dead=True)
+        self.assertEqual((dead["attempts"], dead["last_error"], dead["updated_at"]), (2, "still failing", 1.0))
+
+        self.assertEqual(self.outbox.replay(), 1)
+        self.assertEqual(self.outbox.drain(lambda entry: None), 1)
+        self.assertEqual((self.outbox.size(), self.outbox.dead_letter_size()), (0, 0))
+
+    def test_deferred_entries_do_not_count_attempts(self):
+        self.outbox.add("DUCO", 1, 101, payload(1), "parked")
+
+        def unavailable(entry):
+            raise Deferred("circuit open", 60)
+
+        self.outbox.drain(unavailable)
+        [entry] = self.outbox.entries()
+        self.assertEqual((entry["attempts"], entry["last_error"]), (0, "circuit open"))
+        self.assertEqual(self.outbox.claim_due(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Tests for the polling reconciler. Run with `python -m unittest test_reconcile`."""
+import argparse
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from reconcile import Reconciler, aware_timestamp
+
+
+class Response:
+    status_code = 200
+    links = {}
+
+    def __init__(self, products):
+        self.products = products
+
+    def json(self):
+        return {"products": self.products}
+
+
+class Client:
+    region = "UK"
+
+    def __init__(self, products):
+        self.products = products
+        self.params = []
+
+    def get(self, path, params=None):
+        self.params.append(params)
+        return Response(self.products)
+
+
+class ReconcileCursorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.client = Client([{"id": 1, "updated_at": "2024-05-01T10:00:00Z"}])
+        self.submitted = []
+        self.reconciler = Reconciler(
+            self.client, lambda product: self.submitted.append(product) or True,
+            os.path.join(self.tmp.name, "reconcile.db"), os.path.join(self.tmp.name, "reconcile.lock"),
+            settle=0, overlap=60,
+        )
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_since_needs_an_offset(self):
+        self.assertEqual(aware_timestamp("2024-05-01T00:00:00Z"), datetime(2024, 5, 1, tzinfo=timezone.utc))
+        for value in ("2024-05-01T00:00:00", "2024-05-01", "yesterday"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                aware_timestamp(value)
+        with self.assertRaises(ValueError):
+            self.reconciler.reset(datetime(2024, 5, 1))
+
+    def test_pass_starts_an_overlap_before_the_reset_cursor(self):
+        self.reconciler.reset(aware_timestamp("2024-05-01T01:00:00+01:00"))
+        summary = self.reconciler.run(force=True)
+        self.assertEqual(self.client.params[0]["updated_at_min"], "2024-04-30T23:59:00+00:00")
+        self.assertTrue(summary["complete"])
+        self.assertEqual(len(self.submitted), 1)
+
+    def test_naive_cursor_saved_earlier_is_read_as_utc(self):
+        self.reconciler._save("2024-05-01T00:00:00")
+        self.assertTrue(self.reconciler.run(force=True)["complete"])
+        self.assertEqual(self.client.params[0]["updated_at_min"], "2024-04-30T23:59:00+00:00")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+"""Tests for the capture replayer. Run with `python -m unittest test_replay`."""
+import os
+import tempfile
+import unittest
+from unittest import mock
+from replay import configure_environment
+
+
+class ConfigureEnvironmentTest(unittest.TestCase):
+    def test_pipeline_settings_from_the_environment_are_overridden(self):
+        production = {
+            "COALESCE_WINDOW": "2", "FANOUT_MODE": "threads", "QUEUE_BACKEND": "sqlite", "DEDUP_BACKEND": "sqlite",
+            "CACHE_BACKEND": "sqlite", "RECONCILE_INTERVAL": "900", "UK_BASE_URL": "https://uk.example", "LOG_LEVEL": "DEBUG",
+        }
+        with tempfile.TemporaryDirectory() as work_dir, mock.patch.dict(os.environ, production):
+            os.environ.pop("REGION_MAPPINGS_FILE", None)
+            os.environ.pop("REGION_MAPPINGS", None)
+            configure_environment(work_dir)
+            self.assertEqual(
+                {key: os.environ[key] for key in production},
+                {"COALESCE_WINDOW": "0", "FANOUT_MODE": "serial", "QUEUE_BACKEND": "memory", "DEDUP_BACKEND": "memory",
+                 "CACHE_BACKEND": "memory", "RECONCILE_INTERVAL": "0", "UK_BASE_URL": "http://replay/uk", "LOG_LEVEL": "DEBUG"},
+            )
+            self.assertEqual(os.environ["QUEUE_PATH"], os.path.join(work_dir, "sync_queue.db"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""Tests for the bulk catalog resync. Run with `python -m unittest test_resync`."""
+import io
+import unittest
+from contextlib import redirect_stdout
+from unittest import mock
+from field_mappings import compile_mappings
+import test_sync
+import resync
+
+# app.py as test_sync imports it, in a scratch directory that is removed after these tests too
+app = test_sync.app
+tearDownModule = test_sync.tearDownModule
+
+
+class Writer:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, obj):
+        self.lines.append(obj)
+
+
+class ResyncMappingsTest(unittest.TestCase):
+    def use(self, regions):
+        """Swap in another mapping config for app.py and resync.py, which share it."""
+        compiled = compile_mappings({"source": "UK", "regions": regions})
+        for module in (app, resync):
+            patcher = mock.patch.object(module, "region_mappings", compiled)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_default_mappings_are_exported(self):
+        self.assertEqual([resync.unexported_fields(region) for region in resync.region_mappings.regions], [[], [], []])
+
+    def test_resync_refuses_a_field_the_export_doesnt_read(self):
+        self.use({"DUCO": {"product": ["title", "tags"], "variant": [{"name": "weight", "source": "grams"}]}})
+        self.assertEqual(resync.unexported_fields("DUCO"), ["tags", "variant.grams"])
+        with mock.patch.object(resync, "export_products") as export, redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(resync.main(["--regions", "DUCO", "--dry-run"]), 1)
+        export.assert_not_called()
+        self.assertIn("DUCO maps tags, variant.grams", out.getvalue())
+
+    def test_plan_uses_a_custom_mapping(self):
+        self.use({"DUCO": {"product": [{"name": "title", "source": "vendor", "transform": "upper"}], "variant": ["weight"]}})
+        source = {"id": 1, "title": "Bolt", "vendor": "bmw", "destination_ids": {"DUCO": "100"}, "shipping_label": "",
+                  "variants": [{"id": 11, "sku": "A", "weight": 2.0}]}
+        destination = {"id": 100, "title": "Bolt", "vendor": "bmw", "shipping_label": "",
+                       "variants": [{"id": 110, "sku": "A", "weight": 1.0}]}
+        products, variants = Writer(), Writer()
+        counts = resync.plan_region("DUCO", [source], {"100": destination}, products, variants)
+        self.assertEqual(counts, {"linked": 1, "missing": 0, "unchanged": 0, "changed": 1, "unsupported": 0})
+        self.assertEqual(products.lines, [{"input": {"id": "gid://shopify/Product/100", "title": "BMW"}}])
+        self.assertEqual(variants.lines, [{"productId": "gid://shopify/Product/100", "variants": [{
+            "id": "gid://shopify/ProductVariant/110",
+            "inventoryItem": {"measurement": {"weight": {"value": 2.0, "unit": "KILOGRAMS"}}},
+        }]}])
+
+
+if __name__ == "__main__":
+    unittest.main()
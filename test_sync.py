@@ -0,0 +1,235 @@
+"""Tests for the sync pipeline in app.py. Run with `python -m unittest test_sync`."""
+import base64
+import hashlib
+import hmac
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import requests
+from replay import configure_environment
+
+# app.py reads its settings and opens its stores at import time: keep them in a scratch directory,
+# with the default mappings and every store pointed away from Shopify
+WORK_DIR = tempfile.mkdtemp(prefix="test-sync-")
+for key in ("REGION_MAPPINGS_FILE", "REGION_MAPPINGS"):
+    os.environ.pop(key, None)
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+configure_environment(WORK_DIR)
+import app  # noqa: E402
+
+
+def tearDownModule():
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+def variant(variant_id, sku, weight=1, **fields):
+    return {"id": variant_id, "sku": sku, "weight": weight, "weight_unit": "kg", "inventory_policy": "deny", **fields}
+
+
+class MatchVariantsTest(unittest.TestCase):
+    def test_pairs_variants_by_sku_in_source_order(self):
+        source = [variant(1, "A"), variant(2, "B"), variant(3, "C")]
+        destination = [variant(30, "C"), variant(10, "A"), variant(20, "B")]
+        matches, unmatched = app.match_variants_by_sku(source, destination)
+        self.assertEqual([(src["id"], dest["id"]) for src, dest in matches], [(1, 10), (2, 20), (3, 30)])
+        self.assertEqual(unmatched, [])
+
+    def test_reports_source_variants_without_a_match(self):
+        source = [variant(1, "A"), variant(2, "MISSING"), variant(3, None), variant(4, "")]
+        matches, unmatched = app.match_variants_by_sku(source, [variant(10, "A"), variant(11, None)])
+        self.assertEqual([(src["id"], dest["id"]) for src, dest in matches], [(1, 10)])
+        self.assertEqual(unmatched, ["MISSING", None, ""])
+
+    def test_repeated_source_sku_uses_its_first_variant(self):
+        source = [variant(1, "A", weight=1), variant(2, "A", weight=2)]
+        with self.assertLogs("app", "WARNING"):
+            matches, unmatched = app.match_variants_by_sku(source, [variant(10, "A")])
+        self.assertEqual([(src["id"], dest["id"]) for src, dest in matches], [(1, 10)])
+        self.assertEqual(unmatched, [])
+
+    def test_every_destination_variant_sharing_a_sku_is_updated(self):
+        matches, _ = app.match_variants_by_sku([variant(1, "A")], [variant(10, "A"), variant(11, "A")])
+        self.assertEqual([(src["id"], dest["id"]) for src, dest in matches], [(1, 10), (1, 11)])
+
+    def test_update_data_uses_destination_variant_ids(self):
+        source = {"id": 1, "title": "T", "vendor": "V", "product_type": "P", "status": "active"}
+        updated = app.build_update_data(
+            "DUCO", source, [variant(1, "A", weight=5), variant(2, "B")], [variant(20, "B"), variant(10, "A")],
+        )
+        self.assertEqual(updated["product"]["variants"], [
+            {"id": 10, "weight": 5, "weight_unit": "kg", "inventory_policy": "deny"},
+            {"id": 20, "weight": 1, "weight_unit": "kg", "inventory_policy": "deny"},
+        ])
+
+
+class DiffUpdateDataTest(unittest.TestCase):
+    def setUp(self):
+        self.destination = {
+            "id": 100, "title": "Bolt", "vendor": "BMW", "product_type": "Parts", "status": "active",
+            "variants": [variant(10, "A", weight=1.0), variant(20, "B", weight=2)],
+        }
+
+    def update(self, **fields):
+        product = {
+            "id": 100, "title": "Bolt", "vendor": "BMW", "product_type": "Parts", "status": "active",
+            "variants": [
+                {"id": 10, "weight": 1, "weight_unit": "kg", "inventory_policy": "deny"},
+                {"id": 20, "weight": 2, "weight_unit": "kg", "inventory_policy": "deny"},
+            ],
+        }
+        product.update(fields)
+        return {"product": product}
+
+    def test_unchanged_payload_needs_no_write(self):
+        self.assertIsNone(app.diff_update_data(self.update(), self.destination))
+
+    def test_only_changed_product_fields_are_sent(self):
+        diff = app.diff_update_data(self.update(title="Nut", vendor="BMW"), self.destination)
+        self.assertEqual(diff, {"product": {"id": 100, "title": "Nut"}})
+
+    def test_changed_variant_keeps_its_siblings_ids(self):
+        updated = self.update()
+        updated["product"]["variants"][1]["inventory_policy"] = "continue"
+        diff = app.diff_update_data(updated, self.destination)
+        self.assertEqual(diff, {"product": {"id": 100, "variants": [{"id": 10}, {"id": 20, "inventory_policy": "continue"}]}})
+
+    def test_weight_is_sent_with_its_unit(self):
+        updated = self.update()
+        updated["product"]["variants"][0]["weight"] = 3
+        diff = app.diff_update_data(updated, self.destination)
+        self.assertEqual(diff["product"]["variants"][0], {"id": 10, "weight": 3, "weight_unit": "kg"})
+
+    def test_variant_missing_from_the_destination_is_sent_in_full(self):
+        updated = self.update()
+        updated["product"]["variants"].append({"id": 30, "weight": 1, "weight_unit": "kg", "inventory_policy": "deny"})
+        diff = app.diff_update_data(updated, self.destination)
+        self.assertEqual(diff["product"]["variants"][2], {"id": 30, "weight": 1, "weight_unit": "kg", "inventory_policy": "deny"})
+
+
+class WriteRegionTest(unittest.TestCase):
+    source_data = {
+        "id": 1, "title": "Bolt", "vendor": "BMW", "product_type": "Parts", "status": "active",
+        "variants": [variant(1, "A", weight=3)],
+    }
+
+    def setUp(self):
+        self.writes = []
+        for name in ("update_product_in_destination", "update_product_metafield", "update_product_graphql"):
+            patcher = mock.patch.object(app, name, side_effect=lambda *args, name=name: self.writes.append(name) or True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sync(self):
+        return app.sync_region("DUCO", app.clients["DUCO"], app.clients["UK"], self.source_data, 100, "Standard")
+
+    def test_failed_destination_read_writes_nothing(self):
+        with mock.patch.object(app, "get_product_details", return_value=None):
+            result = self.sync()
+        self.assertEqual((result["status"], result["product"], result["metafield"]), ("failed", "failed", "skipped"))
+        self.assertEqual(self.writes, [])
+
+    def test_read_destination_is_diffed(self):
+        destination = {"id": 100, "title": "Bolt", "vendor": "BMW", "product_type": "Parts", "status": "active",
+                       "shipping_label": "Standard", "variants": [variant(10, "A", weight=1)]}
+        with mock.patch.object(app, "get_product_details", return_value=destination):
+            result = self.sync()
+        self.assertEqual((result["status"], result["product"], result["metafield"]), ("updated", "updated", "unchanged"))
+        self.assertEqual(self.writes, ["update_product_in_destination"])
+        written = app.update_product_in_destination.call_args.args[3]
+        self.assertEqual(written, {"product": {"id": 1, "variants": [{"id": 10, "weight": 3, "weight_unit": "kg"}]}})
+
+
+class LinksTest(unittest.TestCase):
+    links = {"destination_ids": {"DUCO": "100"}, "shipping_label": "Standard"}
+
+    def test_newer_webhook_keeps_the_stored_links(self):
+        app.mappings.put_links(7, self.links)
+        app.invalidate_if_newer(app.clients["UK"], 7, "2999-01-01T00:00:00Z")
+        self.assertEqual(app.mappings.get_links(7), self.links)
+
+    def test_failed_write_forgets_the_links(self):
+        app.mappings.put_links(7, self.links)
+        app.forget_destination(app.clients["DUCO"], 7, 100)
+        self.assertIsNone(app.mappings.get_links(7))
+
+    def test_label_is_taken_from_the_payload_when_it_carries_one(self):
+        metafields = [
+            {"namespace": "custom", "key": "duco_product_id", "value": "100"},
+            {"namespace": "shipping_information", "key": "shipping_label", "value": "Oversize"},
+        ]
+        self.assertEqual(app.payload_shipping_label({"id": 7, "metafields": metafields}), "Oversize")
+        self.assertIsNone(app.payload_shipping_label({"id": 7, "metafields": metafields[:1]}))
+        self.assertIsNone(app.payload_shipping_label({"id": 7}))
+
+
+class SyncProductTest(unittest.TestCase):
+    product_id = 4242
+
+    def setUp(self):
+        links = {"destination_ids": {"DUCO": "100", "EU": "200"}, "shipping_label": "Standard"}
+        for target, value in {"FANOUT_MODE": "serial", "SYNC_REGIONS": ["DUCO", "EU"]}.items():
+            patcher = mock.patch.object(app, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app, "get_product_metafields", return_value=links)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for region, dest_product_id in (("DUCO", 100), ("EU", 200)):
+            app.outbox.resolve(region, dest_product_id, float("inf"))
+
+    def test_destination_that_raises_is_queued_and_the_rest_still_sync(self):
+        def sync_region(region, client, source_client, source_data, dest_product_id, shipping_label):
+            if region == "DUCO":
+                raise requests.ConnectionError("DUCO unreachable")
+            return {"status": "updated", "product_id": dest_product_id}
+
+        with mock.patch.object(app, "sync_region", side_effect=sync_region):
+            results = app.sync_product({"id": self.product_id, "title": "Bolt", "updated_at": "2024-01-01T00:00:00Z"})
+        self.assertEqual({region: result["status"] for region, result in results.items()}, {"DUCO": "error", "EU": "updated"})
+        [entry] = [entry for entry in app.outbox.entries() if entry["source_product_id"] == str(self.product_id)]
+        self.assertEqual((entry["region"], entry["dest_product_id"]), ("DUCO", "100"))
+        self.assertIn("DUCO unreachable", entry["last_error"])
+
+
+class WebhookEndpointTest(unittest.TestCase):
+    secret = "shpss_test"
+
+    def setUp(self):
+        for target, value in {"WEBHOOK_SECRET": self.secret, "coalescer": mock.Mock()}.items():
+            patcher = mock.patch.object(app, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, body, signature=None):
+        headers = {"X-Shopify-Hmac-Sha256": signature} if signature else {}
+        # Called directly rather than through the test client, so the app's background threads aren't started
+        with app.app.test_request_context("/webhook/product-update", method="POST", data=body, headers=headers):
+            response, status = app.product_update_webhook()
+        return status, response.get_json()
+
+    def sign(self, body):
+        return base64.b64encode(hmac.new(self.secret.encode(), body, hashlib.sha256).digest()).decode()
+
+    def test_signed_delivery_is_queued(self):
+        body = b'{"id": 5151, "updated_at": "2024-01-01T00:00:00Z"}'
+        self.assertEqual(self.post(body, self.sign(body))[0], 200)
+        app.coalescer.submit.assert_called_once_with(5151, {"id": 5151, "updated_at": "2024-01-01T00:00:00Z"})
+
+    def test_bad_or_missing_signature_is_rejected(self):
+        body = b'{"id": 5152}'
+        self.assertEqual(self.post(body, self.sign(b'{"id": 1}'))[0], 401)
+        self.assertEqual(self.post(body)[0], 401)
+        app.coalescer.submit.assert_not_called()
+
+    def test_signed_body_that_is_not_an_object_is_rejected(self):
+        for body in (b"[1, 2]", b"null", b"{not json"):
+            self.assertEqual(self.post(body, self.sign(body))[0], 400)
+        app.coalescer.submit.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
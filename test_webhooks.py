@@ -0,0 +1,47 @@
+"""Tests for webhook signature checks and body parsing. Run with `python -m unittest test_webhooks`."""
+import base64
+import hashlib
+import hmac
+import unittest
+from webhooks import parse_body, verify_hmac
+
+SECRET = "shpss_test"
+BODY = b'{"id": 1, "title": "Bolt"}'
+
+
+def sign(body, secret=SECRET):
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+class VerifyHmacTest(unittest.TestCase):
+    def test_valid_signature(self):
+        self.assertTrue(verify_hmac(BODY, sign(BODY), SECRET))
+
+    def test_signature_of_another_body_or_secret(self):
+        self.assertFalse(verify_hmac(BODY + b" ", sign(BODY), SECRET))
+        self.assertFalse(verify_hmac(BODY, sign(BODY, "other"), SECRET))
+        self.assertFalse(verify_hmac(BODY, "not base64", SECRET))
+
+    def test_missing_signature_or_secret(self):
+        self.assertFalse(verify_hmac(BODY, None, SECRET))
+        self.assertFalse(verify_hmac(BODY, "", SECRET))
+        self.assertFalse(verify_hmac(BODY, sign(BODY), None))
+
+
+class ParseBodyTest(unittest.TestCase):
+    def test_object(self):
+        self.assertEqual(parse_body(BODY), {"id": 1, "title": "Bolt"})
+
+    def test_invalid_json_is_none(self):
+        self.assertIsNone(parse_body(b'{"id": 1'))
+        self.assertIsNone(parse_body(b""))
+        self.assertIsNone(parse_body(b"\xff"))
+
+    def test_other_json_values_are_returned_for_the_caller_to_reject(self):
+        self.assertEqual(parse_body(b"[1, 2]"), [1, 2])
+        self.assertEqual(parse_body(b"null"), None)
+        self.assertEqual(parse_body(b'"text"'), "text")
+
+
+if __name__ == "__main__":
+    unittest.main()